@@ -1,10 +1,12 @@
-from datetime import datetime, timedelta
+from datetime import datetime
 import logging
-import h5py
+import time
 import os
 
 from reach_ctrl.ucontroller.microcontroller import Microcontroller
 from reach_ctrl.spectrometer.spectrometer import Spectrometer
+from reach_ctrl.spectrometer.telemetry import acquisition_statistics_dtype, heap_statistics_dtype
+from reach_ctrl.observation_writer import ObservationWriter
 from reach_ctrl.reach_config import REACHConfig
 from reach_ctrl.vna.vna import VNA
 from reach_ctrl import utils
@@ -28,9 +30,20 @@ class REACHObservation:
         self._simulation_mode = False
         self._observation_name = observation.get("name", "test_observation")
         self._start_time = observation.get("start_time", "now")
-        self._scheduling_mode = observation.get("scheduling_mode", "UCT").upper()
+        self._scheduling_mode = observation.get("scheduling_mode", "UTC").upper()
         self._output_directory = observation.get("output_directory", "/tmp/reach_test_obs")
         self._longitude, self._latitude = observation.get("longitude"), observation.get("latitude")
+        self._rows_per_flush = observation.get("rows_per_flush", 16)
+        self._dataset_filters = observation.get("dataset_filters")
+        self._compression_processes = observation.get("compression_processes", 0)
+        self._swmr = observation.get("swmr", False)
+        self._flush_interval = observation.get("flush_interval")
+        self._max_file_size = observation.get("max_file_size", 0) * 1024 * 1024
+        self._rollover_interval = observation.get("rollover_interval", 0)
+        self._catalog_file = observation.get("catalog_file")
+        if self._catalog_file is not None:
+            self._catalog_file = os.path.join(self._output_directory, self._catalog_file)
+        self._preview_levels = observation.get("preview_levels")
         self._operations = operations
 
         # Check if directory exists, and if not try to create it
@@ -48,6 +61,12 @@ class REACHObservation:
         self._ucontroller = None
         self._vna = None
 
+        # Observation data file writer, open for the duration of the observation
+        self._writer = None
+
+        # Start times (UNIX) of scheduled operations, computed during dry runs
+        self._timeline = []
+
         # Placeholder for spectra data file
         current_time = datetime.utcnow()
         self._observation_data_file = os.path.join(self._output_directory, "{}_{}.hdf5".format(self._observation_name,
@@ -61,30 +80,44 @@ class REACHObservation:
 
         # Wait for observation to start
         if not self._simulation_mode:
-            utils.schedule(self._start_time, mode=self._scheduling_mode)
+            utils.schedule(self._start_time, mode=self._scheduling_mode, longitude=self._longitude)
+        elif self._start_time == "now":
+            logging.info("Operations will start now")
         else:
-            logging.info("Operations will start at {}".format(self._start_time))
+            start = float(utils.get_schedule_timeline(self._start_time, self._scheduling_mode, self._longitude)[0])
+            self._timeline.append(start)
+            logging.info("Operations will start at {} UTC".format(
+                datetime.utcfromtimestamp(start).strftime("%d/%m/%Y %H:%M:%S")))
 
         # If a list of operations is not passed on as an argument then use
         # the list in the object instance
         if operations is None:
             operations = self._operations
 
-        # Create output file 
-        if not self._simulation_mode:
+        # Create output file. Nested observation operations write to the same file
+        created_file = False
+        if not self._simulation_mode and self._writer is None:
             self._create_output_file()
+            created_file = True
 
         # Go through list of operations and run them
-        for operation in operations:
-            if type(operation) is not dict:
-                self.run_operation(operation)
-            else:
-                key = list(operation.keys())
-                if len(key) != 1:
-                    logging.error("Operation entry can only have one key ({} is invalid). Skipping".format(operation))
-                    continue
+        try:
+            for operation in operations:
+                if type(operation) is not dict:
+                    self.run_operation(operation)
+                else:
+                    key = list(operation.keys())
+                    if len(key) != 1:
+                        logging.error("Operation entry can only have one key ({} is invalid). "
+                                      "Skipping".format(operation))
+                        continue
 
-                self.run_operation(key[0], operation[key[0]])
+                    self.run_operation(key[0], operation[key[0]])
+
+        # Close output file once all operations are done, or when interrupted, writing all pending data
+        finally:
+            if created_file:
+                self._close_output_file()
 
     def run_operation(self, operation, parameters=None):
         """ Execute an operation
@@ -120,106 +153,179 @@ class REACHObservation:
             # Running a repeated obs. Check start time and repetition period
             local_start = parameters.get('start_time', "now")
             period = parameters.get("every", 0)
+            repetitions = parameters.get('repetitions', 1)
+
+            # Dry runs do not wait, so schedule from the last simulated start time
+            current_time = time.time()
+            if self._simulation_mode and self._timeline:
+                current_time = max(current_time, self._timeline[-1])
 
             # If "now", then schedule in 10 seconds
             if local_start == "now":
-                local_start = datetime.now() + timedelta(seconds=10)
+                local_start = current_time + 10
 
-            # Wait for observation start
-            if not self._simulation_mode:
-                utils.schedule(local_start, mode=self._scheduling_mode)
-            else:
-                logging.info("Observation will start at {}".format(self._start_time))
+            # Start times of all repetitions, computed up front. In LST mode the start time is an LST and the
+            # period is in sidereal seconds, so that repetitions can start at the same LST on consecutive days
+            timeline = utils.get_schedule_timeline(local_start, self._scheduling_mode, self._longitude,
+                                                   0 if period == "now" else period, repetitions, current_time)
 
             # Process the repeating observation operations
-            for i in range(parameters.get('repetitions', 1)):
-                # Update start time to reflect current iteration
-                if period == "now":
+            for i in range(repetitions):
+                # Update start time to reflect current iteration. Without a period, repetitions start as soon
+                # as the previous one is done
+                if i > 0 and period in (0, "now"):
                     self._start_time = "now"
                 else:
-                    self._start_time = local_start + timedelta(seconds=period * i)
+                    self._start_time = float(timeline[i])
 
                 self.run_observation(parameters.get('operations', []))
         else:
             logging.warning("Operation {} not supported. Skipping".format(operation))
 
     def dry_run_operations(self):
-        """ Perform a dry run of the operations to make sure that configuration is valid """
+        """ Perform a dry run of the operations to make sure that configuration is valid
+        :return: Scheduled start times (UNIX) of the observation and of each repetition of observation operations """
 
         # Enable simulation mode
         self._simulation_mode = True
+        self._timeline = []
 
         # Run operations
         self.run_observation()
 
         # Disable simulation mode
         self._simulation_mode = False
+        return self._timeline
 
     def _create_output_file(self):
         """ Create HDF5 output file """
-        # Create HDF5 file which will store observation data
-        with h5py.File(self._observation_data_file, 'w') as f:
-            # Create group which will contain observation info
-            info = f.create_group('observation_info')
-
-            # Add attributes to group
-            info.attrs['observation_name'] = self._observation_name
-            info.attrs['start_time'] = self._start_time
-            info.attrs['start_lst'] = utils.get_sidereal_time(self._longitude, self._latitude,
-                                                              self._start_time.timestamp(0))
-            # info.attrs['operations'] = self._operations
-            # TODO: Add more when required
-
-            # Create group which will contain all observation data
-            f.create_group("observation_data")
+        # Create HDF5 file which will store observation data, with the observation info as attributes.
+        # Datasets are sized for the planned number of spectra up front
+        self._writer = ObservationWriter(self._observation_data_file, rows_per_flush=self._rows_per_flush,
+                                         expected_rows=self._count_dataset_rows(self._operations),
+                                         dataset_filters=self._dataset_filters,
+                                         compression_processes=self._compression_processes,
+                                         swmr=self._swmr, flush_interval=self._flush_interval,
+                                         max_file_size=self._max_file_size,
+                                         rollover_interval=self._rollover_interval, longitude=self._longitude,
+                                         catalog_file=self._catalog_file, preview_levels=self._preview_levels)
+        self._writer.open(observation_info={
+            'observation_name': self._observation_name,
+            'start_time': self._start_time,
+            'start_lst': utils.get_sidereal_time(self._longitude, self._latitude)})
+        # TODO: Add more when required
+
+        # In SWMR mode datasets cannot be added once readers can open the file, so create the datasets of
+        # all planned spectrum measurements first
+        if self._swmr:
+            nof_channels = REACHConfig()['spectrometer'].get('nof_frequency_channels', 16384)
+            for name in sorted(self._get_spectrum_names(self._operations)):
+                self._writer.create_dataset("observation_data/{}_spectra".format(name), (nof_channels,), 'u8')
+                self._writer.create_dataset("observation_data/{}_timestamps".format(name), (), 'f8')
+                self._writer.create_dataset("observation_data/{}_lst_time".format(name), (), 'f8')
+                self._writer.create_dataset("observation_data/{}_channel_count".format(name), (nof_channels,), 'u4')
+                self._writer.create_dataset("observation_data/{}_heap_statistics".format(name), (),
+                                            heap_statistics_dtype)
+                self._writer.create_dataset("observation_data/{}_receiver_statistics".format(name), (),
+                                            acquisition_statistics_dtype)
+            self._writer.start_swmr()
 
         logging.info("Created output file")
 
-    def _add_spectrum_to_file(self, spectrum, name, timestamp):
-        """ Add spectrum to data file 
-        :param spectrum: The spectrum
-        :param name: The data name
-        :param timestamp: Spectrum timestsamp """
-
-        nof_frequency_channels = REACHConfig()['spectrometer']['nof_frequency_channels']
+    def _count_dataset_rows(self, operations):
+        """ Count the rows added to each spectrum dataset by a list of operations, including repeated operations
+        :param operations: List of operations
+        :return: Dictionary of dataset names to number of rows """
 
-        with h5py.File(self._observation_data_file, 'a') as f:
-            # Create dataset names
-            dataset_name = "{}_spectra".format(name)
-            timestamp_name = "{}_timestamps".format(name)
-            lst_name = "{}_lst_time".format(name)
+        rows = {}
+        for operation in operations:
+            if type(operation) is not dict:
+                continue
+
+            for name, parameters in operation.items():
+                # Each spectrum adds one row to its datasets, and one heap statistics row per accumulated heap
+                if name == "measure_spectrum":
+                    planned = {"{}_{}".format(parameters['name'], dataset): 1 for dataset in
+                               ['spectra', 'timestamps', 'lst_time', 'receiver_statistics', 'channel_count']}
+                    planned["{}_heap_statistics".format(parameters['name'])] = parameters.get('duration', 1)
+                elif name == "observation_operations":
+                    planned = {dataset: parameters.get('repetitions', 1) * nof_rows for dataset, nof_rows
+                               in self._count_dataset_rows(parameters.get('operations', [])).items()}
+                else:
+                    continue
 
-            # Load observation data group
-            dset = f['observation_data']
+                for dataset, nof_rows in planned.items():
+                    rows[dataset] = rows.get(dataset, 0) + nof_rows
 
-            # If data sets do not exist, add them
-            if dataset_name not in dset.keys():
-                dset.create_dataset(dataset_name,
-                                    (0, nof_frequency_channels),
-                                    maxshape=(None, nof_frequency_channels),
-                                    chunks=True,
-                                    dtype='u8')
+        return rows
 
-                dset.create_dataset(timestamp_name, (0,),
-                                    maxshape=(None,), chunks=True, dtype='f8')
+    def _get_spectrum_names(self, operations):
+        """ Get the names of the spectra measured by a list of operations, including nested operations
+        :param operations: List of operations """
 
-                dset.create_dataset(lst_name, (0,),
-                                    maxshape=(None,), chunks=True, dtype='f8')
+        names = set()
+        for operation in operations:
+            if type(operation) is not dict:
+                continue
 
-                logging.info("Added {} dataset to output file".format(dataset_name))
+            for name, parameters in operation.items():
+                if name == "measure_spectrum":
+                    names.add(parameters['name'])
+                elif name == "observation_operations":
+                    names.update(self._get_spectrum_names(parameters.get('operations', [])))
 
-            # Add spectrum and timestamp to buffer
-            dset = f['observation_data/{}'.format(dataset_name)]
-            dset.resize((dset.shape[0] + 1, dset.shape[1]))
-            dset[-1, :] = spectrum
+        return names
 
-            dset = f['observation_data/{}'.format(timestamp_name)]
-            dset.resize((dset.shape[0] + 1,))
-            dset[-1] = timestamp
+    def _close_output_file(self):
+        """ Write pending data and close HDF5 output file """
+        self._writer.close()
+        self._writer = None
 
-            dset = f['observation_data/{}'.format(lst_name)]
-            dset.resize((dset.shape[0] + 1,))
-            dset[-1] = utils.get_sidereal_time(self._longitude, self._latitude, timestamp)
+    def _add_spectrum_to_file(self, spectrum, name, timestamp, receiver_statistics=None, channel_count=None,
+                              heap_statistics=None):
+        """ Add spectrum to data file 
+        :param spectrum: The spectrum
+        :param name: The data name
+        :param timestamp: Spectrum timestsamp
+        :param receiver_statistics: Receiver statistics of the acquisition
+        :param channel_count: Number of spectra in which each frequency channel was received
+        :param heap_statistics: Receiver statistics of every heap in the acquisition """
+
+        # LST is computed and rows are written in the writer thread, so that the next operation is not
+        # delayed by disk writes
+        self._writer.submit(self._write_spectrum, spectrum.copy(), name, timestamp, receiver_statistics,
+                            None if channel_count is None else channel_count.copy(), heap_statistics)
+
+    def _write_spectrum(self, spectrum, name, timestamp, receiver_statistics, channel_count=None,
+                        heap_statistics=None):
+        """ Write spectrum rows to data file. Runs in the writer thread
+        :param spectrum: The spectrum
+        :param name: The data name
+        :param timestamp: Spectrum timestsamp
+        :param receiver_statistics: Receiver statistics of the acquisition
+        :param channel_count: Number of spectra in which each frequency channel was received
+        :param heap_statistics: Receiver statistics of every heap in the acquisition """
+
+        # Datasets are created by the writer on the first append, or up front in SWMR mode
+        self._writer.append("observation_data/{}_spectra".format(name), spectrum, dtype='u8')
+        self._writer.append("observation_data/{}_timestamps".format(name), timestamp, dtype='f8')
+        self._writer.append("observation_data/{}_lst_time".format(name),
+                            utils.get_sidereal_time(self._longitude, self._latitude, timestamp), dtype='f8')
+
+        if receiver_statistics is not None:
+            self._writer.append("observation_data/{}_receiver_statistics".format(name), receiver_statistics,
+                                dtype=acquisition_statistics_dtype)
+
+        # Channels with a count lower than the number of accumulated spectra were partially lost
+        if channel_count is not None:
+            self._writer.append("observation_data/{}_channel_count".format(name), channel_count, dtype='u4')
+
+        # One row per heap. The heaps of each spectrum follow those of the previous spectrum, their number is
+        # given by nof_heaps in the receiver statistics
+        if heap_statistics is not None:
+            for statistics in heap_statistics:
+                self._writer.append("observation_data/{}_heap_statistics".format(name), statistics,
+                                    dtype=heap_statistics_dtype)
 
     def _measure_s(self, name, source):
         """ Measure S parameters of a specific source """
@@ -261,13 +367,26 @@ class REACHObservation:
             logging.error("Microcontroller must be initialised to measure spectra.")
             exit()
 
-        # Toggle switch
+        # Toggle switch. Spectra integrated before the switch are not used
+        start_time = None
         if source != "none":
             self._enable_source(source)
+            start_time = time.time()
 
         # Get spectrum and save to file
-        timestamps, spectra = self._spectrometer.acquire_spectrum(nof_seconds=duration)
-        self._add_spectrum_to_file(spectra, name, timestamps[0])
+        timestamps, spectra = self._spectrometer.acquire_spectrum(nof_seconds=duration, start_time=start_time)
+        receiver_statistics, _ = self._spectrometer.get_receiver_telemetry()
+        _, _, channel_count = self._spectrometer.get_accumulation_statistics()
+        self._add_spectrum_to_file(spectra, name, timestamps[0], receiver_statistics, channel_count,
+                                   self._spectrometer.get_heap_statistics())
+
+        # Report packet loss
+        if receiver_statistics['received_packets'] != receiver_statistics['expected_packets']:
+            logging.warning("Lost {} of {} packets in {} heaps while measuring spectrum for {}, "
+                            "missing channel ranges {}".format(
+                                receiver_statistics['expected_packets'] - receiver_statistics['received_packets'],
+                                receiver_statistics['expected_packets'], receiver_statistics['incomplete_heaps'],
+                                name, self._spectrometer.get_missing_channels()))
 
         logging.info("Measured spectrum for {}".format(name))
 
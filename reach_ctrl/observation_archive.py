@@ -0,0 +1,193 @@
+from builtins import object
+import numpy as np
+import logging
+import json
+import glob
+import time
+import h5py
+import os
+
+# Datasets of each source which are stitched, by name suffix
+ARCHIVE_DATASETS = ['spectra', 'timestamps', 'lst_time']
+
+
+class ObservationArchive(object):
+    """ HDF5 virtual dataset (VDS) archive of a directory of observation files. For every source, the
+    observation_data/{name}_spectra, _timestamps and _lst_time datasets of all files are mapped, in time order,
+    into one continuous virtual dataset with the same name, so the whole campaign can be sliced (e.g. with an
+    ObservationReader) without copying any data.
+
+    The archive stores an index of the files it maps. On update only new and changed files are opened, and the
+    archive is rewritten (it only contains mappings, so this is fast) and replaced atomically, so readers which
+    have the previous version open are not affected. Source files are referenced by paths relative to the
+    archive, so the directory can be moved as a whole """
+
+    def __init__(self, archive_file, datasets=None):
+        """ Class constructor
+        :param archive_file: Path of archive file
+        :param datasets: Dataset name suffixes to stitch, defaults to ARCHIVE_DATASETS """
+        self._archive_file = os.path.abspath(archive_file)
+        self._datasets = datasets or ARCHIVE_DATASETS
+
+    @property
+    def archive_file(self):
+        """ Path of archive file """
+        return self._archive_file
+
+    def update(self, directory, pattern="*.hdf5", force=False):
+        """ Map new and changed files in a directory, and remove files which no longer exist
+        :param directory: Directory of observation files
+        :param pattern: File name pattern
+        :param force: Rewrite the archive even if no file changed
+        :return: Number of new or changed files """
+
+        index = self._load_index()
+        archive_directory = os.path.dirname(self._archive_file)
+
+        updated = {}
+        nof_changed = 0
+        for file_name in sorted(glob.glob(os.path.join(directory, pattern))):
+            path = os.path.abspath(file_name)
+            if path == self._archive_file:
+                continue
+
+            key = os.path.relpath(path, archive_directory)
+            stat = os.stat(path)
+            entry = index.get(key)
+            if entry is None or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+                entry = self._read_file(path)
+                if entry is None:
+                    continue
+                entry['mtime'], entry['size'] = stat.st_mtime, stat.st_size
+                nof_changed += 1
+            updated[key] = entry
+
+        if nof_changed == 0 and set(updated) == set(index) and not force and os.path.exists(self._archive_file):
+            return 0
+
+        self._write(updated)
+        logging.info("Updated archive {} ({} files, {} new or changed)".format(self._archive_file, len(updated),
+                                                                               nof_changed))
+        return nof_changed
+
+    def _load_index(self):
+        """ Get the index of mapped files stored in the archive """
+        if not os.path.exists(self._archive_file):
+            return {}
+        try:
+            with h5py.File(self._archive_file, 'r') as f:
+                return json.loads(f.attrs['archive_index'])
+        except Exception as e:
+            logging.warning("Cannot read index of archive {}, rebuilding it: {}".format(self._archive_file, e))
+            return {}
+
+    def _read_file(self, path):
+        """ Get the shape and type of the datasets to stitch in a file
+        :return: Index entry, or None if the file cannot be read or is an archive """
+        datasets = {}
+        try:
+            with h5py.File(path, 'r', swmr=True) as f:
+                if 'archive_index' in f.attrs or 'observation_data' not in f:
+                    return None
+
+                group = f['observation_data']
+                start_time = None
+                for key in group:
+                    dataset = group[key]
+                    suffix = [name for name in self._datasets if key.endswith("_{}".format(name))]
+                    if not suffix or not isinstance(dataset, h5py.Dataset) or dataset.is_virtual:
+                        continue
+                    datasets[key] = {'shape': list(dataset.shape), 'dtype': dataset.dtype.str,
+                                     'axis': 1 if dataset.ndim == 3 else 0}
+
+                    # Files are ordered by their first timestamp
+                    if key.endswith("_timestamps") and dataset.shape[0] > 0:
+                        first = float(dataset[0])
+                        start_time = first if start_time is None else min(start_time, first)
+        except Exception as e:
+            logging.error("Cannot add {} to archive: {}".format(path, e))
+            return None
+
+        return {'start_time': start_time, 'datasets': datasets}
+
+    def _write(self, index):
+        """ Write the archive with virtual datasets for an index of files, replacing the existing archive """
+
+        # Files without timestamps go last
+        order = sorted(index, key=lambda key: (index[key]['start_time'] is None, index[key]['start_time'], key))
+
+        # Group the datasets of each name across files, checking that rows have the same shape and type
+        layouts = {}
+        for key in order:
+            for name, dataset in index[key]['datasets'].items():
+                row_shape = dataset['shape'][:dataset['axis']] + dataset['shape'][dataset['axis'] + 1:]
+                if name not in layouts:
+                    layouts[name] = {'row_shape': row_shape, 'dtype': dataset['dtype'], 'axis': dataset['axis'],
+                                     'parts': []}
+                layout = layouts[name]
+                if layout['row_shape'] != row_shape or layout['dtype'] != dataset['dtype'] or \
+                        layout['axis'] != dataset['axis']:
+                    logging.warning("Skipping {} in {}, its shape or type differs from earlier files".format(
+                        name, key))
+                    continue
+                layout['parts'].append((key, dataset['shape']))
+
+        temporary_file = "{}.tmp".format(self._archive_file)
+        with h5py.File(temporary_file, 'w', libver='latest') as f:
+            f.attrs['archive_index'] = json.dumps(index)
+            f.attrs['update_time'] = time.time()
+            info = f.create_group('observation_info')
+            info.attrs['files'] = json.dumps(order)
+            data = f.create_group('observation_data')
+
+            for name, layout in sorted(layouts.items()):
+                axis = layout['axis']
+                nof_rows = sum(shape[axis] for _, shape in layout['parts'])
+                shape = list(layout['row_shape'])
+                shape.insert(axis, nof_rows)
+                virtual_layout = h5py.VirtualLayout(shape=tuple(shape), dtype=np.dtype(layout['dtype']))
+
+                row = 0
+                for key, part_shape in layout['parts']:
+                    if part_shape[axis] == 0:
+                        continue
+                    selection = [slice(None)] * len(shape)
+                    selection[axis] = slice(row, row + part_shape[axis])
+                    virtual_layout[tuple(selection)] = h5py.VirtualSource(key, "observation_data/{}".format(name),
+                                                                          shape=tuple(part_shape))
+                    row += part_shape[axis]
+
+                data.create_virtual_dataset(name, virtual_layout)
+
+                # First row of each file in the virtual dataset, to map rows back to files
+                offsets = np.cumsum([0] + [part_shape[axis] for _, part_shape in layout['parts']])
+                data[name].attrs['files'] = json.dumps([key for key, _ in layout['parts']])
+                data[name].attrs['file_offsets'] = offsets
+
+        os.replace(temporary_file, self._archive_file)
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-d", "--directory", dest="directory", default=None, help="Directory of observation files")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="Archive file (default: archive.hdf5 in the observation directory)")
+    parser.add_option("-p", "--pattern", dest="pattern", default="*.hdf5",
+                      help="Observation file name pattern (default: *.hdf5)")
+    parser.add_option("--interval", dest="interval", default=0, type=float,
+                      help="Keep updating the archive at this interval in seconds (default: 0, update once)")
+    (config, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if config.directory is None:
+        parser.error("An observation directory must be specified")
+
+    archive = ObservationArchive(config.output or os.path.join(config.directory, "archive.hdf5"))
+    while True:
+        archive.update(config.directory, config.pattern)
+        if config.interval <= 0:
+            break
+        time.sleep(config.interval)
@@ -0,0 +1,366 @@
+from builtins import object
+import numpy as np
+import logging
+import sqlite3
+import glob
+import h5py
+import os
+
+from reach_ctrl import utils
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, path TEXT UNIQUE, mtime REAL, size INTEGER,
+                                  observation_name TEXT, start_time REAL, end_time REAL);
+CREATE TABLE IF NOT EXISTS sources (id INTEGER PRIMARY KEY, file_id INTEGER, name TEXT, nof_rows INTEGER,
+                                    start_time REAL, end_time REAL, lst_min REAL, lst_max REAL);
+CREATE TABLE IF NOT EXISTS datasets (source_id INTEGER, path TEXT, axis INTEGER, nof_rows INTEGER);
+CREATE TABLE IF NOT EXISTS blocks (source_id INTEGER, start_row INTEGER, stop_row INTEGER,
+                                   start_time REAL, end_time REAL, lst_min REAL, lst_max REAL);
+CREATE INDEX IF NOT EXISTS sources_file ON sources (file_id);
+CREATE INDEX IF NOT EXISTS sources_name ON sources (name);
+CREATE INDEX IF NOT EXISTS blocks_time ON blocks (source_id, start_time, end_time);
+"""
+
+
+def _lst_bounds(lst):
+    """ Get the range covered by a sequence of LST values (degrees), which may wrap around 360. The lower
+    bound is in [0, 360), the upper bound can exceed 360 """
+    unwrapped = np.degrees(np.unwrap(np.radians(lst)))
+    lower = float(np.min(unwrapped))
+    upper = float(np.max(unwrapped))
+    offset = np.floor(lower / 360.0) * 360.0
+    return lower - offset, upper - offset
+
+
+def _in_lst_range(lst, lst_range):
+    """ Mask of LST values (degrees) in a range, which wraps around 360 if its start is after its end """
+    start, end = lst_range
+    lst = np.mod(lst, 360.0)
+    if start <= end:
+        return (lst >= start) & (lst <= end)
+    return (lst >= start) | (lst <= end)
+
+
+def _runs(mask):
+    """ Get (start, stop) ranges of runs of True values in a mask """
+    edges = np.flatnonzero(np.diff(np.concatenate(([False], mask, [False])).astype(np.int8)))
+    return [(int(start), int(stop)) for start, stop in zip(edges[0::2], edges[1::2])]
+
+
+class ObservationCatalog(object):
+    """ SQLite catalog of observation files. For each file it records its sources (the names of measured
+    spectra, e.g. obs_ant for observation_data/obs_ant_spectra), their datasets, row counts, and time and LST
+    ranges. Ranges are also recorded per block of rows, so that queries can return the row slices of each
+    dataset which cover a time or LST range without opening any file.
+
+    Files are indexed again only if they have changed since they were last indexed. LST values are in degrees,
+    times are UNIX timestamps """
+
+    def __init__(self, catalog_file, block_size=256, longitude=None, check_same_thread=True):
+        """ Class constructor
+        :param catalog_file: Path of SQLite catalog, created if it does not exist
+        :param block_size: Number of rows per block in the row index
+        :param longitude: Site longitude in degrees, used to compute LST for sources without an LST dataset
+        :param check_same_thread: If False, the catalog can be used from threads other than the one which created
+                                  it. Callers must then make sure it is not used by two threads at once """
+
+        self._catalog_file = catalog_file
+        self._block_size = block_size
+        self._longitude = longitude
+
+        self._connection = sqlite3.connect(catalog_file, timeout=30, check_same_thread=check_same_thread)
+        self._connection.executescript(_SCHEMA)
+
+    def index_file(self, file_name, force=False):
+        """ Add a file to the catalog, or update its entry if the file changed
+        :param file_name: Path of HDF5 observation file
+        :param force: Index the file even if it did not change
+        :return: True if the file was indexed """
+
+        path = os.path.abspath(file_name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            logging.error("Cannot index {}, file does not exist".format(path))
+            return False
+
+        row = self._connection.execute("SELECT mtime, size FROM files WHERE path = ?", (path,)).fetchone()
+        if not force and row is not None and row[0] == stat.st_mtime and row[1] == stat.st_size:
+            return False
+
+        try:
+            sources, observation_name = self._read_file(path)
+        except Exception as e:
+            logging.error("Cannot index {}: {}".format(path, e))
+            return False
+
+        with self._connection:
+            self._remove(path)
+            times = [t for source in sources for t in (source['start_time'], source['end_time'])
+                     if t is not None]
+            cursor = self._connection.execute(
+                "INSERT INTO files (path, mtime, size, observation_name, start_time, end_time) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (path, stat.st_mtime, stat.st_size, observation_name,
+                 min(times) if times else None, max(times) if times else None))
+            file_id = cursor.lastrowid
+
+            for source in sources:
+                cursor = self._connection.execute(
+                    "INSERT INTO sources (file_id, name, nof_rows, start_time, end_time, lst_min, lst_max) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (file_id, source['name'], source['nof_rows'], source['start_time'], source['end_time'],
+                     source['lst_min'], source['lst_max']))
+                source_id = cursor.lastrowid
+                self._connection.executemany("INSERT INTO datasets (source_id, path, axis, nof_rows) "
+                                             "VALUES (?, ?, ?, ?)",
+                                             [(source_id,) + dataset for dataset in source['datasets']])
+                self._connection.executemany("INSERT INTO blocks (source_id, start_row, stop_row, start_time, "
+                                             "end_time, lst_min, lst_max) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                             [(source_id,) + block for block in source['blocks']])
+
+        logging.info("Indexed {} ({} sources)".format(path, len(sources)))
+        return True
+
+    def update(self, directory, pattern="*.hdf5"):
+        """ Index new and changed files in a directory, and remove files which no longer exist
+        :param directory: Directory of observation files
+        :param pattern: File name pattern
+        :return: Number of files indexed """
+
+        nof_indexed = 0
+        for file_name in sorted(glob.glob(os.path.join(directory, pattern))):
+            if self.index_file(file_name):
+                nof_indexed += 1
+
+        # Remove missing files in the directory
+        directory = os.path.abspath(directory)
+        for (path,) in self._connection.execute("SELECT path FROM files").fetchall():
+            if os.path.dirname(path) == directory and not os.path.exists(path):
+                with self._connection:
+                    self._remove(path)
+
+        return nof_indexed
+
+    def list_sources(self):
+        """ Get the names of all indexed sources """
+        return [name for (name,) in self._connection.execute("SELECT DISTINCT name FROM sources ORDER BY name")]
+
+    def list_files(self, time_range=None):
+        """ Get the indexed files, optionally only those with data in a time range
+        :param time_range: (start, end) UNIX times, None for all files
+        :return: List of (path, observation name, start time, end time) tuples, by start time """
+
+        query, parameters = "SELECT path, observation_name, start_time, end_time FROM files", []
+        if time_range is not None:
+            query += " WHERE end_time >= ? AND start_time <= ?"
+            parameters = [time_range[0], time_range[1]]
+        return self._connection.execute(query + " ORDER BY start_time", parameters).fetchall()
+
+    def query(self, time_range=None, lst_range=None, sources=None, dataset="spectra", exact=False):
+        """ Find the rows of datasets in a time and LST range
+        :param time_range: (start, end) UNIX times, None for no limit
+        :param lst_range: (start, end) LST in degrees, wrapping around 360 if start is after end. None for no limit
+        :param sources: List of source names, None for all sources
+        :param dataset: Dataset of each source to return, e.g. spectra or timestamps
+        :param exact: Read the timestamp (and LST) datasets of matching blocks to trim slices to matching rows.
+                      Otherwise slices are block aligned and can include up to a block of rows outside the range
+                      at either end
+        :return: List of (file, dataset path, row slice) tuples, in time order. The slice is along the dataset
+                 time axis, which is axis 1 for (signal, time, channel) spectra """
+
+        query = ("SELECT files.path, sources.name, datasets.path, datasets.axis, blocks.start_row, blocks.stop_row "
+                 "FROM blocks JOIN sources ON blocks.source_id = sources.id "
+                 "JOIN files ON sources.file_id = files.id "
+                 "JOIN datasets ON datasets.source_id = sources.id "
+                 "WHERE datasets.path = 'observation_data/' || sources.name || '_' || ?")
+        parameters = [dataset]
+
+        if time_range is not None:
+            query += " AND blocks.end_time >= ? AND blocks.start_time <= ?"
+            parameters += [time_range[0], time_range[1]]
+
+        if lst_range is not None:
+            # Blocks store an LST interval whose lower bound is in [0, 360), compare against the requested
+            # range shifted by a full turn either way
+            start, end = lst_range
+            if end < start:
+                end += 360.0
+            query += " AND blocks.lst_min IS NOT NULL AND (" + " OR ".join(
+                ["(blocks.lst_max >= ? AND blocks.lst_min <= ?)"] * 3) + ")"
+            for shift in (-360.0, 0.0, 360.0):
+                parameters += [start + shift, end + shift]
+
+        if sources is not None:
+            query += " AND sources.name IN ({})".format(", ".join(["?"] * len(sources)))
+            parameters += list(sources)
+
+        query += " ORDER BY blocks.start_time, files.path, blocks.start_row"
+
+        # Merge consecutive blocks of the same dataset into slices
+        matches = []
+        for path, source, dataset_path, axis, start_row, stop_row in self._connection.execute(query, parameters):
+            if matches and matches[-1][0] == path and matches[-1][1] == dataset_path and \
+                    matches[-1][2].stop == start_row:
+                matches[-1] = (path, dataset_path, slice(matches[-1][2].start, stop_row), source)
+            else:
+                matches.append((path, dataset_path, slice(start_row, stop_row), source))
+
+        if exact:
+            return self._trim(matches, time_range, lst_range)
+        return [(path, dataset_path, rows) for path, dataset_path, rows, source in matches]
+
+    def close(self):
+        """ Close the catalog """
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _remove(self, path):
+        """ Remove a file and its sources from the catalog """
+        row = self._connection.execute("SELECT id FROM files WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return
+
+        source_ids = "SELECT id FROM sources WHERE file_id = ?"
+        self._connection.execute("DELETE FROM blocks WHERE source_id IN ({})".format(source_ids), row)
+        self._connection.execute("DELETE FROM datasets WHERE source_id IN ({})".format(source_ids), row)
+        self._connection.execute("DELETE FROM sources WHERE file_id = ?", row)
+        self._connection.execute("DELETE FROM files WHERE id = ?", row)
+
+    def _read_file(self, path):
+        """ Read the sources of an observation file
+        :return: List of source dictionaries and observation name """
+
+        sources = []
+        with h5py.File(path, 'r', swmr=True) as f:
+            # Virtual dataset archives map rows of other files, which are indexed themselves
+            if 'archive_index' in f.attrs:
+                return sources, None
+
+            observation_name = f['observation_info'].attrs.get('observation_name') \
+                if 'observation_info' in f else None
+            if isinstance(observation_name, bytes):
+                observation_name = observation_name.decode()
+
+            group = f['observation_data'] if 'observation_data' in f else {}
+            names = sorted(key[:-len("_timestamps")] for key in group if key.endswith("_timestamps"))
+
+            # Datasets belong to the source with the longest matching name prefix
+            owners = {}
+            for key in group:
+                matching = [name for name in names if key.startswith(name + "_")]
+                if matching and isinstance(group[key], h5py.Dataset):
+                    owners[key] = max(matching, key=len)
+
+            for name in names:
+                timestamps = group["{}_timestamps".format(name)][:]
+                nof_rows = timestamps.shape[0]
+
+                lst = None
+                if "{}_lst_time".format(name) in group:
+                    lst = group["{}_lst_time".format(name)][:nof_rows]
+                elif self._longitude is not None:
+                    lst = utils.get_sidereal_times(timestamps, self._longitude)
+
+                # Datasets of the source, with the axis along which they have one row per timestamp
+                datasets = []
+                for key in sorted(key for key, owner in owners.items() if owner == name):
+                    shape = group[key].shape
+                    axis = 1 if len(shape) == 3 else 0
+                    datasets.append(("observation_data/{}".format(key), axis, int(shape[axis])))
+
+                sources.append(self._summarise(name, timestamps, lst, datasets))
+
+        return sources, observation_name
+
+    def _summarise(self, name, timestamps, lst, datasets):
+        """ Compute the time and LST ranges of a source and of each of its blocks of rows """
+        source = {'name': name, 'nof_rows': int(timestamps.shape[0]), 'datasets': datasets, 'blocks': [],
+                  'start_time': None, 'end_time': None, 'lst_min': None, 'lst_max': None}
+        if timestamps.shape[0] == 0:
+            return source
+
+        source['start_time'], source['end_time'] = float(np.min(timestamps)), float(np.max(timestamps))
+        if lst is not None:
+            source['lst_min'], source['lst_max'] = _lst_bounds(lst)
+
+        for start in range(0, timestamps.shape[0], self._block_size):
+            stop = min(start + self._block_size, timestamps.shape[0])
+            block_lst = (None, None) if lst is None else _lst_bounds(lst[start:stop])
+            source['blocks'].append((start, stop, float(np.min(timestamps[start:stop])),
+                                     float(np.max(timestamps[start:stop]))) + block_lst)
+
+        return source
+
+    def _trim(self, matches, time_range, lst_range):
+        """ Trim block aligned matches to the rows in range, using the timestamps and LST of each source """
+
+        trimmed = []
+        for path, dataset_path, rows, source in matches:
+            with h5py.File(path, 'r', swmr=True) as f:
+                mask = np.ones(rows.stop - rows.start, dtype=bool)
+                timestamps = f["observation_data/{}_timestamps".format(source)][rows]
+                if time_range is not None:
+                    mask &= (timestamps >= time_range[0]) & (timestamps <= time_range[1])
+                if lst_range is not None:
+                    if "observation_data/{}_lst_time".format(source) in f:
+                        lst = f["observation_data/{}_lst_time".format(source)][rows]
+                    else:
+                        lst = utils.get_sidereal_times(timestamps, self._longitude)
+                    mask &= _in_lst_range(lst, lst_range)
+
+            trimmed.extend((path, dataset_path, slice(rows.start + start, rows.start + stop))
+                           for start, stop in _runs(mask))
+
+        return trimmed
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    from datetime import datetime
+    import calendar
+
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-c", "--catalog", dest="catalog", default=None, help="SQLite catalog file")
+    parser.add_option("-d", "--directory", dest="directory", default=None,
+                      help="Index new and changed observation files in this directory")
+    parser.add_option("--start", dest="start", default=None, help="Start of time range (%d/%m/%Y_%H:%M, UTC)")
+    parser.add_option("--end", dest="end", default=None, help="End of time range (%d/%m/%Y_%H:%M, UTC)")
+    parser.add_option("--lst", dest="lst", default=None,
+                      help="LST range in hours, e.g. 4,6 (wraps around 24h if the start is after the end)")
+    parser.add_option("-s", "--source", dest="source", default=None,
+                      help="Comma separated source names, e.g. obs_ant (default: all)")
+    parser.add_option("--longitude", dest="longitude", default=None, type=float,
+                      help="Site longitude in degrees, for files without LST datasets")
+    (config, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if config.catalog is None:
+        parser.error("A catalog file must be specified")
+
+    catalog = ObservationCatalog(config.catalog, longitude=config.longitude)
+    if config.directory is not None:
+        logging.info("Indexed {} files".format(catalog.update(config.directory)))
+
+    def to_timestamp(value, default):
+        if value is None:
+            return default
+        return calendar.timegm(datetime.strptime(value, "%d/%m/%Y_%H:%M").timetuple())
+
+    time_range = None
+    if config.start is not None or config.end is not None:
+        time_range = (to_timestamp(config.start, 0), to_timestamp(config.end, float('inf')))
+
+    lst_range = None
+    if config.lst is not None:
+        lst_range = tuple(float(hours) * 15 for hours in config.lst.split(','))
+
+    sources = config.source.split(',') if config.source is not None else None
+
+    if time_range is not None or lst_range is not None or sources is not None:
+        for file_name, dataset, rows in catalog.query(time_range, lst_range, sources, exact=True):
+            print("{} {} {}:{}".format(file_name, dataset, rows.start, rows.stop))
+
+    catalog.close()
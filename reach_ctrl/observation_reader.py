@@ -0,0 +1,516 @@
+from builtins import object
+import numpy as np
+import logging
+import h5py
+import yaml
+import os
+
+from reach_ctrl import utils
+
+
+def read_manifest(manifest_file, start_time=None, end_time=None):
+    """ Get the segment files of an observation which was split by ObservationWriter, optionally only those
+    overlapping a time range. Segments without a time range (e.g. still being written) are always included
+    :param manifest_file: Path of segment manifest
+    :param start_time: Start of time range (UNIX time), None for no limit
+    :param end_time: End of time range (UNIX time), None for no limit
+    :return: List of segment entries (file, start_time, end_time, start_lst, end_lst, size, nof_rows), with
+             file paths relative to the current directory """
+
+    with open(manifest_file) as f:
+        segments = (yaml.safe_load(f) or {}).get('segments', [])
+
+    directory = os.path.dirname(manifest_file)
+    selected = []
+    for segment in segments:
+        if 'start_time' in segment:
+            if start_time is not None and segment['end_time'] < start_time:
+                continue
+            if end_time is not None and segment['start_time'] > end_time:
+                continue
+        segment = dict(segment)
+        segment['file'] = os.path.join(directory, segment['file'])
+        selected.append(segment)
+
+    return selected
+
+
+def get_nof_rows(dataset, axis=0):
+    """ Get the number of rows written to a dataset. ObservationWriter grows datasets ahead of the rows written and
+    only trims them when the file is closed, so the nof_rows attribute, updated on every flush, is used for files
+    which were not closed
+    :param dataset: h5py dataset
+    :param axis: Append axis of dataset """
+    nof_rows = dataset.shape[axis]
+    if 'nof_rows' in dataset.attrs:
+        nof_rows = min(nof_rows, int(dataset.attrs['nof_rows']))
+    return nof_rows
+
+
+def list_preview_levels(observation_file, path):
+    """ Get the preview levels of a dataset, written by ObservationWriter when preview levels are configured
+    :param observation_file: Open h5py file
+    :param path: Full resolution dataset path
+    :return: List of (preview path, frequency factor, time factor), from finest to coarsest """
+
+    if 'observation_preview' not in observation_file:
+        return []
+
+    levels = []
+    for name, dataset in observation_file['observation_preview'].items():
+        if dataset.attrs.get('source') == path:
+            levels.append(("observation_preview/{}".format(name), int(dataset.attrs['frequency_factor']),
+                           int(dataset.attrs['time_factor'])))
+    return sorted(levels, key=lambda level: level[1] * level[2])
+
+
+def select_preview_level(observation_file, path, nof_channels=None, nof_rows=None, axis=0):
+    """ Select the coarsest version of a dataset which still has the requested resolution, e.g. the number of
+    pixels of a plot, so that browsing long observations does not read full resolution spectra
+    :param observation_file: Open h5py file
+    :param path: Full resolution dataset path
+    :param nof_channels: Minimum number of frequency channels, None for any
+    :param nof_rows: Minimum number of rows (spectra) along the time axis, None for any
+    :param axis: Time axis of dataset
+    :return: Path, frequency factor and time factor of selected dataset. The full resolution dataset (factors 1)
+             is returned if no preview level has enough resolution """
+
+    selected = (path, 1, 1)
+    for preview_path, frequency_factor, time_factor in list_preview_levels(observation_file, path):
+        dataset = observation_file[preview_path]
+        if nof_channels is not None and dataset.shape[-1] < nof_channels:
+            continue
+        if nof_rows is not None and get_nof_rows(dataset, axis) < nof_rows:
+            continue
+        if frequency_factor * time_factor > selected[1] * selected[2]:
+            selected = (preview_path, frequency_factor, time_factor)
+    return selected
+
+
+class LiveObservationReader(object):
+    """ Reads an observation file while it is being written by an ObservationWriter in SWMR mode. Datasets
+    are refreshed on every read and only rows added since the previous read are returned, so monitoring
+    tools do not re-read the whole file. Files which are not being written can be read in the same way """
+
+    def __init__(self, file_name):
+        """ Class constructor
+        :param file_name: Path of HDF5 observation file """
+        self._file_name = file_name
+        self._file = h5py.File(file_name, 'r', libver='latest', swmr=True)
+
+        # Number of rows already returned per dataset
+        self._positions = {}
+
+    @property
+    def file_name(self):
+        """ Path of HDF5 file """
+        return self._file_name
+
+    def list_datasets(self, group='observation_data'):
+        """ Get the paths of the datasets in a group
+        :param group: Group path """
+        return ["{}/{}".format(group, name) for name, node in self._file[group].items()
+                if isinstance(node, h5py.Dataset)]
+
+    def get_attributes(self, path='observation_info'):
+        """ Get attributes of a group or dataset
+        :param path: Group or dataset path """
+        return dict(self._file[path].attrs)
+
+    def shape(self, path):
+        """ Get the current shape of a dataset
+        :param path: Dataset path """
+        dataset = self._file[path]
+        dataset.refresh()
+        return dataset.shape
+
+    def nof_rows(self, path, axis=0):
+        """ Get the current number of rows written to a dataset, see get_nof_rows
+        :param path: Dataset path
+        :param axis: Append axis of dataset """
+        dataset = self._file[path]
+        dataset.refresh()
+        return get_nof_rows(dataset, axis)
+
+    def read(self, path, start, stop, axis=0, signal=None):
+        """ Read a range of rows of a dataset. Does not affect read_new
+        :param path: Dataset path
+        :param start: First row
+        :param stop: Row after the last row
+        :param axis: Append axis of dataset
+        :param signal: Signal to read from (signal, time, channel) datasets, None to read all signals. Only the
+                       selected signal is read from file, and rows are returned as (time, channel) """
+
+        dataset = self._file[path]
+        if dataset.ndim != 3:
+            signal = None
+
+        # Avoid a read for empty selections
+        if stop <= start:
+            shape = list(dataset.shape)
+            shape[axis] = 0
+            return np.zeros(shape[1:] if signal is not None else shape, dtype=dataset.dtype)
+
+        index = [slice(None)] * dataset.ndim
+        index[axis] = slice(start, stop)
+        if signal is not None:
+            index[0] = signal
+        return dataset[tuple(index)]
+
+    def read_new(self, path, axis=0, max_rows=None, signal=None):
+        """ Read the rows added to a dataset since the previous call
+        :param path: Dataset path
+        :param axis: Append axis of dataset
+        :param max_rows: Maximum number of rows to return. If more rows were added, only the latest ones are
+                         returned and older ones are skipped
+        :param signal: Signal to read from (signal, time, channel) datasets, None to read all signals (see read)
+        :return: New rows, with the append axis of the dataset (empty if there are no new rows) """
+
+        end = self.nof_rows(path, axis)
+        start = min(self._positions.get(path, 0), end)
+        if max_rows is not None:
+            start = max(start, end - max_rows)
+
+        self._positions[path] = end
+        return self.read(path, start, end, axis, signal)
+
+    def read_latest(self, path, axis=0):
+        """ Read the last row of a dataset, or None if the dataset is empty. Does not affect read_new
+        :param path: Dataset path
+        :param axis: Append axis of dataset """
+
+        end = self.nof_rows(path, axis)
+        if end == 0:
+            return None
+        return np.take(self.read(path, end - 1, end, axis), 0, axis=axis)
+
+    def select_preview(self, path, nof_channels=None, nof_rows=None, axis=0):
+        """ Select the coarsest preview level of a dataset with the requested resolution, see select_preview_level
+        :return: Path, frequency factor and time factor of selected dataset """
+        for preview_path, _, _ in list_preview_levels(self._file, path):
+            self._file[preview_path].refresh()
+        return select_preview_level(self._file, path, nof_channels, nof_rows, axis)
+
+    def seek(self, path, row=0):
+        """ Set the row from which the next read_new call reads
+        :param path: Dataset path
+        :param row: Row number """
+        self._positions[path] = row
+
+    def close(self):
+        """ Close file """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            logging.debug("Closed observation file {}".format(self._file_name))
+
+
+def _mask_runs(mask):
+    """ Get [start, stop) ranges of runs of True values in a mask """
+    edges = np.flatnonzero(np.diff(np.concatenate(([False], mask, [False])).astype(np.int8)))
+    return [(int(start), int(stop)) for start, stop in zip(edges[0::2], edges[1::2])]
+
+
+def _intersect_runs(first, second):
+    """ Intersect two sorted lists of non-overlapping [start, stop) ranges """
+    runs, i, j = [], 0, 0
+    while i < len(first) and j < len(second):
+        start, stop = max(first[i][0], second[j][0]), min(first[i][1], second[j][1])
+        if start < stop:
+            runs.append((start, stop))
+        if first[i][1] < second[j][1]:
+            i += 1
+        else:
+            j += 1
+    return runs
+
+
+class ObservationReader(object):
+    """ Read-only access to observation files, possibly split into segments, as a set of sources. A source is a
+    measured input (e.g. obs_ant), whose datasets follow the {name}_spectra, {name}_timestamps and
+    {name}_lst_time naming convention. Files are opened, and data is read, only when needed.
+
+    Files must be given in time order, which is the case for the segments listed in a manifest and for the
+    files returned by an ObservationCatalog """
+
+    def __init__(self, files, longitude=None):
+        """ Class constructor
+        :param files: Observation file, segment manifest (.yaml), or list of files in time order
+        :param longitude: Site longitude in degrees, used to compute LST for sources without an LST dataset """
+
+        if not isinstance(files, (list, tuple)):
+            files = [files]
+
+        self._file_names = []
+        for file_name in files:
+            if file_name.endswith(".yaml"):
+                self._file_names.extend(segment['file'] for segment in read_manifest(file_name))
+            else:
+                self._file_names.append(file_name)
+
+        self._longitude = longitude
+        self._files = {}
+        self._sources = None
+
+    @property
+    def file_names(self):
+        """ Paths of observation files """
+        return list(self._file_names)
+
+    @property
+    def sources(self):
+        """ Dictionary of source names to ObservationSource objects """
+        if self._sources is None:
+            parts = {}
+            for index in range(len(self._file_names)):
+                group = self.get_file(index).get('observation_data', {})
+                for key in group:
+                    if key.endswith("_timestamps"):
+                        parts.setdefault(key[:-len("_timestamps")], []).append(index)
+            self._sources = {name: ObservationSource(self, name, indices) for name, indices in sorted(parts.items())}
+        return self._sources
+
+    def __getitem__(self, name):
+        """ Get a source by name """
+        return self.sources[name]
+
+    def get_file(self, index):
+        """ Get an open file, opening it on first use
+        :param index: File index """
+        if index not in self._files:
+            self._files[index] = h5py.File(self._file_names[index], 'r', swmr=True)
+        return self._files[index]
+
+    def get_sidereal_times(self, timestamps):
+        """ Compute LST (degrees) for timestamps, for sources without an LST dataset """
+        if self._longitude is None:
+            raise ValueError("Source has no LST dataset and no longitude was specified to compute it")
+        return utils.get_sidereal_times(timestamps, self._longitude)
+
+    def refresh(self):
+        """ Discard cached sources, timestamps and LST, e.g. after files being written have grown """
+        for observation_file in self._files.values():
+            observation_file.close()
+        self._files = {}
+        self._sources = None
+
+    def close(self):
+        """ Close all files """
+        self.refresh()
+
+
+class ObservationSource(object):
+    """ A source in a set of observation files. Its timestamps and LST are loaded on first use, spectra and other
+    datasets are only read through selections """
+
+    def __init__(self, reader, name, file_indices):
+        """ Class constructor
+        :param reader: ObservationReader of the files
+        :param name: Source name
+        :param file_indices: Indices of the files which contain the source """
+
+        self.name = name
+        self._reader = reader
+        self._file_indices = file_indices
+        self._timestamps = None
+        self._lst = None
+
+        # First row of each file in the concatenated rows of the source
+        self._offsets = None
+
+    def _load_timestamps(self):
+        """ Read and concatenate the timestamps of all files """
+        timestamps = []
+        for index in self._file_indices:
+            dataset = self._reader.get_file(index)["observation_data/{}_timestamps".format(self.name)]
+            timestamps.append(dataset[:get_nof_rows(dataset)])
+        self._offsets = np.cumsum([0] + [len(part) for part in timestamps])
+        self._timestamps = np.concatenate(timestamps) if timestamps else np.zeros(0)
+
+    @property
+    def timestamps(self):
+        """ Timestamps of all rows """
+        if self._timestamps is None:
+            self._load_timestamps()
+        return self._timestamps
+
+    @property
+    def lst(self):
+        """ LST (degrees) of all rows, read from the LST dataset or computed from the timestamps """
+        if self._lst is None:
+            path = "observation_data/{}_lst_time".format(self.name)
+            parts = []
+            for file_number, index in enumerate(self._file_indices):
+                start, stop = self.offsets[file_number], self.offsets[file_number + 1]
+                observation_file = self._reader.get_file(index)
+                if path in observation_file:
+                    parts.append(observation_file[path][:stop - start])
+                else:
+                    parts.append(self._reader.get_sidereal_times(self.timestamps[start:stop]))
+            self._lst = np.concatenate(parts) if parts else np.zeros(0)
+        return self._lst
+
+    @property
+    def offsets(self):
+        """ First row of each file, and total number of rows """
+        if self._offsets is None:
+            self._load_timestamps()
+        return self._offsets
+
+    @property
+    def nof_rows(self):
+        """ Number of rows (spectra) of the source """
+        return int(self.offsets[-1])
+
+    def get_dataset(self, dataset, file_number):
+        """ Get an h5py dataset of the source
+        :param dataset: Dataset name, e.g. spectra
+        :param file_number: Index of file in the files which contain the source """
+        observation_file = self._reader.get_file(self._file_indices[file_number])
+        return observation_file["observation_data/{}_{}".format(self.name, dataset)]
+
+    def select(self, time_range=None, lst_range=None, channels=None, signal=None):
+        """ Select rows in a time and LST range, and a range of channels. Ranges are found by binary search on
+        the timestamps and on the unwrapped LST, falling back to a scan if timestamps are not in order
+        :param time_range: (start, end) UNIX times, inclusive, None for all times
+        :param lst_range: (start, end) LST in degrees, inclusive, wrapping around 360 if start is after end.
+                          None for all LSTs
+        :param channels: (start, stop) frequency channel range or slice, None for all channels
+        :param signal: Signal of (signal, time, channel) datasets, None for all signals
+        :return: ObservationSelection """
+
+        timestamps = self.timestamps
+        runs = [(0, len(timestamps))]
+        ordered = np.all(np.diff(timestamps) >= 0)
+
+        if time_range is not None:
+            if ordered:
+                runs = [(int(np.searchsorted(timestamps, time_range[0], 'left')),
+                         int(np.searchsorted(timestamps, time_range[1], 'right')))]
+            else:
+                runs = _mask_runs((timestamps >= time_range[0]) & (timestamps <= time_range[1]))
+
+        if lst_range is not None and len(timestamps):
+            lst = self.lst
+            start, end = lst_range
+            if end < start:
+                end += 360.0
+
+            if ordered:
+                # LST increases with time once unwrapped, the range is searched once per sidereal day
+                unwrapped = np.degrees(np.unwrap(np.radians(lst)))
+                lst_runs = []
+                for turn in range(int(np.floor((unwrapped[0] - end) / 360.0)),
+                                  int(np.ceil((unwrapped[-1] - start) / 360.0)) + 1):
+                    first = int(np.searchsorted(unwrapped, start + 360.0 * turn, 'left'))
+                    last = int(np.searchsorted(unwrapped, end + 360.0 * turn, 'right'))
+                    if first < last:
+                        lst_runs.append((first, last))
+            else:
+                lst = np.mod(lst, 360.0)
+                if end <= 360.0:
+                    mask = (lst >= start) & (lst <= end)
+                else:
+                    mask = (lst >= start) | (lst <= end - 360.0)
+                lst_runs = _mask_runs(mask)
+            runs = _intersect_runs(runs, lst_runs)
+
+        if channels is not None and not isinstance(channels, slice):
+            channels = slice(channels[0], channels[1])
+
+        # Merge adjacent ranges, e.g. LST ranges covering consecutive sidereal days
+        merged = []
+        for start, stop in runs:
+            if start >= stop:
+                continue
+            if merged and merged[-1][1] == start:
+                merged[-1] = (merged[-1][0], stop)
+            else:
+                merged.append((start, stop))
+
+        return ObservationSelection(self, merged, channels, signal)
+
+
+class ObservationSelection(object):
+    """ Rows and channels of a source selected by ObservationSource.select. Data is streamed in blocks of whole
+    dataset chunks, so that memory use is bounded regardless of the size of the selection """
+
+    def __init__(self, source, runs, channels=None, signal=None):
+        """ Class constructor
+        :param source: ObservationSource
+        :param runs: Sorted list of (start, stop) ranges of selected rows
+        :param channels: Slice of selected channels, None for all channels
+        :param signal: Selected signal of (signal, time, channel) datasets, None for all signals """
+        self.source = source
+        self.runs = runs
+        self.channels = channels
+        self.signal = signal
+
+    @property
+    def nof_rows(self):
+        """ Number of selected rows """
+        return int(sum(stop - start for start, stop in self.runs))
+
+    @property
+    def timestamps(self):
+        """ Timestamps of selected rows """
+        return np.concatenate([self.source.timestamps[start:stop] for start, stop in self.runs] or [np.zeros(0)])
+
+    @property
+    def lst(self):
+        """ LST (degrees) of selected rows """
+        return np.concatenate([self.source.lst[start:stop] for start, stop in self.runs] or [np.zeros(0)])
+
+    def iter_blocks(self, dataset="spectra", max_block_size=64 * 1024 * 1024):
+        """ Read the selected rows of a dataset in blocks. Block boundaries are aligned to dataset chunks along the
+        time axis, and blocks never span files
+        :param dataset: Dataset name, e.g. spectra or receiver_statistics
+        :param max_block_size: Maximum size of a block in bytes (at least one chunk is read per block)
+        :return: Generator of (timestamps, data) blocks. Data keeps the dataset layout, with time along axis 1
+                 for (signal, time, channel) spectra and along axis 0 otherwise. If a signal is selected, only that
+                 signal is read and (signal, time, channel) spectra are returned as (time, channel) """
+
+        offsets = self.source.offsets
+        for start, stop in self.runs:
+            # Split runs at file boundaries
+            for file_number in range(len(offsets) - 1):
+                file_start, file_stop = max(start, offsets[file_number]), min(stop, offsets[file_number + 1])
+                if file_start >= file_stop:
+                    continue
+
+                h5_dataset = self.source.get_dataset(dataset, file_number)
+                axis = 1 if h5_dataset.ndim == 3 else 0
+                signal = self.signal if h5_dataset.ndim == 3 else None
+
+                # Whole chunks per block, within the size limit
+                chunk_rows = h5_dataset.chunks[axis] if h5_dataset.chunks is not None else 1
+                row_size = h5_dataset.dtype.itemsize * int(np.prod(h5_dataset.shape[:axis] +
+                                                                    h5_dataset.shape[axis + 1:]))
+                if signal is not None:
+                    row_size //= h5_dataset.shape[0]
+                block_rows = chunk_rows * max(1, max_block_size // max(1, row_size * chunk_rows))
+
+                row = file_start - offsets[file_number]
+                end = file_stop - offsets[file_number]
+                while row < end:
+                    block_end = min(end, (row // block_rows + 1) * block_rows)
+                    index = [slice(None)] * h5_dataset.ndim
+                    index[axis] = slice(row, block_end)
+                    if self.channels is not None and h5_dataset.ndim > 1:
+                        index[-1] = self.channels
+                    if signal is not None:
+                        index[0] = signal
+                    first = offsets[file_number] + row
+                    yield (self.source.timestamps[first:first + block_end - row], h5_dataset[tuple(index)])
+                    row = block_end
+
+    def read(self, dataset="spectra"):
+        """ Read all selected rows of a dataset into memory
+        :param dataset: Dataset name, e.g. spectra
+        :return: Timestamps and data, concatenated along the time axis """
+        blocks = list(self.iter_blocks(dataset))
+        if not blocks:
+            return np.zeros(0), None
+        axis = 1 if blocks[0][1].ndim == 3 else 0
+        return np.concatenate([block[0] for block in blocks]), np.concatenate([block[1] for block in blocks],
+                                                                              axis=axis)
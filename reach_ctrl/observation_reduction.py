@@ -0,0 +1,343 @@
+from builtins import object
+import multiprocessing
+import numpy as np
+import logging
+import json
+import glob
+import time
+import h5py
+import os
+
+from reach_ctrl.observation_reader import ObservationReader
+
+
+class LSTAccumulator(object):
+    """ Per-LST-bin partial sums of the spectra of each source: sum, sum of squares and number of values per
+    channel. Memory use is O(bins x channels) per source, irrespective of the number of spectra added, and
+    accumulators of different files or nights can be merged by adding them """
+
+    def __init__(self, nof_bins):
+        """ Class constructor
+        :param nof_bins: Number of LST bins over 360 degrees """
+        self.nof_bins = nof_bins
+        self.sources = {}
+
+        # Reduced files, with their modification time and size
+        self.files = {}
+
+    @property
+    def lst_bins(self):
+        """ LST (degrees) of the bin centres """
+        return (np.arange(self.nof_bins) + 0.5) * 360.0 / self.nof_bins
+
+    def add(self, name, lst, data):
+        """ Add spectra of a source to their LST bins
+        :param name: Source name
+        :param lst: LST (degrees) of each spectrum
+        :param data: Spectra, with one spectrum per row along axis 0 """
+
+        if len(lst) == 0:
+            return
+
+        if name not in self.sources:
+            shape = (self.nof_bins,) + data.shape[1:]
+            self.sources[name] = {'sum': np.zeros(shape), 'sum_squares': np.zeros(shape),
+                                  'count': np.zeros(shape, dtype=np.int64)}
+        source = self.sources[name]
+        if source['sum'].shape[1:] != data.shape[1:]:
+            raise ValueError("Spectra of {} have shape {}, expected {}".format(name, data.shape[1:],
+                                                                             source['sum'].shape[1:]))
+
+        # Sort spectra by bin and sum each run of equal bins
+        bins = np.floor(np.mod(lst, 360.0) * self.nof_bins / 360.0).astype(np.int64) % self.nof_bins
+        order = np.argsort(bins, kind='stable')
+        bins = bins[order]
+        starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+        bins = bins[starts]
+
+        values = data[order].astype(np.float64)
+        finite = np.isfinite(values)
+        values[~finite] = 0
+
+        source['sum'][bins] += np.add.reduceat(values, starts, axis=0)
+        source['sum_squares'][bins] += np.add.reduceat(values * values, starts, axis=0)
+        source['count'][bins] += np.add.reduceat(finite, starts, axis=0, dtype=np.int64)
+
+    def merge(self, other):
+        """ Add the partial sums of another accumulator to this one
+        :param other: LSTAccumulator with the same number of bins
+        :return: This accumulator """
+
+        if other.nof_bins != self.nof_bins:
+            raise ValueError("Cannot merge accumulators with {} and {} LST bins".format(self.nof_bins,
+                                                                                      other.nof_bins))
+
+        for name, partial in other.sources.items():
+            if name not in self.sources:
+                self.sources[name] = partial
+                continue
+            source = self.sources[name]
+            if source['sum'].shape != partial['sum'].shape:
+                raise ValueError("Cannot merge spectra of {} with shapes {} and {}".format(
+                    name, source['sum'].shape, partial['sum'].shape))
+            for key in source:
+                source[key] += partial[key]
+
+        self.files.update(other.files)
+        return self
+
+    def mean(self, name):
+        """ Mean spectrum of each LST bin of a source, NaN for empty bins """
+        source = self.sources[name]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return source['sum'] / source['count']
+
+    def std(self, name):
+        """ Standard deviation of the spectra of each LST bin of a source, NaN for empty bins """
+        source = self.sources[name]
+        mean = self.mean(name)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.sqrt(np.maximum(source['sum_squares'] / source['count'] - mean * mean, 0))
+
+    def save(self, file_name):
+        """ Write the accumulator to an HDF5 file, replacing it atomically. Each source is stored as a group with
+        sum, sum_squares and count datasets, and mean and std for convenience
+        :param file_name: Path of accumulator file """
+
+        temporary_file = "{}.tmp".format(file_name)
+        with h5py.File(temporary_file, 'w') as f:
+            f.attrs['nof_bins'] = self.nof_bins
+            f.attrs['files'] = json.dumps(self.files)
+            f.attrs['update_time'] = time.time()
+            f.create_dataset('lst_bins', data=self.lst_bins)
+
+            for name, source in sorted(self.sources.items()):
+                group = f.create_group(name)
+                for key, data in source.items():
+                    group.create_dataset(key, data=data, compression='gzip', shuffle=True)
+                group.create_dataset('mean', data=self.mean(name), compression='gzip', shuffle=True)
+                group.create_dataset('std', data=self.std(name), compression='gzip', shuffle=True)
+
+        os.replace(temporary_file, file_name)
+
+    @staticmethod
+    def load(file_name):
+        """ Read an accumulator written with save
+        :param file_name: Path of accumulator file
+        :return: LSTAccumulator """
+
+        with h5py.File(file_name, 'r') as f:
+            accumulator = LSTAccumulator(int(f.attrs['nof_bins']))
+            accumulator.files = json.loads(f.attrs['files'])
+            for name in f:
+                if isinstance(f[name], h5py.Group):
+                    accumulator.sources[name] = {key: f[name][key][:] for key in ('sum', 'sum_squares', 'count')}
+        return accumulator
+
+
+def reduce_file(file_name, nof_bins, longitude=None, sources=None, channels=None, signal=None,
+                max_block_size=64 * 1024 * 1024):
+    """ Reduce the spectra of an observation file into LST bins. The file is streamed in blocks of whole chunks,
+    so memory use does not depend on the size of the file
+    :param file_name: Path of observation file
+    :param nof_bins: Number of LST bins over 360 degrees
+    :param longitude: Site longitude in degrees, for sources without an LST dataset
+    :param sources: Names of sources to reduce, None for all sources
+    :param channels: (start, stop) frequency channel range, None for all channels
+    :param signal: Signal to reduce for sources with (signal, time, channel) spectra, None for all signals. Other
+                   signals are not read from file
+    :param max_block_size: Maximum size of a block read from the file in bytes
+    :return: LSTAccumulator, or None if the file cannot be reduced """
+
+    accumulator = LSTAccumulator(nof_bins)
+    stat = os.stat(file_name)
+    reader = ObservationReader(file_name, longitude)
+    try:
+        # Virtual dataset archives map rows of other files, which are reduced themselves
+        if 'archive_index' in reader.get_file(0).attrs:
+            return None
+
+        for name, source in reader.sources.items():
+            if sources is not None and name not in sources:
+                continue
+            if "observation_data/{}_spectra".format(name) not in reader.get_file(0):
+                continue
+
+            selection = source.select(channels=channels, signal=signal)
+            lst = selection.lst
+            row = 0
+            for timestamps, data in selection.iter_blocks("spectra", max_block_size):
+                # Spectra are stored as (signal, time, channel) or (time, channel), and are read as (time, channel)
+                # if a signal is selected
+                if data.ndim == 3:
+                    data = np.moveaxis(data, 1, 0)
+                accumulator.add(name, lst[row:row + len(timestamps)], data)
+                row += len(timestamps)
+    except Exception as e:
+        logging.error("Cannot reduce {}: {}".format(file_name, e))
+        return None
+    finally:
+        reader.close()
+
+    accumulator.files[os.path.abspath(file_name)] = {'mtime': stat.st_mtime, 'size': stat.st_size}
+    return accumulator
+
+
+def _reduce_file(arguments):
+    """ Pool wrapper of reduce_file """
+    return reduce_file(*arguments)
+
+
+def reduce_files(file_names, nof_bins, longitude=None, sources=None, channels=None, nof_processes=None,
+                 signal=None):
+    """ Reduce observation files into LST bins, one file per worker process. Partial sums are merged with a
+    tree reduction as they arrive, so that at most O(log(files)) partial accumulators are held at any time
+    :param file_names: Paths of observation files
+    :param nof_bins: Number of LST bins over 360 degrees
+    :param longitude: Site longitude in degrees, for sources without an LST dataset
+    :param sources: Names of sources to reduce, None for all sources
+    :param channels: (start, stop) frequency channel range, None for all channels
+    :param nof_processes: Number of worker processes, defaults to the number of cores
+    :param signal: Signal to reduce for sources with (signal, time, channel) spectra, None for all signals
+    :return: LSTAccumulator """
+
+    arguments = [(file_name, nof_bins, longitude, sources, channels, signal) for file_name in file_names]
+
+    if nof_processes is None:
+        nof_processes = multiprocessing.cpu_count()
+    nof_processes = max(1, min(nof_processes, len(arguments)))
+
+    pool = None
+    if nof_processes > 1:
+        pool = multiprocessing.Pool(nof_processes)
+        partials = pool.imap_unordered(_reduce_file, arguments)
+    else:
+        partials = map(_reduce_file, arguments)
+
+    # Tree reduction: a partial covering 2^n files is merged with the next one covering as many
+    levels = []
+    try:
+        for partial in partials:
+            if partial is None:
+                continue
+            level = 0
+            while levels and levels[-1][0] == level:
+                partial = levels.pop()[1].merge(partial)
+                level += 1
+            levels.append((level, partial))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    accumulator = LSTAccumulator(nof_bins)
+    while levels:
+        accumulator = levels.pop()[1].merge(accumulator)
+    return accumulator
+
+
+class LSTReduction(object):
+    """ Incrementally maintained LST-binned average of the observation files in a directory. The accumulator file
+    records which files it contains, so that when new nights arrive only the new files are reduced and added """
+
+    def __init__(self, accumulator_file, nof_bins=96, longitude=None, sources=None, channels=None,
+                 nof_processes=None, signal=None):
+        """ Class constructor
+        :param accumulator_file: Path of accumulator file
+        :param nof_bins: Number of LST bins over 360 degrees
+        :param longitude: Site longitude in degrees, for sources without an LST dataset
+        :param sources: Names of sources to reduce, None for all sources
+        :param channels: (start, stop) frequency channel range, None for all channels
+        :param nof_processes: Number of worker processes, defaults to the number of cores
+        :param signal: Signal to reduce for sources with (signal, time, channel) spectra, None for all signals """
+        self._accumulator_file = accumulator_file
+        self._nof_bins = nof_bins
+        self._longitude = longitude
+        self._sources = sources
+        self._channels = channels
+        self._nof_processes = nof_processes
+        self._signal = signal
+
+    def update(self, directory, pattern="*.hdf5", min_age=0, rebuild=False):
+        """ Reduce files which are not in the accumulator yet, and add them to it. Reduced files which have changed
+        since are reported, since their old partial sums cannot be removed, and are included with a rebuild
+        :param directory: Directory of observation files
+        :param pattern: File name pattern
+        :param min_age: Skip files modified less than this number of seconds ago, e.g. still being written
+        :param rebuild: Discard the accumulator and reduce all files
+        :return: The updated LSTAccumulator """
+
+        accumulator = LSTAccumulator(self._nof_bins)
+        if os.path.exists(self._accumulator_file) and not rebuild:
+            accumulator = LSTAccumulator.load(self._accumulator_file)
+            if accumulator.nof_bins != self._nof_bins:
+                raise ValueError("Accumulator {} has {} LST bins, rebuild it to use {}".format(
+                    self._accumulator_file, accumulator.nof_bins, self._nof_bins))
+
+        new_files = []
+        for file_name in sorted(glob.glob(os.path.join(directory, pattern))):
+            path = os.path.abspath(file_name)
+            if path == os.path.abspath(self._accumulator_file):
+                continue
+
+            stat = os.stat(path)
+            if time.time() - stat.st_mtime < min_age:
+                continue
+
+            entry = accumulator.files.get(path)
+            if entry is None:
+                new_files.append(path)
+            elif entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+                logging.warning("{} has changed since it was reduced, rebuild the accumulator to include the "
+                                "changes".format(path))
+
+        if not new_files:
+            return accumulator
+
+        logging.info("Reducing {} files into {} LST bins".format(len(new_files), self._nof_bins))
+        accumulator.merge(reduce_files(new_files, self._nof_bins, self._longitude, self._sources, self._channels,
+                                       self._nof_processes, self._signal))
+        accumulator.save(self._accumulator_file)
+        logging.info("Updated {} ({} files)".format(self._accumulator_file, len(accumulator.files)))
+        return accumulator
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-d", "--directory", dest="directory", default=None, help="Directory of observation files")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="Accumulator file (default: lst_average.hdf5 in the observation directory)")
+    parser.add_option("-p", "--pattern", dest="pattern", default="*.hdf5",
+                      help="Observation file name pattern (default: *.hdf5)")
+    parser.add_option("-b", "--bins", dest="bins", default=96, type=int,
+                      help="Number of LST bins over 24h (default: 96)")
+    parser.add_option("-s", "--source", dest="source", default=None,
+                      help="Comma separated source names, e.g. obs_ant,obs_load (default: all)")
+    parser.add_option("--channels", dest="channels", default=None,
+                      help="Frequency channel range, e.g. 1000,2000 (default: all)")
+    parser.add_option("--signal", dest="signal", default=None, type=int,
+                      help="Signal to reduce for (signal, time, channel) spectra (default: all)")
+    parser.add_option("--longitude", dest="longitude", default=None, type=float,
+                      help="Site longitude in degrees, for files without LST datasets")
+    parser.add_option("-n", "--processes", dest="processes", default=None, type=int,
+                      help="Number of worker processes (default: number of cores)")
+    parser.add_option("--min-age", dest="min_age", default=0, type=float,
+                      help="Skip files modified less than this number of seconds ago (default: 0)")
+    parser.add_option("--rebuild", dest="rebuild", action="store_true", default=False,
+                      help="Discard the accumulator and reduce all files")
+    (config, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if config.directory is None:
+        parser.error("An observation directory must be specified")
+
+    sources = config.source.split(',') if config.source is not None else None
+    channels = tuple(int(channel) for channel in config.channels.split(',')) if config.channels else None
+
+    # The accumulator is excluded from the files to reduce, but is written to the observation directory
+    reduction = LSTReduction(config.output or os.path.join(config.directory, "lst_average.hdf5"), config.bins,
+                             config.longitude, sources, channels, config.processes, config.signal)
+    reduction.update(config.directory, config.pattern, config.min_age, config.rebuild)
@@ -0,0 +1,942 @@
+from builtins import object
+import numpy as np
+import multiprocessing
+import threading
+import tempfile
+import fnmatch
+import logging
+import queue
+import time
+import zlib
+import h5py
+import yaml
+import os
+
+from reach_ctrl.observation_catalog import ObservationCatalog
+from reach_ctrl import utils
+
+
+def truncate_mantissa(data, mantissa_bits):
+    """ Round floating point values to a number of mantissa bits, in place. The zeroed low bits make the data
+    much more compressible, at a bounded relative error of 2^-(mantissa_bits + 1)
+    :param data: Floating point array
+    :param mantissa_bits: Number of explicit mantissa bits to keep """
+
+    nof_dropped = np.finfo(data.dtype).nmant - mantissa_bits
+    if nof_dropped <= 0:
+        return data
+
+    # Round to nearest by adding half of the dropped range before masking. Carries into the exponent
+    # are correct rounding. Non-finite values are left untouched
+    int_type = np.uint64 if data.dtype.itemsize == 8 else np.uint32
+    bits = data.view(int_type)
+    rounded = (bits + int_type(1 << (nof_dropped - 1))) & ~int_type((1 << nof_dropped) - 1)
+    np.copyto(bits, rounded, where=np.isfinite(data))
+    return data
+
+
+def get_dataset_filter(dataset_filters, path):
+    """ Get the filter settings of a dataset
+    :param dataset_filters: Dictionary of dataset name patterns (e.g. *_spectra) to filter settings
+    :param path: Dataset path, matched by name
+    :return: Filter settings of the first matching pattern, or an empty dictionary """
+
+    name = path.split('/')[-1]
+    for pattern, settings in (dataset_filters or {}).items():
+        if fnmatch.fnmatch(name, pattern):
+            return settings or {}
+    return {}
+
+
+def _compress_chunk(chunk, shuffle, level):
+    """ Compress a chunk as the HDF5 shuffle and deflate filters would. Runs in a compression process
+    :param chunk: Chunk data, in chunk shape
+    :param shuffle: Apply byte shuffle before compression
+    :param level: Deflate compression level
+    :return: Compressed chunk """
+
+    data = np.ascontiguousarray(chunk).view(np.uint8)
+    if shuffle:
+        data = data.reshape(-1, chunk.dtype.itemsize).T
+    return zlib.compress(np.ascontiguousarray(data).tobytes(), level)
+
+
+class _ChunkCompressor(object):
+    """ Compresses full chunks in a process pool and writes them with direct chunk writes, bypassing the
+    HDF5 filter pipeline. Only deflate (gzip) with optional shuffle is supported, since the result must be
+    identical to what the HDF5 filters produce so that files remain readable by stock h5py """
+
+    def __init__(self, nof_processes):
+        """ Class constructor
+        :param nof_processes: Number of compression processes """
+        self._pool = multiprocessing.Pool(nof_processes)
+        self._pending = []
+
+        # Limit the number of chunks in flight, so that memory use is bounded when compression falls behind
+        self._max_pending = 2 * nof_processes
+
+    @staticmethod
+    def supports(dataset):
+        """ Check whether chunks of a dataset can be compressed by the pool """
+        return dataset.compression == 'gzip' and not dataset.fletcher32 and dataset.scaleoffset is None
+
+    def submit(self, dataset, offsets, chunk):
+        """ Compress a chunk in the pool, it is written when complete
+        :param dataset: HDF5 dataset
+        :param offsets: Offsets of chunk in dataset
+        :param chunk: Chunk data """
+        # Wait for the oldest chunk if too many are in flight
+        if len(self._pending) >= self._max_pending:
+            oldest_dataset, oldest_offsets, oldest_result = self._pending.pop(0)
+            oldest_dataset.id.write_direct_chunk(oldest_offsets, oldest_result.get())
+
+        result = self._pool.apply_async(_compress_chunk, (chunk, dataset.shuffle, dataset.compression_opts))
+        self._pending.append((dataset, offsets, result))
+
+    def write_completed(self, wait=False):
+        """ Write compressed chunks
+        :param wait: Wait for all pending chunks, otherwise only write chunks which are ready """
+        pending = []
+        for dataset, offsets, result in self._pending:
+            if wait or result.ready():
+                dataset.id.write_direct_chunk(offsets, result.get())
+            else:
+                pending.append((dataset, offsets, result))
+        self._pending = pending
+
+    def close(self):
+        """ Write pending chunks and stop the process pool """
+        self.write_completed(wait=True)
+        self._pool.close()
+        self._pool.join()
+
+
+def rebin_channels(data, factor):
+    """ Average groups of frequency channels (last axis). A last partial group is averaged over the channels it has
+    :param data: Array with channels along the last axis
+    :param factor: Number of channels per group
+    :return: Rebinned array (float32) """
+
+    nof_channels = data.shape[-1]
+    starts = np.arange(0, nof_channels, factor)
+    counts = np.minimum(factor, nof_channels - starts)
+    return (np.add.reduceat(data, starts, axis=-1, dtype=np.float64) / counts).astype(np.float32)
+
+
+class _PreviewPyramid(object):
+    """ Downsampled versions of a dataset, updated incrementally as rows are appended. Each level averages groups
+    of frequency channels and groups of rows (time) """
+
+    def __init__(self, path, levels):
+        """ Class constructor
+        :param path: Path of full resolution dataset
+        :param levels: List of (frequency factor, time factor) pairs """
+        self.levels = [(int(frequency_factor), int(time_factor)) for frequency_factor, time_factor in levels]
+        self.paths = [get_preview_path(path, frequency_factor, time_factor)
+                      for frequency_factor, time_factor in self.levels]
+
+        # Sum and number of rows being averaged per level
+        self._sums = [None] * len(self.levels)
+        self._counts = [0] * len(self.levels)
+
+    def add(self, row):
+        """ Add a full resolution row
+        :return: List of (path, row) of completed preview rows """
+        completed = []
+        for i, (frequency_factor, time_factor) in enumerate(self.levels):
+            rebinned = rebin_channels(row, frequency_factor)
+            if self._counts[i] == 0:
+                self._sums[i] = rebinned
+            else:
+                self._sums[i] += rebinned
+            self._counts[i] += 1
+
+            if self._counts[i] == time_factor:
+                completed.append((self.paths[i], self._sums[i] / time_factor))
+                self._counts[i] = 0
+        return completed
+
+    def finish(self):
+        """ Get partially averaged rows, at the end of a file
+        :return: List of (path, row) """
+        completed = [(self.paths[i], self._sums[i] / self._counts[i])
+                     for i in range(len(self.levels)) if self._counts[i] > 0]
+        self._counts = [0] * len(self.levels)
+        return completed
+
+
+def get_preview_path(path, frequency_factor, time_factor):
+    """ Get the path of a preview dataset, e.g. observation_preview/obs_ant_spectra_f16_t4 for the
+    observation_data/obs_ant_spectra dataset averaged over 16 channels and 4 spectra """
+    return "observation_preview/{}_f{}_t{}".format(path.split('/')[-1], frequency_factor, time_factor)
+
+
+class _BufferedDataset(object):
+    """ Extendable dataset with an in-memory buffer of one chunk of rows. Full buffers are written as one
+    chunk-aligned slab, and the dataset is grown in large steps rather than by one row per append. Since the
+    dataset can be larger than the number of rows written until it is trimmed, that number is kept in its
+    nof_rows attribute (see observation_reader.get_nof_rows) """
+
+    def __init__(self, dataset, axis, nof_rows, rows_per_flush, growth_factor, mantissa_bits=None,
+                 compressor=None):
+        """ Class constructor
+        :param dataset: HDF5 dataset
+        :param axis: Append axis
+        :param nof_rows: Number of rows already in the dataset
+        :param rows_per_flush: Number of rows buffered before a slab write
+        :param growth_factor: Factor by which the dataset capacity is grown when full
+        :param mantissa_bits: Number of mantissa bits kept for floating point data, None to keep all
+        :param compressor: Chunk compressor used for full chunks, None to use the HDF5 filter pipeline """
+
+        self.dataset = dataset
+        self.axis = axis
+        self._growth_factor = growth_factor
+        self._mantissa_bits = mantissa_bits if dataset.dtype.kind == 'f' else None
+
+        # Full chunks can only be written directly if they are aligned to the dataset chunks
+        aligned = dataset.chunks is not None and dataset.chunks[axis] == rows_per_flush and \
+            nof_rows % rows_per_flush == 0
+        self._compressor = compressor if aligned and compressor is not None and \
+            _ChunkCompressor.supports(dataset) else None
+
+        self.row_shape = dataset.shape[:axis] + dataset.shape[axis + 1:]
+        self._buffer = np.zeros((rows_per_flush,) + self.row_shape, dtype=dataset.dtype)
+        self._nof_buffered = 0
+
+        # Row at which the buffer starts. Partially filled buffers are written on flush, but are kept
+        # until full so that the buffer stays aligned to chunks
+        self._buffer_start = nof_rows
+
+    @property
+    def nof_rows(self):
+        """ Number of rows in the dataset, including buffered ones """
+        return self._buffer_start + self._nof_buffered
+
+    def append(self, row):
+        """ Buffer a row, writing the buffer to file when full """
+        self._buffer[self._nof_buffered] = row
+        self._nof_buffered += 1
+        if self._nof_buffered == self._buffer.shape[0]:
+            self.write()
+            self._buffer_start += self._nof_buffered
+            self._nof_buffered = 0
+
+    def write(self):
+        """ Write buffered rows to the dataset, growing it if required """
+        if self._nof_buffered == 0:
+            return
+
+        end = self.nof_rows
+        capacity = self.dataset.shape[self.axis]
+        if end > capacity:
+            self._resize(max(end, int(capacity * self._growth_factor)))
+
+        rows = self._buffer[:self._nof_buffered]
+        if self._mantissa_bits is not None:
+            truncate_mantissa(rows, self._mantissa_bits)
+
+        # Full chunks are compressed in the compression processes
+        if self._compressor is not None and self._nof_buffered == self._buffer.shape[0]:
+            offsets = [0] * self.dataset.ndim
+            offsets[self.axis] = self._buffer_start
+            self._compressor.submit(self.dataset, tuple(offsets), np.moveaxis(rows, 0, self.axis).copy())
+            return
+
+        index = [slice(None)] * self.dataset.ndim
+        index[self.axis] = slice(self._buffer_start, end)
+        self.dataset[tuple(index)] = np.moveaxis(rows, 0, self.axis)
+
+        # Earlier rows might still be in the compression processes, in which case the row count is only updated
+        # once they are written
+        if self._compressor is None:
+            self.write_row_count()
+
+    def write_row_count(self):
+        """ Store the number of rows written in the nof_rows attribute. All buffered rows and chunks submitted
+        for compression must have been written """
+        nof_rows = self.dataset.attrs.get('nof_rows')
+
+        # Attributes cannot be added in SWMR mode, datasets of older files might not have one
+        if nof_rows is None and self.dataset.file.swmr_mode:
+            return
+        if nof_rows != self.nof_rows:
+            self.dataset.attrs['nof_rows'] = np.int64(self.nof_rows)
+
+    def trim(self):
+        """ Write buffered rows and shrink the dataset to the number of rows written """
+        self.write()
+        if self.dataset.shape[self.axis] != self.nof_rows:
+            self._resize(self.nof_rows)
+        self.write_row_count()
+
+    def _resize(self, nof_rows):
+        """ Resize dataset along the append axis """
+        shape = list(self.dataset.shape)
+        shape[self.axis] = nof_rows
+        self.dataset.resize(tuple(shape))
+
+
+class ObservationWriter(object):
+    """ Owns an HDF5 observation file for the lifetime of an observation. Producers append rows through a bounded
+    queue, which blocks them when full, and a single writer thread buffers, compresses and writes the rows. Files
+    can be read while they are written (SWMR), split into segments and given preview levels """
+
+    def __init__(self, file_name, rows_per_flush=16, expected_rows=None, growth_factor=2, max_queue_size=64,
+                 dataset_filters=None, compression_processes=0, swmr=False, flush_interval=None,
+                 max_file_size=None, rollover_interval=None, time_datasets='*_timestamps', longitude=None,
+                 catalog_file=None, preview_levels=None, preview_datasets='*_spectra',
+                 chunk_cache_size=32 * 1024 * 1024):
+        """ Class constructor
+        :param file_name: Path of HDF5 file
+        :param rows_per_flush: Number of rows buffered per dataset before a slab write, and chunk length
+        :param expected_rows: Dictionary of dataset names (e.g. obs_ant_spectra) to their planned number of rows,
+                              used as the initial dataset size. Preview levels are sized from their dataset
+        :param growth_factor: Factor by which datasets are grown when full
+        :param max_queue_size: Maximum number of queued operations before producers block
+        :param dataset_filters: Dictionary of dataset name patterns (e.g. *_spectra) to filter settings:
+                                compression (gzip, lzf), compression_level, shuffle, mantissa_bits and
+                                dtype (e.g. float32)
+        :param compression_processes: Number of processes compressing gzip chunks, 0 to compress chunks
+                                      in the HDF5 filter pipeline
+        :param swmr: Create the file so that it can be read while it is written, see start_swmr
+        :param flush_interval: Interval in seconds at which buffered rows are written and the file is flushed,
+                               None to only flush when full buffers are written
+        :param max_file_size: Size in bytes at which a new segment file is started, None for no limit. Chunks held
+                              in the HDF5 chunk cache are not counted, so files can be a few MB larger
+        :param rollover_interval: Interval in seconds at whose wall-clock boundaries a new segment file is started,
+                                  e.g. 3600 for hourly files, None to disable
+        :param time_datasets: Name pattern of datasets with UNIX timestamps, used for segment time ranges
+        :param longitude: Site longitude in degrees, used for segment LST ranges
+        :param catalog_file: SQLite observation catalog (see ObservationCatalog) to which each file or segment is
+                             added when it is closed, None to not index files
+        :param preview_levels: List of (frequency factor, time factor) preview levels, e.g. [(16, 1), (64, 4)],
+                               None for no previews
+        :param preview_datasets: Name pattern of datasets with previews
+        :param chunk_cache_size: Size in bytes of the HDF5 chunk cache of each dataset. It should hold a chunk of
+                                 rows_per_flush rows, otherwise chunks which are partially written on flush are
+                                 read back and decompressed for every flush """
+
+        self._file_name = file_name
+        self._file = None
+        self._datasets = {}
+
+        self._rows_per_flush = rows_per_flush
+        self._expected_rows = expected_rows
+        self._growth_factor = growth_factor
+        self._dataset_filters = dataset_filters
+        self._compression_processes = compression_processes
+        self._compressor = None
+        self._chunk_cache_size = chunk_cache_size
+
+        self._swmr = swmr
+        self._swmr_started = False
+        self._flush_interval = flush_interval
+        self._last_flush_time = 0
+
+        # File segments. Without rollover the single file is written as is, without a manifest
+        self._max_file_size = max_file_size
+        self._rollover_interval = rollover_interval
+        self._time_datasets = time_datasets
+        self._longitude = longitude
+        self._segment_index = 0
+        self._segment_end_time = None
+        self._segment_times = None
+        self._segments = []
+
+        self._catalog_file = catalog_file
+        self._catalog = None
+
+        # Preview pyramids per full resolution dataset
+        self._preview_levels = preview_levels
+        self._preview_datasets = preview_datasets
+        self._previews = {}
+
+        self._base_file_name = file_name
+        self._manifest_file = None
+        if max_file_size or rollover_interval:
+            root, extension = os.path.splitext(file_name)
+            self._manifest_file = "{}_manifest.yaml".format(root)
+            self._file_name = self._get_segment_file_name(0)
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._writer_thread = None
+
+        # Backpressure and write statistics
+        self._statistics_lock = threading.Lock()
+        self._statistics = {'nof_operations': 0, 'nof_blocked': 0, 'blocked_time': 0.0, 'max_queue_depth': 0,
+                            'write_time': 0.0, 'nof_errors': 0}
+        self._last_warning_time = 0
+
+        # First exception raised in the writer thread, re-raised to producers, and whether it has been raised
+        self._error = None
+        self._error_raised = False
+
+    @property
+    def file_name(self):
+        """ Path of HDF5 file, or of the current segment file """
+        return self._file_name
+
+    @property
+    def manifest_file(self):
+        """ Path of the segment manifest, None if files are not rolled over """
+        return self._manifest_file
+
+    def open(self, observation_info=None, mode='w'):
+        """ Open the file and start the writer thread
+        :param observation_info: Attributes of the observation_info group
+        :param mode: h5py file mode. In 'w' mode the observation_info and observation_data groups are created """
+
+        # Compression processes are started before the file is opened, so they do not inherit it
+        if self._compression_processes > 0:
+            self._compressor = _ChunkCompressor(self._compression_processes)
+
+        # Continue an existing list of segments when appending
+        if self._manifest_file is not None and mode != 'w' and os.path.exists(self._manifest_file):
+            with open(self._manifest_file) as f:
+                self._segments = (yaml.safe_load(f) or {}).get('segments', [])
+            self._segment_index = len(self._segments)
+            self._file_name = self._get_segment_file_name(self._segment_index)
+
+        self._open_file(mode, observation_info)
+
+        self._last_flush_time = time.time()
+        self._writer_thread = threading.Thread(target=self._write_loop, name="observation_writer")
+        self._writer_thread.daemon = True
+        self._writer_thread.start()
+
+        logging.info("Opened output file {}".format(self._file_name))
+
+    def append(self, path, data, axis=0, dtype=None):
+        """ Append a row to a dataset, which is created on the first append
+        :param path: Dataset path in file, e.g. observation_data/test_spectra
+        :param data: Row to append, a scalar or array with the dataset shape excluding the append axis
+        :param axis: Axis along which rows are appended
+        :param dtype: Dataset data type, defaults to the type of the first row """
+
+        # Functions submitted to the writer thread append directly
+        if threading.current_thread() is self._writer_thread:
+            self._append(path, np.asarray(data, dtype=dtype), axis)
+            return
+
+        # Copy the row, producers are free to reuse their buffers once append returns
+        self._put('append', (path, np.array(data, dtype=dtype), axis))
+
+    def create_dataset(self, path, row_shape, dtype, axis=0):
+        """ Create an empty dataset, which is otherwise created on the first append. In SWMR mode all datasets
+        must be created before start_swmr is called
+        :param path: Dataset path in file
+        :param row_shape: Shape of a row, excluding the append axis
+        :param dtype: Dataset data type
+        :param axis: Axis along which rows are appended """
+        self._put('create', (path, np.zeros(row_shape, dtype=dtype), axis))
+
+    def start_swmr(self):
+        """ Start SWMR writing, after which readers can open the file while it is written. No datasets can be
+        created from this point on, and attributes should be set before """
+        if not self._swmr:
+            logging.warning("Output file {} was not created for SWMR, cannot start SWMR mode".format(
+                self._file_name))
+            return
+        self._put('swmr', ())
+
+    def set_attributes(self, path, attributes):
+        """ Set attributes of a group or dataset
+        :param path: Group or dataset path in file
+        :param attributes: Dictionary of attributes """
+        self._put('attributes', (path, dict(attributes)))
+
+    def submit(self, function, *args):
+        """ Run a function in the writer thread, after all previously queued operations. Used to move work
+        which only matters for the file (e.g. computing derived values) off the acquisition path.
+        The function may call append. Segment rollover only happens between operations, so rows which belong
+        together should be appended from one function
+        :param function: Function to call
+        :param args: Function arguments """
+        self._put('call', (function, args))
+
+    def flush(self):
+        """ Wait for all queued and buffered rows to be written, and flush the file to disk """
+        done = threading.Event()
+        self._put('flush', (done,))
+        done.wait()
+        self._raise_error()
+
+    def get_statistics(self):
+        """ Get writer statistics: number of queued operations, number of times and total time producers were
+        blocked by a full queue, maximum and current queue depth, time spent writing and number of errors """
+        with self._statistics_lock:
+            statistics = dict(self._statistics)
+        statistics['queue_depth'] = self._queue.qsize()
+        return statistics
+
+    def _raise_error(self):
+        """ Raise the first exception of the writer thread, if any. Data written after the exception may be
+        incomplete, so every subsequent operation raises it """
+        if self._error is not None:
+            self._error_raised = True
+            raise self._error
+
+    def _put(self, operation, args):
+        """ Queue an operation, blocking if the queue is full. Raises the first exception of the writer thread """
+        self._raise_error()
+
+        item = (operation, args)
+        blocked_time = 0
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            start = time.time()
+            self._queue.put(item)
+            blocked_time = time.time() - start
+
+        with self._statistics_lock:
+            self._statistics['nof_operations'] += 1
+            self._statistics['max_queue_depth'] = max(self._statistics['max_queue_depth'], self._queue.qsize())
+            if not blocked_time:
+                return
+
+            self._statistics['nof_blocked'] += 1
+            self._statistics['blocked_time'] += blocked_time
+
+            # Limit warnings to one every few seconds while the writer is behind
+            if time.time() - self._last_warning_time < 10:
+                return
+            self._last_warning_time = time.time()
+            nof_blocked, total_blocked_time = self._statistics['nof_blocked'], self._statistics['blocked_time']
+
+        logging.warning("Output file writer is falling behind, producers blocked {} times for {:.3f}s".format(
+            nof_blocked, total_blocked_time))
+
+    def close(self):
+        """ Drain the queue, write all buffered rows, stop the writer thread and close the file. Raises the first
+        exception of the writer thread if it has not been raised by an earlier operation """
+        if self._writer_thread is None:
+            return
+
+        self._queue.put(('stop', ()))
+        self._writer_thread.join()
+        self._writer_thread = None
+
+        try:
+            self._close_file()
+        finally:
+            self._datasets = {}
+            self._previews = {}
+            if self._compressor is not None:
+                self._compressor.close()
+                self._compressor = None
+            if self._catalog is not None:
+                self._catalog.close()
+                self._catalog = None
+
+        statistics = self.get_statistics()
+        logging.info("Closed output file {} (producers blocked {} times for {:.3f}s, {:.3f}s writing)".format(
+            self._file_name, statistics['nof_blocked'], statistics['blocked_time'], statistics['write_time']))
+
+        if not self._error_raised:
+            self._raise_error()
+
+    def _write_loop(self):
+        """ Writer thread, processes queued operations in order until stopped """
+        while True:
+            # Wake up in time for the next periodic flush, even if nothing is queued
+            timeout = None
+            if self._flush_interval is not None:
+                timeout = max(0, self._last_flush_time + self._flush_interval - time.time())
+
+            try:
+                operation, args = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                operation, args = 'periodic_flush', ()
+            if operation == 'stop':
+                break
+
+            start = time.time()
+            try:
+                # Start a new segment before writing rows which are past the segment boundary
+                if self._rollover_due():
+                    self._rollover()
+
+                if operation == 'append':
+                    self._append(*args)
+                elif operation == 'create':
+                    self._get_dataset(*args)
+                elif operation == 'attributes':
+                    self._set_attributes(*args)
+                elif operation == 'call':
+                    args[0](*args[1])
+                elif operation == 'swmr':
+                    self._file.swmr_mode = True
+                    self._swmr_started = True
+                    logging.info("Started SWMR writing to {}".format(self._file_name))
+                elif operation == 'flush':
+                    try:
+                        self._flush()
+                    finally:
+                        args[0].set()
+
+                if self._flush_interval is not None and time.time() - self._last_flush_time >= self._flush_interval:
+                    self._flush()
+
+                # Write chunks which have been compressed
+                if self._compressor is not None:
+                    self._compressor.write_completed()
+            except Exception as e:
+                logging.error("Failed to write to {}: {}".format(self._file_name, e))
+                with self._statistics_lock:
+                    self._statistics['nof_errors'] += 1
+                    if self._error is None:
+                        self._error = e
+
+            with self._statistics_lock:
+                self._statistics['write_time'] += time.time() - start
+
+    def _get_catalog(self):
+        """ Get the catalog to which closed files are added, opening it on first use. Segments are closed by the
+        writer thread and the last file by close() after the writer thread stops, so the catalog is never used by
+        two threads at once """
+        if self._catalog is None:
+            self._catalog = ObservationCatalog(self._catalog_file, longitude=self._longitude, check_same_thread=False)
+        return self._catalog
+
+    def _get_segment_file_name(self, index):
+        """ Get the path of a segment file """
+        root, extension = os.path.splitext(self._base_file_name)
+        return "{}_{:03d}{}".format(root, index, extension or ".hdf5")
+
+    def _open_file(self, mode, observation_info=None):
+        """ Open the file or current segment file and create its groups
+        :param mode: h5py file mode
+        :param observation_info: Attributes of the observation_info group """
+
+        # SWMR requires the latest file format
+        self._file = h5py.File(self._file_name, mode, libver='latest' if self._swmr else None,
+                               rdcc_nbytes=self._chunk_cache_size)
+        if 'observation_info' not in self._file:
+            self._file.create_group('observation_info')
+        if 'observation_data' not in self._file:
+            self._file.create_group('observation_data')
+        if self._preview_levels and 'observation_preview' not in self._file:
+            self._file.create_group('observation_preview')
+
+        if observation_info is not None:
+            for key, value in observation_info.items():
+                self._file['observation_info'].attrs[key] = value
+
+        if self._manifest_file is None:
+            return
+
+        # Segment boundaries and time range
+        self._file['observation_info'].attrs['segment'] = self._segment_index
+        self._segment_times = None
+        self._segment_end_time = None
+        if self._rollover_interval:
+            self._segment_end_time = (np.floor(time.time() / self._rollover_interval) + 1) * self._rollover_interval
+        self._segments.append({'file': os.path.basename(self._file_name)})
+        self._write_manifest()
+
+    def _close_file(self):
+        """ Write pending and buffered rows, remove unused space at the end of datasets and close the file """
+
+        # Preview rows averaged over fewer spectra than their time factor
+        for path, pyramid in self._previews.items():
+            try:
+                for preview_path, row in pyramid.finish():
+                    self._append(preview_path, row, self._datasets[path].axis)
+            except Exception as e:
+                logging.error("Failed to write previews of {} to {}: {}".format(path, self._file_name, e))
+
+        # Write chunks being compressed, then remaining rows
+        if self._compressor is not None:
+            self._compressor.write_completed(wait=True)
+
+        for path, dataset in self._datasets.items():
+            try:
+                dataset.trim()
+            except Exception as e:
+                logging.error("Failed to write {} to {}: {}".format(path, self._file_name, e))
+
+        if self._manifest_file is not None:
+            self._file.flush()
+            self._segments[-1].update(self._get_segment_info())
+            self._write_manifest()
+
+        self._file.close()
+        self._file = None
+
+        # Index the closed file, so that it can be found by time, LST and source
+        if self._catalog_file is not None:
+            try:
+                self._get_catalog().index_file(self._file_name)
+            except Exception as e:
+                logging.error("Failed to add {} to catalog {}: {}".format(self._file_name, self._catalog_file, e))
+
+    def _rollover_due(self):
+        """ Check whether the current segment has reached its size or time limit """
+        if self._manifest_file is None:
+            return False
+        if self._segment_end_time is not None and time.time() >= self._segment_end_time:
+            return True
+        return bool(self._max_file_size) and self._file.id.get_filesize() >= self._max_file_size
+
+    def _rollover(self):
+        """ Close the current segment and continue in a new one, with the same observation_info attributes,
+        datasets (empty) and dataset attributes """
+
+        observation_info = dict(self._file['observation_info'].attrs)
+        layouts = [(path, dataset.dataset.dtype, dataset.row_shape, dataset.axis, dict(dataset.dataset.attrs))
+                   for path, dataset in self._datasets.items()]
+
+        self._close_file()
+        self._datasets = {}
+        self._previews = {}
+
+        self._segment_index += 1
+        self._file_name = self._get_segment_file_name(self._segment_index)
+        self._open_file('w', observation_info)
+
+        for path, dtype, row_shape, axis, attributes in layouts:
+            dataset = self._get_dataset(path, np.zeros(row_shape, dtype=dtype), axis)
+            for key, value in attributes.items():
+                if key != 'nof_rows':
+                    dataset.dataset.attrs[key] = value
+
+        if self._swmr_started:
+            self._file.swmr_mode = True
+
+        logging.info("Rolled over to output file {}".format(self._file_name))
+
+    def _get_segment_info(self):
+        """ Get the manifest entry of the current segment: time and LST range and file size """
+        info = {'size': int(self._file.id.get_filesize()),
+                'nof_rows': int(max([dataset.nof_rows for dataset in self._datasets.values()] or [0]))}
+        if self._segment_times is not None:
+            info['start_time'], info['end_time'] = [float(t) for t in self._segment_times]
+            if self._longitude is not None:
+                info['start_lst'], info['end_lst'] = [float(lst) for lst in
+                                                      utils.get_sidereal_times(self._segment_times, self._longitude)]
+        return info
+
+    def _write_manifest(self):
+        """ Write the segment manifest. The file is replaced atomically, so readers never see a partial manifest """
+        temporary_file = "{}.tmp".format(self._manifest_file)
+        with open(temporary_file, 'w') as f:
+            yaml.safe_dump({'observation': os.path.basename(self._base_file_name), 'segments': self._segments}, f,
+                           default_flow_style=False, sort_keys=False)
+        os.replace(temporary_file, self._manifest_file)
+
+    def _flush(self):
+        """ Write buffered rows and chunks being compressed, and flush the file so that readers see them """
+        self._last_flush_time = time.time()
+        for dataset in self._datasets.values():
+            dataset.write()
+        if self._compressor is not None:
+            self._compressor.write_completed(wait=True)
+        for dataset in self._datasets.values():
+            dataset.write_row_count()
+        self._file.flush()
+
+    def _get_dataset(self, path, row, axis, expected_rows=None):
+        """ Get a cached dataset, creating the dataset if it does not exist
+        :param path: Dataset path
+        :param row: First row, used to define the dataset shape and type
+        :param axis: Append axis
+        :param expected_rows: Planned number of rows, defaults to the number planned for the dataset name """
+
+        dataset = self._datasets.get(path)
+        if dataset is not None:
+            return dataset
+
+        settings = get_dataset_filter(self._dataset_filters, path)
+        mantissa_bits = settings.get('mantissa_bits')
+
+        # SWMR readers see the whole dataset, so datasets are not over-allocated
+        growth_factor = 1 if self._swmr else self._growth_factor
+
+        if path in self._file:
+            # Rows after the number of rows written are unused space left by a writer which did not close the file
+            h5_dataset = self._file[path]
+            nof_rows = int(min(h5_dataset.attrs.get('nof_rows', h5_dataset.shape[axis]), h5_dataset.shape[axis]))
+            dataset = _BufferedDataset(h5_dataset, axis, nof_rows, self._rows_per_flush, growth_factor,
+                                       mantissa_bits, self._compressor)
+            dataset.write_row_count()
+        elif self._file.swmr_mode:
+            raise ValueError("Dataset {} cannot be created after SWMR writing has started".format(path))
+        else:
+            # Start with the planned number of rows, one chunk of rows_per_flush rows along the append axis
+            if expected_rows is None:
+                expected_rows = (self._expected_rows or {}).get(path.split('/')[-1])
+            nof_rows = expected_rows if expected_rows else self._rows_per_flush
+            if self._swmr:
+                nof_rows = 0
+            shape, maxshape, chunks = list(row.shape), list(row.shape), list(row.shape)
+            shape.insert(axis, nof_rows)
+            maxshape.insert(axis, None)
+            chunks.insert(axis, self._rows_per_flush)
+
+            # Filter pipeline
+            compression = settings.get('compression')
+            h5_dataset = self._file.create_dataset(path, tuple(shape), maxshape=tuple(maxshape),
+                                                   chunks=tuple(chunks),
+                                                   dtype=settings.get('dtype', row.dtype),
+                                                   compression=compression,
+                                                   compression_opts=settings.get('compression_level')
+                                                   if compression == 'gzip' else None,
+                                                   shuffle=settings.get('shuffle', False))
+            if mantissa_bits is not None and h5_dataset.dtype.kind == 'f':
+                h5_dataset.attrs['mantissa_bits'] = mantissa_bits
+
+            # Attributes cannot be added in SWMR mode, so the row count is created with the dataset
+            h5_dataset.attrs['nof_rows'] = np.int64(0)
+
+            chunk_size = h5_dataset.dtype.itemsize * int(np.prod(chunks))
+            if chunk_size > self._chunk_cache_size:
+                logging.warning("Chunks of {} ({} bytes) do not fit in the chunk cache ({} bytes)".format(
+                    path, chunk_size, self._chunk_cache_size))
+
+            dataset = _BufferedDataset(h5_dataset, axis, 0, self._rows_per_flush, growth_factor,
+                                       mantissa_bits, self._compressor)
+            logging.info("Added {} dataset to output file".format(path))
+
+        self._datasets[path] = dataset
+
+        # Preview datasets are created with their dataset, since they cannot be created later in SWMR mode
+        if self._preview_levels and path.startswith('observation_data/') and \
+                fnmatch.fnmatch(path.split('/')[-1], self._preview_datasets):
+            pyramid = _PreviewPyramid(path, self._preview_levels)
+            expected_rows = (self._expected_rows or {}).get(path.split('/')[-1])
+            for (frequency_factor, time_factor), preview_path in zip(pyramid.levels, pyramid.paths):
+                preview_rows = -(-expected_rows // time_factor) if expected_rows else None
+                preview = self._get_dataset(preview_path, rebin_channels(row, frequency_factor), axis,
+                                            preview_rows)
+                preview.dataset.attrs['frequency_factor'] = frequency_factor
+                preview.dataset.attrs['time_factor'] = time_factor
+                preview.dataset.attrs['source'] = path
+            self._previews[path] = pyramid
+
+        return dataset
+
+    def _append(self, path, row, axis):
+        """ Append a row to a dataset """
+        self._get_dataset(path, row, axis).append(row)
+
+        pyramid = self._previews.get(path)
+        if pyramid is not None:
+            for preview_path, preview_row in pyramid.add(row):
+                self._datasets[preview_path].append(preview_row)
+
+        # Keep the time range of the segment
+        if self._manifest_file is not None and fnmatch.fnmatch(path.split('/')[-1], self._time_datasets) and \
+                row.size:
+            first, last = float(np.min(row)), float(np.max(row))
+            if self._segment_times is not None:
+                first, last = min(first, self._segment_times[0]), max(last, self._segment_times[1])
+            self._segment_times = (first, last)
+
+    def _set_attributes(self, path, attributes):
+        """ Set attributes of a group or dataset """
+        node = self._file[path]
+        for key, value in attributes.items():
+            node.attrs[key] = value
+
+
+def benchmark_filters(spectra, settings, directory=None, rows_per_flush=16, axis=0, compression_processes=0):
+    """ Write spectra to a scratch file with the given filter settings and measure the write rate and
+    compression ratio
+    :param spectra: Recorded spectra
+    :param settings: Filter settings, as in ObservationWriter dataset_filters
+    :param directory: Directory of scratch file, defaults to the system temporary directory
+    :param rows_per_flush: Number of rows per slab write
+    :param axis: Time axis of spectra
+    :param compression_processes: Number of processes compressing gzip chunks
+    :return: Dictionary with raw and stored sizes in bytes, compression ratio, write rate in MB/s and rows/s """
+
+    handle, file_name = tempfile.mkstemp(suffix=".hdf5", dir=directory)
+    os.close(handle)
+
+    rows = np.moveaxis(spectra, axis, 0)
+    try:
+        writer = ObservationWriter(file_name, rows_per_flush=rows_per_flush,
+                                   expected_rows={'benchmark': rows.shape[0]}, dataset_filters={'*': settings},
+                                   compression_processes=compression_processes)
+        start = time.time()
+        writer.open()
+        for row in rows:
+            writer.append("observation_data/benchmark", row, axis=axis)
+        writer.close()
+        elapsed = time.time() - start
+
+        with h5py.File(file_name, 'r') as f:
+            stored_size = f['observation_data/benchmark'].id.get_storage_size()
+    finally:
+        os.remove(file_name)
+
+    return {'raw_size': spectra.nbytes,
+            'stored_size': stored_size,
+            'compression_ratio': spectra.nbytes / float(stored_size),
+            'write_rate': spectra.nbytes / elapsed / 1e6,
+            'rows_per_second': rows.shape[0] / elapsed}
+
+
+# Filter settings compared by the benchmark, in addition to any configured ones
+BENCHMARK_SETTINGS = [{},
+                      {'compression': 'lzf', 'shuffle': True},
+                      {'compression': 'gzip', 'compression_level': 1, 'shuffle': True},
+                      {'compression': 'gzip', 'compression_level': 4, 'shuffle': True},
+                      {'compression': 'gzip', 'compression_level': 4, 'shuffle': True, 'dtype': 'float32'},
+                      {'compression': 'gzip', 'compression_level': 4, 'shuffle': True, 'mantissa_bits': 16},
+                      {'compression': 'lzf', 'shuffle': True, 'dtype': 'float32', 'mantissa_bits': 12}]
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-f", dest="file", default=None, help="Observation file with recorded spectra")
+    parser.add_option("-d", dest="dataset", default=None,
+                      help="Spectra dataset, e.g. observation_data/obs_ant_spectra")
+    parser.add_option("--axis", dest="axis", default=0, type=int,
+                      help="Time axis of spectra dataset (default: 0)")
+    parser.add_option("--nof-rows", dest="nof_rows", default=256, type=int,
+                      help="Maximum number of recorded spectra to use (default: 256)")
+    parser.add_option("--rows-per-flush", dest="rows_per_flush", default=16, type=int,
+                      help="Number of spectra per slab write (default: 16)")
+    parser.add_option("--config", dest="config", default=None,
+                      help="Observation configuration file, its dataset_filters are also benchmarked")
+    parser.add_option("--directory", dest="directory", default=None,
+                      help="Directory of scratch files, should be on the observation disk (default: /tmp)")
+    parser.add_option("--compression-processes", dest="compression_processes", default=0, type=int,
+                      help="Number of processes compressing gzip chunks (default: 0, compress in writer)")
+    parser.add_option("--integration-time", dest="integration_time", default=1, type=float,
+                      help="Acquisition integration time in seconds, to compare rates against (default: 1)")
+    (config, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    if config.file is None or config.dataset is None:
+        parser.error("A recorded observation file and spectra dataset must be specified")
+
+    # Load recorded spectra
+    with h5py.File(config.file, 'r') as f:
+        dset = f[config.dataset]
+        index = [slice(None)] * dset.ndim
+        index[config.axis] = slice(0, min(config.nof_rows, dset.shape[config.axis]))
+        recorded = dset[tuple(index)]
+
+    candidates = list(BENCHMARK_SETTINGS)
+    if config.config is not None:
+        with open(config.config) as f:
+            observation = yaml.load(f, Loader=yaml.FullLoader).get('observation', {})
+        configured = get_dataset_filter(observation.get('dataset_filters'), config.dataset)
+        if configured:
+            candidates.insert(0, configured)
+
+    print("Benchmarking {} spectra of shape {} ({})".format(recorded.shape[config.axis], recorded.shape,
+                                                           recorded.dtype))
+    print("{:<90} {:>8} {:>10} {:>10}".format("Settings", "Ratio", "MB/s", "Realtime"))
+    for settings in candidates:
+        result = benchmark_filters(recorded, settings, config.directory, config.rows_per_flush, config.axis,
+                                   config.compression_processes)
+        print("{:<90} {:>8.2f} {:>10.1f} {:>9.0f}x".format(str(settings), result['compression_ratio'],
+                                                           result['write_rate'],
+                                                           result['rows_per_second'] * config.integration_time))
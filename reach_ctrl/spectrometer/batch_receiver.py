@@ -0,0 +1,151 @@
+from builtins import object
+import numpy as np
+import ctypes
+import logging
+import select
+import socket
+import errno
+import sys
+
+# recvmmsg flags (linux/socket.h)
+MSG_DONTWAIT = 0x40
+
+# Socket option which reports the number of packets dropped by the kernel as ancillary data
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL', 40)
+
+# Size of the ancillary data buffer per message, and offset of the data in a cmsghdr
+_CONTROL_SIZE = 32
+_CMSG_DATA_OFFSET = ctypes.sizeof(ctypes.c_size_t) + 2 * ctypes.sizeof(ctypes.c_int)
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_IOVec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+def _load_recvmmsg():
+    """ Get a handle to the libc recvmmsg function, or None if not available """
+    if not sys.platform.startswith('linux'):
+        return None
+
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        recvmmsg = libc.recvmmsg
+    except (OSError, AttributeError):
+        return None
+
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    return recvmmsg
+
+
+_recvmmsg = _load_recvmmsg()
+
+
+class BatchReceiver(object):
+    """ Receive multiple UDP datagrams per system call with recvmmsg """
+
+    def __init__(self, sock, nof_slots=256, slot_size=9000):
+        """ Class constructor
+        @param sock: Bound UDP socket to receive from
+        @param nof_slots: Number of packets which can be received in one call
+        @param slot_size: Maximum size of each packet """
+
+        if _recvmmsg is None:
+            raise RuntimeError("recvmmsg is not available on this platform")
+
+        self._socket = sock
+        self._nof_slots = nof_slots
+        self._slot_size = slot_size
+
+        # Ring of packet slots. Each message header points to its own slot for the lifetime of the
+        # receiver, so packets are written in place by the kernel
+        self.slots = np.zeros((nof_slots, slot_size), dtype=np.uint8)
+        self.lengths = np.zeros(nof_slots, dtype=np.int64)
+
+        # Ancillary data buffers, used to get the number of packets dropped by the kernel
+        self._control = np.zeros((nof_slots, _CONTROL_SIZE), dtype=np.uint8)
+        self.kernel_drops = 0
+
+        self._iovecs = (_IOVec * nof_slots)()
+        self._messages = (_MMsgHdr * nof_slots)()
+
+        # View of the message header fields written by the kernel, so that they can be read and reset
+        # without looping over messages in Python
+        message_fields = np.dtype({'names': ['msg_controllen', 'msg_len'],
+                                   'formats': [np.uintp, np.uintc],
+                                   'offsets': [_MsgHdr.msg_controllen.offset, _MMsgHdr.msg_len.offset],
+                                   'itemsize': ctypes.sizeof(_MMsgHdr)})
+        self._message_fields = np.frombuffer(self._messages, dtype=message_fields)
+        self._message_fields['msg_controllen'] = _CONTROL_SIZE
+        self._nof_used_slots = 0
+
+        base_address = self.slots.ctypes.data
+        for i in range(nof_slots):
+            self._iovecs[i].iov_base = base_address + i * slot_size
+            self._iovecs[i].iov_len = slot_size
+            self._messages[i].msg_hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+            self._messages[i].msg_hdr.msg_iovlen = 1
+            self._messages[i].msg_hdr.msg_control = self._control.ctypes.data + i * _CONTROL_SIZE
+
+    @staticmethod
+    def available():
+        """ Check whether batched receive is supported """
+        return _recvmmsg is not None
+
+    def receive(self):
+        """ Wait for packets to arrive and receive as many as are queued, up to the number of slots.
+        Raises socket.timeout if no packet arrives within the socket timeout
+        @return: Number of received packets, stored in the first slots """
+
+        # Wait for the socket to become readable, honouring the socket timeout
+        readable, _, _ = select.select([self._socket], [], [], self._socket.gettimeout())
+        if not readable:
+            raise socket.timeout()
+
+        # Receive all queued packets. The kernel overwrites the ancillary data length of the messages it fills,
+        # so only the slots used by the previous call need to be reset
+        self._message_fields['msg_controllen'][:self._nof_used_slots] = _CONTROL_SIZE
+        self._nof_used_slots = 0
+        nof_packets = _recvmmsg(self._socket.fileno(), self._messages, self._nof_slots, MSG_DONTWAIT, None)
+        if nof_packets < 0:
+            error = ctypes.get_errno()
+            if error in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return 0
+            raise OSError(error, "recvmmsg failed")
+
+        self._nof_used_slots = nof_packets
+        self.lengths[:nof_packets] = self._message_fields['msg_len'][:nof_packets]
+
+        # The drop counter is cumulative, so only the last packet needs to be checked
+        if nof_packets > 0:
+            self._update_kernel_drops(nof_packets - 1)
+
+        return nof_packets
+
+    def _update_kernel_drops(self, index):
+        """ Update the number of packets dropped by the kernel from the ancillary data of a message """
+        header = self._messages[index].msg_hdr
+        if header.msg_controllen < _CMSG_DATA_OFFSET + 4:
+            return
+
+        control = self._control[index]
+        level, option = np.frombuffer(control[ctypes.sizeof(ctypes.c_size_t):_CMSG_DATA_OFFSET], dtype=np.intc)
+        if level == socket.SOL_SOCKET and option == SO_RXQ_OVFL:
+            self.kernel_drops = int(control[_CMSG_DATA_OFFSET:_CMSG_DATA_OFFSET + 4].view(np.uint32)[0])
+
@@ -0,0 +1,263 @@
+from multiprocessing import shared_memory
+from builtins import object
+import multiprocessing
+import numpy as np
+import logging
+import signal
+import time
+
+from reach_ctrl.spectrometer.telemetry import heap_statistics_dtype
+
+
+class HeapRing(object):
+    """ Ring of completed heaps (timestamp and spectrum) in shared memory. A single producer writes heaps
+    with increasing sequence numbers, consumers copy them out by sequence number. Each slot is protected
+    by its sequence number, as a sequence lock: the producer invalidates it before overwriting the slot,
+    and consumers check it again after copying a heap """
+
+    def __init__(self, nof_slots, nof_signals, nof_channels, dtype=np.double, name=None):
+        """ Class constructor. Creates the shared memory block if name is not specified, otherwise
+        attaches to an existing one
+        :param nof_slots: Number of heaps in ring
+        :param nof_signals: Number of signals per heap
+        :param nof_channels: Number of frequency channels per signal
+        :param dtype: Spectrum data type
+        :param name: Name of existing shared memory block """
+
+        self._nof_slots = nof_slots
+        self._dtype = np.dtype(dtype)
+
+        # Layout: write sequence, per-slot sequence numbers, timestamps, heap statistics, spectra,
+        # spectra validity masks
+        spectra_shape = (nof_slots, nof_signals, nof_channels)
+        control_size = 8 * (1 + nof_slots)
+        timestamps_size = 8 * nof_slots + heap_statistics_dtype.itemsize * nof_slots
+        spectra_size = int(np.prod(spectra_shape)) * self._dtype.itemsize
+        masks_size = int(np.prod(spectra_shape))
+
+        self._owner = name is None
+        if self._owner:
+            self._shm = shared_memory.SharedMemory(create=True,
+                                                   size=control_size + timestamps_size + spectra_size + masks_size)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+
+        buf = self._shm.buf
+        self._head = np.ndarray((1,), dtype=np.int64, buffer=buf, offset=0)
+        self._slot_sequence = np.ndarray((nof_slots,), dtype=np.int64, buffer=buf, offset=8)
+        self._timestamps = np.ndarray((nof_slots,), dtype=np.float64, buffer=buf, offset=control_size)
+        self._statistics = np.ndarray((nof_slots,), dtype=heap_statistics_dtype, buffer=buf,
+                                      offset=control_size + 8 * nof_slots)
+        self._spectra = np.ndarray(spectra_shape, dtype=self._dtype, buffer=buf,
+                                   offset=control_size + timestamps_size)
+        self._masks = np.ndarray(spectra_shape, dtype=bool, buffer=buf,
+                                 offset=control_size + timestamps_size + spectra_size)
+
+        if self._owner:
+            self._head[0] = 0
+            self._slot_sequence[:] = -1
+
+    @property
+    def name(self):
+        """ Name of the shared memory block """
+        return self._shm.name
+
+    @property
+    def head(self):
+        """ Sequence number of the next heap to be written """
+        return int(self._head[0])
+
+    def write(self, timestamp, spectrum, valid_mask, statistics):
+        """ Write a heap to the ring. Should only be called by the producer
+        :param timestamp: Heap timestamp
+        :param spectrum: Heap spectrum
+        :param valid_mask: Mask of received values in spectrum
+        :param statistics: Heap receiver statistics """
+
+        sequence = int(self._head[0])
+        slot = sequence % self._nof_slots
+
+        # Mark slot as being written, write heap, then publish it
+        self._slot_sequence[slot] = -1
+        self._timestamps[slot] = timestamp
+        self._spectra[slot] = spectrum
+        self._masks[slot] = valid_mask
+        self._statistics[slot] = statistics
+        self._slot_sequence[slot] = sequence
+        self._head[0] = sequence + 1
+
+    def read(self, sequence, spectrum=None, valid_mask=None):
+        """ Copy a heap out of the ring. The producer may start overwriting the slot while it is being copied,
+        so the copy is only returned if the slot still holds the same heap afterwards
+        :param sequence: Sequence number of heap to read
+        :param spectrum: Optional array to copy the spectrum into
+        :param valid_mask: Optional array to copy the valid mask into
+        :return: Timestamp, spectrum, valid mask and heap statistics, or None if the heap is not available
+                 or was overwritten while being read """
+
+        slot = sequence % self._nof_slots
+        if not self.is_valid(sequence):
+            return None
+
+        if spectrum is None:
+            spectrum = np.empty_like(self._spectra[slot])
+        if valid_mask is None:
+            valid_mask = np.empty_like(self._masks[slot])
+
+        timestamp = float(self._timestamps[slot])
+        statistics = self._statistics[slot:slot + 1].copy()[0]
+        np.copyto(spectrum, self._spectra[slot])
+        np.copyto(valid_mask, self._masks[slot])
+
+        # Discard the copy if the producer started overwriting the slot in the meantime
+        if not self.is_valid(sequence):
+            return None
+
+        return timestamp, spectrum, valid_mask, statistics
+
+    def is_valid(self, sequence):
+        """ Check whether a heap is in the ring and has not been overwritten
+        :param sequence: Sequence number of heap """
+        return self._slot_sequence[sequence % self._nof_slots] == sequence
+
+    def close(self):
+        """ Detach from the shared memory block, and remove it if this instance created it """
+
+        # Release array views before closing the memory map
+        self._head = self._slot_sequence = self._timestamps = self._spectra = self._masks = None
+        self._statistics = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+def _capture(ring_name, nof_slots, spectra_parameters, stop_event, heap_event):
+    """ Capture process entry point. Receives heaps and publishes them to the heap ring
+    :param ring_name: Name of heap ring shared memory block
+    :param nof_slots: Number of heaps in ring
+    :param spectra_parameters: Spectra constructor parameters
+    :param stop_event: Event used to stop capturing
+    :param heap_event: Event set whenever a heap is published """
+
+    from reach_ctrl.spectrometer.spectra import Spectra
+
+    # Interrupts are handled by the main process, which stops the capture process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    spectra = Spectra(**spectra_parameters)
+    spectra.initialise()
+
+    ring = HeapRing(nof_slots, spectra_parameters['nof_signals'], spectra_parameters['nof_channels'],
+                    spectra.data_type, name=ring_name)
+
+    try:
+        while True:
+            heap = spectra.receive_spectrum(stop_event)
+            if heap is None:
+                break
+            ring.write(heap[0], heap[1], spectra.valid_mask, spectra.heap_statistics)
+            heap_event.set()
+    finally:
+        ring.close()
+
+
+class CaptureProcess(object):
+    """ Runs packet reception and heap assembly in a separate process, publishing heaps to a HeapRing """
+
+    def __init__(self, spectra_parameters, nof_slots=32):
+        """ Class constructor
+        :param spectra_parameters: Parameters of the Spectra receiver created in the capture process
+        :param nof_slots: Number of heaps in the shared memory ring """
+
+        self._spectra_parameters = spectra_parameters
+        self._nof_slots = nof_slots
+        self._dtype = np.double if spectra_parameters.get('floating_point', True) else np.uint64
+
+        self._ring = None
+        self._process = None
+        self._stop_event = multiprocessing.Event()
+        self._heap_event = multiprocessing.Event()
+
+        # Sequence number of next heap to be read, and the maximum time between checks of the capture
+        # process while waiting for a heap
+        self._read_sequence = 0
+        self._wait_interval = 0.1
+
+    def start(self):
+        """ Create heap ring and start capture process """
+        self._ring = HeapRing(self._nof_slots, self._spectra_parameters['nof_signals'],
+                              self._spectra_parameters['nof_channels'], self._dtype)
+
+        self._stop_event.clear()
+        self._heap_event.clear()
+        self._process = multiprocessing.Process(target=_capture, name="spectra_capture",
+                                                args=(self._ring.name, self._nof_slots, self._spectra_parameters,
+                                                      self._stop_event, self._heap_event))
+        self._process.daemon = True
+        self._process.start()
+        self._read_sequence = 0
+
+        logging.info("Started spectra capture process (pid {})".format(self._process.pid))
+
+    def skip_to_latest(self):
+        """ Discard heaps which have already been captured, so that the next read returns a new heap """
+        self._read_sequence = self._ring.head
+
+    def read_heap(self, timeout=None, stop_event=None, spectrum=None, valid_mask=None):
+        """ Wait for the next heap and copy it out of the ring
+        :param timeout: Maximum time to wait in seconds, None to wait indefinitely
+        :param stop_event: Optional event which interrupts the wait
+        :param spectrum: Optional array to copy the spectrum into
+        :param valid_mask: Optional array to copy the valid mask into
+        :return: Timestamp, spectrum, valid mask and heap statistics, or None on timeout or stop """
+
+        start_time = time.time()
+        while True:
+            # Wait for the producer to publish a heap. The wait is interrupted periodically to check
+            # whether the capture process is still running and whether the caller stopped reading
+            while self._ring.head <= self._read_sequence:
+                if not self._process.is_alive():
+                    logging.error("Spectra capture process is not running")
+                    return None
+                if stop_event is not None and stop_event.is_set():
+                    return None
+
+                wait_time = self._wait_interval
+                if timeout is not None:
+                    wait_time = min(wait_time, timeout - (time.time() - start_time))
+                    if wait_time <= 0:
+                        return None
+
+                # Clear the event before checking the ring again, so that a heap published in between
+                # is not missed
+                self._heap_event.clear()
+                if self._ring.head > self._read_sequence:
+                    break
+                self._heap_event.wait(wait_time)
+
+            # If the consumer fell behind by more than the ring size, skip to the oldest available heap
+            oldest = self._ring.head - self._nof_slots
+            if self._read_sequence < oldest:
+                logging.warning("Spectra consumer overrun, dropped {} heaps".format(oldest - self._read_sequence))
+                self._read_sequence = oldest
+
+            heap = self._ring.read(self._read_sequence, spectrum, valid_mask)
+            self._read_sequence += 1
+            if heap is not None:
+                return heap
+
+            # The producer overwrote the heap while it was being copied
+            logging.warning("Spectra consumer overrun, dropped 1 heap")
+
+    def stop(self):
+        """ Stop capture process and release heap ring """
+        if self._process is not None:
+            self._stop_event.set()
+            self._process.join()
+            self._process = None
+
+        if self._ring is not None:
+            self._ring.close()
+            self._ring = None
+
+        logging.info("Stopped spectra capture process")
@@ -0,0 +1,183 @@
+from builtins import range
+from builtins import object
+import numpy as np
+import time
+
+
+class Heap(object):
+    """ Heap returned by HeapReassembler. Data and mask are views into the reassembler, valid until the next
+    packet is added """
+
+    def __init__(self, header, data, packet_mask):
+        self.header = header
+        self.data = data
+        self.packet_mask = packet_mask
+
+    @property
+    def complete(self):
+        """ True if all packets in the heap were received """
+        return bool(np.all(self.packet_mask))
+
+
+class HeapReassembler(object):
+    """ Reassembles packets into heaps keyed by timestamp. Several heaps can be in flight at the same time,
+    so packets from different FPGAs which interleave across heap boundaries, or late packets, do not corrupt
+    or drop a heap. Heaps are returned in timestamp order once complete, or partially filled when they
+    time out or are pushed out of the table by newer heaps """
+
+    def __init__(self, nof_rows, row_length, packet_length, dtype=np.double, nof_heaps=4, timeout=2):
+        """ Class constructor
+        :param nof_rows: Number of rows (FPGAs) in a heap
+        :param row_length: Number of values per row
+        :param packet_length: Number of values per packet
+        :param dtype: Data type of values
+        :param nof_heaps: Maximum number of heaps in flight
+        :param timeout: Time in seconds after the first packet of a heap after which it is returned partially """
+
+        self._nof_rows = nof_rows
+        self._row_length = row_length
+        self._packet_length = packet_length
+        self._nof_heaps = nof_heaps
+        self._timeout = timeout
+        self._nof_packets = nof_rows * row_length // packet_length
+
+        # One spare slot, used for a new heap while the heap it pushes out is still to be returned
+        nof_slots = nof_heaps + 1
+        self._data = np.zeros((nof_slots, nof_rows, row_length), dtype=dtype)
+        self._packet_mask = np.zeros((nof_slots, self._nof_packets), dtype=bool)
+        self._nof_received = np.zeros(nof_slots, dtype=np.int64)
+        self._timestamps = np.full(nof_slots, -1, dtype=np.int64)
+        self._arrival_times = np.zeros(nof_slots)
+        self._expired = np.zeros(nof_slots, dtype=bool)
+        self._headers = [None] * nof_slots
+
+        # Timestamp of last returned heap. Packets for this or older heaps are late
+        self._last_timestamp = -1
+        self._sync_time = None
+
+        # Heap which was being received when the reassembler was reset, and is discarded
+        self._skip_in_progress = False
+
+        # Most recently used slot, to avoid a lookup for consecutive packets of the same heap
+        self._current_slot = 0
+
+        # Packet and heap counters
+        self.nof_late_packets = 0
+        self.nof_duplicate_packets = 0
+        self.nof_invalid_packets = 0
+        self.nof_dropped_heaps = 0
+
+    @property
+    def expected_nof_packets(self):
+        """ Number of packets in a full heap """
+        return self._nof_packets
+
+    def reset(self, skip_in_progress=False):
+        """ Discard all heaps in flight
+        :param skip_in_progress: Also discard the rest of the heap being received, if the next packet is
+                                 not at the start of a heap row """
+        self._timestamps[:] = -1
+        self._expired[:] = False
+        self._last_timestamp = -1
+        self._skip_in_progress = skip_in_progress
+
+    def add_packet(self, header, row, offset, payload):
+        """ Add a packet to its heap
+        :param header: Decoded packet header
+        :param row: Heap row (FPGA) of packet
+        :param offset: Offset of packet payload within row
+        :param payload: Packet payload """
+
+        # Drop packets which do not fit a packet slot of the heap, rather than failing on a corrupt packet
+        if not (0 <= row < self._nof_rows and 0 <= offset and offset % self._packet_length == 0 and
+                offset + payload.shape[0] <= self._row_length and payload.shape[0] == self._packet_length):
+            self.nof_invalid_packets += 1
+            return
+
+        timestamp = int(header['timestamp'])
+
+        # Timestamps restart when the firmware is re-synchronised
+        if header['sync_time'] != self._sync_time:
+            self.reset()
+            self._sync_time = header['sync_time']
+
+        # Discard the heap in progress after a reset, unless this packet starts it
+        if self._skip_in_progress:
+            self._skip_in_progress = False
+            if offset != 0:
+                self._last_timestamp = timestamp
+
+        # Drop packets belonging to heaps which have already been returned
+        if timestamp <= self._last_timestamp:
+            self.nof_late_packets += 1
+            return
+
+        slot = self._find_slot(timestamp, header)
+        packet = (row * self._row_length + offset) // self._packet_length
+        if self._packet_mask[slot, packet]:
+            self.nof_duplicate_packets += 1
+            return
+
+        self._data[slot, row, offset:offset + payload.shape[0]] = payload
+        self._packet_mask[slot, packet] = True
+        self._nof_received[slot] += 1
+
+    def pop_heap(self, flush=False):
+        """ Return the oldest heap if it is complete, has timed out or has been pushed out by newer heaps
+        :param flush: Return the oldest heap in flight regardless of its state
+        :return: Heap, or None if no heap is ready """
+
+        in_flight = np.flatnonzero(self._timestamps >= 0)
+        if in_flight.size == 0:
+            return None
+
+        slot = in_flight[np.argmin(self._timestamps[in_flight])]
+        ready = (flush or self._expired[slot] or self._nof_received[slot] == self._nof_packets or
+                 time.time() - self._arrival_times[slot] > self._timeout)
+        if not ready:
+            return None
+
+        # Release slot. Its content remains valid until a new heap is allocated
+        self._last_timestamp = self._timestamps[slot]
+        self._timestamps[slot] = -1
+        self._expired[slot] = False
+
+        return Heap(self._headers[slot], self._data[slot], self._packet_mask[slot])
+
+    def _find_slot(self, timestamp, header):
+        """ Get the slot of the heap with the specified timestamp, allocating a new one if required """
+
+        if self._timestamps[self._current_slot] == timestamp:
+            return self._current_slot
+
+        matches = np.flatnonzero(self._timestamps == timestamp)
+        if matches.size != 0:
+            self._current_slot = matches[0]
+            return self._current_slot
+
+        # If too many heaps are in flight, mark the oldest one for return
+        in_flight = np.flatnonzero((self._timestamps >= 0) & ~self._expired)
+        if in_flight.size >= self._nof_heaps:
+            self._expired[in_flight[np.argmin(self._timestamps[in_flight])]] = True
+
+        # If heaps pushed out of the table were not returned, drop the oldest one to free a slot
+        free = np.flatnonzero(self._timestamps < 0)
+        if free.size == 0:
+            expired = np.flatnonzero(self._expired)
+            slot = expired[np.argmin(self._timestamps[expired])]
+            self._timestamps[slot] = -1
+            self._expired[slot] = False
+            self.nof_dropped_heaps += 1
+        else:
+            slot = free[0]
+
+        # Allocate slot
+        self._timestamps[slot] = timestamp
+        self._arrival_times[slot] = time.time()
+        self._headers[slot] = header
+        self._data[slot] = 0
+        self._packet_mask[slot] = False
+        self._nof_received[slot] = 0
+        self._current_slot = slot
+
+        return slot
@@ -0,0 +1,177 @@
+from builtins import range
+import numpy as np
+import logging
+
+# SPEAD item identifiers used by the TPM integrated channel data stream
+SPEAD_MAGIC = 0x5304
+HEAP_COUNTER = 0x8001
+PAYLOAD_LENGTH = 0x8004
+SYNC_TIME = 0x9027
+TIMESTAMP = 0x9600
+BUFFER_ID = 0xA001
+CHANNEL_INFO = 0xA002
+BUFFER_INFO = 0xA003
+LMC_MODE = 0xA004
+PADDING = 0x3300
+
+# Number of items and bytes in the SPEAD header
+NOF_HEADER_ITEMS = 9
+HEADER_LENGTH = NOF_HEADER_ITEMS * 8
+
+# Decoded header representation, one record per packet
+header_dtype = np.dtype([('heap_counter', np.uint32),
+                         ('logical_channel_id', np.uint32),
+                         ('payload_length', np.int64),
+                         ('sync_time', np.uint64),
+                         ('timestamp', np.uint64),
+                         ('start_channel_id', np.int64),
+                         ('start_antenna_id', np.int64),
+                         ('buffer_id', np.uint32),
+                         ('lmc_mode', np.uint32),
+                         ('flags', np.uint32)])
+
+# Flags set in the decoded header
+FLAG_FLOATING_POINT = 0x1
+FLAG_UNKNOWN_ITEM = 0x2
+FLAG_OUT_OF_RANGE = 0x4
+
+
+def _decode_heap_counter(headers, values):
+    headers['heap_counter'] = values & 0xFFFFFF
+    headers['logical_channel_id'] = values >> 24
+
+
+def _decode_payload_length(headers, values):
+    headers['payload_length'] = values
+
+
+def _decode_sync_time(headers, values):
+    headers['sync_time'] = values
+
+
+def _decode_timestamp(headers, values):
+    headers['timestamp'] = values
+
+
+def _decode_lmc_mode(headers, values):
+    headers['lmc_mode'] = values & 0xEF
+    headers['flags'] |= ((values >> 7) & 0x1).astype(np.uint32) * FLAG_FLOATING_POINT
+
+
+def _decode_channel_info(headers, values):
+    headers['start_channel_id'] = (values & 0x000000FFFF000000) >> 24
+    headers['start_antenna_id'] = (values & 0x000000000000FF00) >> 8
+
+
+def _decode_buffer_id(headers, values):
+    headers['buffer_id'] = (values & 0xFFFFFFFF) >> 16
+
+
+def _ignore_item(headers, values):
+    pass
+
+
+# Dispatch table mapping item identifiers to their decoders
+ITEM_DECODERS = {SPEAD_MAGIC: _ignore_item,
+                 HEAP_COUNTER: _decode_heap_counter,
+                 PAYLOAD_LENGTH: _decode_payload_length,
+                 SYNC_TIME: _decode_sync_time,
+                 TIMESTAMP: _decode_timestamp,
+                 LMC_MODE: _decode_lmc_mode,
+                 CHANNEL_INFO: _decode_channel_info,
+                 BUFFER_ID: _decode_buffer_id,
+                 BUFFER_INFO: _decode_buffer_id,
+                 PADDING: _ignore_item}
+
+
+def _decode_item(headers, spead_id, values, selection):
+    """ Decode one item for the selected packets using the dispatch table """
+    decoder = ITEM_DECODERS.get(spead_id)
+    if decoder is None:
+        headers['flags'][selection] |= FLAG_UNKNOWN_ITEM
+    elif isinstance(selection, slice):
+        decoder(headers, values)
+    else:
+        subset = headers[selection]
+        decoder(subset, values)
+        headers[selection] = subset
+
+
+def decode_spead_headers(packets, lengths=None, payload_length=None, nof_channels=None, channels_per_packet=1,
+                         nof_antennas=None):
+    """ Decode the SPEAD headers of a batch of packets
+    :param packets: 2D uint8 array with one packet (or packet header) per row
+    :param lengths: Number of valid bytes per packet. If not specified the packets are assumed to be complete
+    :param payload_length: Expected payload length in bytes, None to accept any payload length
+    :param nof_channels: Number of channels in a heap, None to accept any start channel
+    :param channels_per_packet: Number of channels per packet. Start channels must be a multiple of it and
+                                packets must end within the heap
+    :param nof_antennas: Number of antennas (signals) in a heap, None to accept any start antenna
+    :return: Structured array of decoded headers (header_dtype) and validity mask """
+
+    nof_packets = packets.shape[0]
+    headers = np.zeros(nof_packets, dtype=header_dtype)
+    if nof_packets == 0:
+        return headers, np.zeros(0, dtype=bool)
+
+    # Interpret header items as big-endian 64-bit words, split into item IDs and values
+    items = np.ascontiguousarray(packets[:, :HEADER_LENGTH]).view('>u8').astype(np.uint64)
+    ids = (items >> np.uint64(48)).astype(np.int64)
+    values = (items & np.uint64(0x0000FFFFFFFFFFFF)).astype(np.int64)
+
+    # Decode items position by position. In a well-formed stream every packet has the same item
+    # at a given position, so each position is normally a single vectorised decode over all packets
+    uniform = np.all(ids == ids[0], axis=0)
+    for position in range(NOF_HEADER_ITEMS):
+        if uniform[position]:
+            _decode_item(headers, int(ids[0, position]), values[:, position], slice(None))
+        else:
+            position_ids = ids[:, position]
+            for spead_id in np.unique(position_ids):
+                selection = position_ids == spead_id
+                _decode_item(headers, int(spead_id), values[selection, position], selection)
+
+    # Valid packets start with the SPEAD magic item and contain their full payload
+    valid = ids[:, 0] == SPEAD_MAGIC
+    if lengths is not None:
+        valid &= np.asarray(lengths) >= HEADER_LENGTH + headers['payload_length']
+
+    # Packets must have the configured size and fall within the heap, otherwise they are stray or corrupt
+    in_range = np.ones(nof_packets, dtype=bool)
+    if payload_length is not None:
+        in_range &= headers['payload_length'] == payload_length
+    if nof_channels is not None:
+        in_range &= (headers['start_channel_id'] % channels_per_packet == 0) & \
+            (headers['start_channel_id'] + channels_per_packet <= nof_channels)
+    if nof_antennas is not None:
+        in_range &= headers['start_antenna_id'] < nof_antennas
+    headers['flags'][~in_range] |= FLAG_OUT_OF_RANGE
+    valid &= in_range
+
+    return headers, valid
+
+
+def heap_time(header, sampling_period=2.5e-9, nof_samples_per_timestamp=32768):
+    """ Convert decoded header timestamps to UNIX time
+    :param header: Decoded header record or array
+    :param sampling_period: ADC sampling period in seconds
+    :param nof_samples_per_timestamp: Number of samples per timestamp tick """
+    return header['sync_time'] + header['timestamp'] * nof_samples_per_timestamp * sampling_period
+
+
+def log_header_errors(headers, valid):
+    """ Log a summary of decoding errors for a batch of packets, rather than one message per packet
+    :param headers: Decoded headers
+    :param valid: Validity mask """
+    nof_invalid = np.count_nonzero(~valid)
+    if nof_invalid:
+        logging.error("Discarded {} invalid SPEAD packets".format(nof_invalid))
+
+    nof_unknown = np.count_nonzero(headers['flags'] & FLAG_UNKNOWN_ITEM)
+    if nof_unknown:
+        logging.error("Unexpected SPEAD header items in {} packets".format(nof_unknown))
+
+    nof_out_of_range = np.count_nonzero(headers['flags'] & FLAG_OUT_OF_RANGE)
+    if nof_out_of_range:
+        logging.error("Payload length, channel or antenna out of range in {} SPEAD packets".format(
+            nof_out_of_range))
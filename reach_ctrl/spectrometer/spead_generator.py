@@ -0,0 +1,336 @@
+from __future__ import division
+from builtins import range
+from builtins import object
+import numpy as np
+import logging
+import socket
+import time
+
+from reach_ctrl.spectrometer import spead
+
+# LMC mode of the integrated channel data stream, and the floating point flag within the mode item
+INTEGRATED_CHANNEL_MODE = 0x5
+FLOATING_POINT_MODE = 0x80
+
+# Duration of one timestamp tick in seconds (32768 samples at 400 MHz)
+TIMESTAMP_PERIOD = 32768 * 2.5e-9
+
+
+def ramp_spectrum(nof_signals=2, nof_channels=16384):
+    """ Generate a spectrum where every value is unique, so that reassembly errors are easy to spot
+    :param nof_signals: Number of signals
+    :param nof_channels: Number of frequency channels per signal
+    :return: Spectrum in (signal, channel) order, value is signal * nof_channels + channel """
+    return np.arange(nof_signals * nof_channels, dtype=np.double).reshape(nof_signals, nof_channels)
+
+
+def firmware_channel_order(nof_signals, nof_channels, floating_point=True):
+    """ Get the signal and channel of every value in the FPGA buffers, in the order in which the firmware sends
+    them. This follows the firmware layout value by value, and does not use the receiver's reorder index, so that
+    the generator can be used to check the receiver
+    :param nof_signals: Number of signals, split equally between two FPGAs
+    :param nof_channels: Number of frequency channels per signal
+    :param floating_point: Channels are sent in bit reversed order in floating point mode
+    :return: Signal and channel arrays, one row per FPGA """
+
+    nof_fpgas = 2
+    nof_signals_per_fpga = nof_signals // nof_fpgas
+    nof_bits = int(np.log2(nof_channels))
+
+    signals = np.zeros((nof_fpgas, nof_signals_per_fpga * nof_channels), dtype=np.int64)
+    channels = np.zeros_like(signals)
+    for fpga in range(nof_fpgas):
+        for n in range(nof_signals_per_fpga * nof_channels):
+            # The signals of an FPGA are multiplexed value by value
+            signal = fpga * nof_signals_per_fpga + n % nof_signals_per_fpga
+            channel = n // nof_signals_per_fpga
+
+            # With more than one signal per FPGA the band is scrambled: even positions hold the lower half of
+            # the band and odd positions the upper half
+            if nof_signals_per_fpga != 1:
+                if channel % 2 == 0:
+                    channel = channel // 2
+                else:
+                    channel = channel // 2 + nof_channels // 2
+
+            # In floating point mode channels are sent in bit reversed FFT output order
+            if floating_point:
+                reversed_channel = 0
+                for bit in range(nof_bits):
+                    reversed_channel |= ((channel >> bit) & 1) << (nof_bits - bit - 1)
+                channel = reversed_channel
+
+            signals[fpga, n] = signal
+            channels[fpga, n] = channel
+
+    return signals, channels
+
+
+class SpeadGenerator(object):
+    """ Emulates the integrated channel data stream of the TPM spectrometer firmware. Spectra are scrambled,
+    multiplexed and split between two FPGAs as in the firmware, and sent as SPEAD packets, optionally with
+    packet loss, reordering and duplication """
+
+    def __init__(self, ip="127.0.0.1", port=4660, nof_signals=2, nof_channels=16384, floating_point=True,
+                 payload_length=1024, sync_time=None, integration_time=1, packet_rate=None,
+                 loss=0, reorder=0, reorder_distance=16, duplicate=0, seed=None):
+        """ Class constructor
+        :param ip: Destination IP address
+        :param port: Destination port
+        :param nof_signals: Number of signals, split equally between two FPGAs
+        :param nof_channels: Number of frequency channels per signal
+        :param floating_point: Send floating point spectra (otherwise 64-bit integers)
+        :param payload_length: Payload bytes per packet
+        :param sync_time: Synchronisation time in the packet headers, defaults to now
+        :param integration_time: Time between consecutive heap timestamps in seconds
+        :param packet_rate: Packets per second, None to send as fast as possible
+        :param loss: Probability that a packet is dropped
+        :param reorder: Probability that a packet is delayed
+        :param reorder_distance: Maximum number of packets by which a delayed packet is moved
+        :param duplicate: Probability that a packet is sent twice
+        :param seed: Random seed for impairments """
+
+        self._ip = ip
+        self._port = port
+        self._nof_signals = nof_signals
+        self._nof_channels = nof_channels
+        self._use_floating_point = floating_point
+        self._payload_length = payload_length
+        self._sync_time = int(time.time()) if sync_time is None else sync_time
+        self._timestamp_step = max(1, int(round(integration_time / TIMESTAMP_PERIOD)))
+        self._packet_rate = packet_rate
+
+        # Impairments
+        self._loss = loss
+        self._reorder = reorder
+        self._reorder_distance = reorder_distance
+        self._duplicate = duplicate
+        self._random = np.random.RandomState(seed)
+
+        # Payload layout
+        self._nof_fpgas = 2
+        self._nof_signals_per_fpga = nof_signals // self._nof_fpgas
+        self._data_type = np.dtype('<f8' if floating_point else '<u8')
+        self._values_per_packet = payload_length // self._data_type.itemsize
+        self._nof_packets_per_fpga = self._nof_signals_per_fpga * nof_channels // self._values_per_packet
+        self._nof_packets = self._nof_fpgas * self._nof_packets_per_fpga
+
+        # Index of the spectrum value sent in every payload position. The FPGA buffers are split into packets,
+        # so each buffer row is a run of consecutive packet payloads
+        signals, channels = firmware_channel_order(nof_signals, nof_channels, floating_point)
+        self._gather_index = (signals * nof_channels + channels).reshape(self._nof_packets, self._values_per_packet)
+
+        # Packets in wire order: packets of the two FPGAs are interleaved
+        fpga, packet = np.divmod(np.arange(self._nof_packets), self._nof_packets_per_fpga)
+        self._wire_order = np.lexsort((fpga, packet))
+
+        # Preallocated packets, with the constant header items filled in
+        self._packets = np.zeros((self._nof_packets, spead.HEADER_LENGTH + payload_length), dtype=np.uint8)
+        self._headers = np.zeros((self._nof_packets, spead.NOF_HEADER_ITEMS), dtype='>u8')
+        self._payloads = self._packets[:, spead.HEADER_LENGTH:].view(self._data_type)
+        self._initialise_headers(fpga, packet)
+
+        self._socket = None
+        self._next_timestamp = 0
+
+        # Statistics
+        self.nof_heaps = 0
+        self.nof_packets = 0
+        self.nof_lost_packets = 0
+        self.nof_reordered_packets = 0
+        self.nof_duplicate_packets = 0
+
+    @property
+    def nof_packets_per_heap(self):
+        """ Number of packets in a heap """
+        return self._nof_packets
+
+    @property
+    def packet_size(self):
+        """ Size of a packet in bytes """
+        return self._packets.shape[1]
+
+    def _initialise_headers(self, fpga, packet):
+        """ Fill in header items which do not change between heaps
+        :param fpga: FPGA of each packet
+        :param packet: Index of each packet within its FPGA """
+
+        def item(spead_id, values):
+            return (np.uint64(spead_id) << np.uint64(48)) | np.asarray(values, dtype=np.uint64)
+
+        mode = INTEGRATED_CHANNEL_MODE | (FLOATING_POINT_MODE if self._use_floating_point else 0)
+        start_channel = packet * self._values_per_packet // self._nof_signals_per_fpga
+        start_antenna = fpga * self._nof_signals_per_fpga
+
+        # SPEAD magic word: version 4, 2-byte item pointers, 6-byte addresses, number of items
+        self._headers[:, 0] = item(spead.SPEAD_MAGIC, (0x0206 << 32) | spead.NOF_HEADER_ITEMS)
+        self._headers[:, 2] = item(spead.PAYLOAD_LENGTH, self._payload_length)
+        self._headers[:, 3] = item(spead.SYNC_TIME, self._sync_time)
+        self._headers[:, 5] = item(spead.BUFFER_ID, 0)
+        self._headers[:, 6] = item(spead.CHANNEL_INFO, (start_channel << 24) | (start_antenna << 8))
+        self._headers[:, 7] = item(spead.BUFFER_INFO, 0)
+        self._headers[:, 8] = item(spead.LMC_MODE, mode)
+
+    def build_heap(self, spectrum, timestamp, heap_counter=0):
+        """ Build the packets of a heap
+        :param spectrum: Spectrum in (signal, channel) order, as returned by the receiver
+        :param timestamp: Heap timestamp, in timestamp ticks since sync time
+        :param heap_counter: Heap number, the same in every packet of the heap (24 bits)
+        :return: Packets, one per row, in the order they are sent by the firmware """
+
+        # Fill the FPGA buffers, which are split into packet payloads, in firmware order
+        self._payloads[:] = np.asarray(spectrum).ravel()[self._gather_index]
+
+        self._headers[:, 1] = (np.uint64(spead.HEAP_COUNTER) << np.uint64(48)) | np.uint64(heap_counter & 0xFFFFFF)
+        self._headers[:, 4] = (np.uint64(spead.TIMESTAMP) << np.uint64(48)) | np.uint64(timestamp)
+        self._packets[:, :spead.HEADER_LENGTH] = self._headers.view(np.uint8).reshape(self._nof_packets, -1)
+
+        return self._packets[self._wire_order]
+
+    def _impair(self, nof_packets):
+        """ Compute the send order of a heap with loss, reordering and duplication applied
+        :param nof_packets: Number of packets in heap
+        :return: Indices of packets to send, in send order """
+
+        order = np.arange(nof_packets)
+
+        # Delay some packets by a random number of positions
+        if self._reorder > 0:
+            delayed = self._random.random_sample(nof_packets) < self._reorder
+            keys = order + delayed * self._random.uniform(1, self._reorder_distance + 1, nof_packets)
+            order = order[np.argsort(keys, kind='stable')]
+            self.nof_reordered_packets += int(np.count_nonzero(delayed))
+
+        # Duplicate some packets, the copy is sent right after the original
+        if self._duplicate > 0:
+            duplicated = self._random.random_sample(order.size) < self._duplicate
+            order = np.repeat(order, 1 + duplicated)
+            self.nof_duplicate_packets += int(np.count_nonzero(duplicated))
+
+        # Drop some packets
+        if self._loss > 0:
+            kept = self._random.random_sample(order.size) >= self._loss
+            self.nof_lost_packets += int(order.size - np.count_nonzero(kept))
+            order = order[kept]
+
+        return order
+
+    def connect(self):
+        """ Create sending socket """
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 8 * 1024 * 1024)
+
+    def close(self):
+        """ Close sending socket """
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def send_heap(self, spectrum, timestamp=None):
+        """ Send one heap
+        :param spectrum: Spectrum in (signal, channel) order
+        :param timestamp: Heap timestamp in ticks since sync time, defaults to the next integration """
+
+        if self._socket is None:
+            self.connect()
+
+        if timestamp is None:
+            timestamp = self._next_timestamp
+        self._next_timestamp = timestamp + self._timestamp_step
+
+        packets = self.build_heap(spectrum, timestamp, self.nof_heaps)
+        address = (self._ip, self._port)
+        period = 1.0 / self._packet_rate if self._packet_rate else 0
+        start = time.time()
+
+        for i, index in enumerate(self._impair(packets.shape[0])):
+            # Pace packets by waiting until each packet's send time
+            if period:
+                delay = start + i * period - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            self._socket.sendto(packets[index], address)
+            self.nof_packets += 1
+
+        self.nof_heaps += 1
+
+    def run(self, nof_heaps, spectrum=None, heap_rate=None, stop_event=None):
+        """ Send a number of heaps
+        :param nof_heaps: Number of heaps to send, -1 to send until stopped
+        :param spectrum: Spectrum to send, or a function of the heap number returning a spectrum. Defaults to
+                         a ramp spectrum
+        :param heap_rate: Heaps per second, None to send as fast as possible
+        :param stop_event: Optional event which stops sending
+        :return: Number of heaps sent and elapsed time in seconds """
+
+        if spectrum is None:
+            spectrum = ramp_spectrum(self._nof_signals, self._nof_channels)
+            if not self._use_floating_point:
+                spectrum = spectrum.astype(np.uint64)
+
+        start = time.time()
+        heap = 0
+        while heap < nof_heaps or nof_heaps == -1:
+            if stop_event is not None and stop_event.is_set():
+                break
+
+            self.send_heap(spectrum(heap) if callable(spectrum) else spectrum)
+            heap += 1
+
+            if heap_rate:
+                delay = start + heap / heap_rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+        return heap, time.time() - start
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-p", dest="port", default=4660, type=int, help="UDP port (default:4660)")
+    parser.add_option("-i", dest="ip", default="127.0.0.1", help="Destination IP (default: 127.0.0.1)")
+    parser.add_option("-n", dest="nof_heaps", default=-1, type=int,
+                      help="Number of heaps to send, -1 to send until interrupted (default: -1)")
+    parser.add_option("--nof-channels", dest="nof_channels", default=16384, type=int,
+                      help="Number of frequency channels (default: 16384)")
+    parser.add_option("--fixed-point", dest="fixed_point", default=False, action="store_true",
+                      help="Send integer spectra (default: False)")
+    parser.add_option("--integration-time", dest="integration_time", default=1, type=float,
+                      help="Integration time between heap timestamps in seconds (default: 1)")
+    parser.add_option("--heap-rate", dest="heap_rate", default=None, type=float,
+                      help="Heaps per second (default: as fast as possible)")
+    parser.add_option("--packet-rate", dest="packet_rate", default=None, type=float,
+                      help="Packets per second within a heap (default: as fast as possible)")
+    parser.add_option("--loss", dest="loss", default=0, type=float,
+                      help="Packet loss probability (default: 0)")
+    parser.add_option("--reorder", dest="reorder", default=0, type=float,
+                      help="Packet reordering probability (default: 0)")
+    parser.add_option("--reorder-distance", dest="reorder_distance", default=16, type=int,
+                      help="Maximum reordering distance in packets (default: 16)")
+    parser.add_option("--duplicate", dest="duplicate", default=0, type=float,
+                      help="Packet duplication probability (default: 0)")
+    parser.add_option("--seed", dest="seed", default=None, type=int, help="Random seed (default: None)")
+    (config, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    generator = SpeadGenerator(ip=config.ip, port=config.port, nof_channels=config.nof_channels,
+                               floating_point=not config.fixed_point, integration_time=config.integration_time,
+                               packet_rate=config.packet_rate, loss=config.loss, reorder=config.reorder,
+                               reorder_distance=config.reorder_distance, duplicate=config.duplicate,
+                               seed=config.seed)
+
+    try:
+        nof_heaps, elapsed = generator.run(config.nof_heaps, heap_rate=config.heap_rate)
+    except KeyboardInterrupt:
+        nof_heaps, elapsed = generator.nof_heaps, None
+    generator.close()
+
+    logging.info("Sent {} heaps, {} packets ({} lost, {} reordered, {} duplicated)".format(
+        nof_heaps, generator.nof_packets, generator.nof_lost_packets, generator.nof_reordered_packets,
+        generator.nof_duplicate_packets))
+    if elapsed:
+        logging.info("Sent {:.1f} packets/s, {:.3f} Gb/s".format(
+            generator.nof_packets / elapsed, generator.nof_packets * generator.packet_size * 8 / elapsed / 1e9))
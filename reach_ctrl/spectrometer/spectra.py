@@ -1,25 +1,81 @@
 from __future__ import division
-from builtins import hex
-from builtins import str
 from builtins import range
 from builtins import object
-from past.utils import old_div
 import numpy as np
 import threading
 import logging
 import socket
-import struct
+import queue
+import time
+
+from reach_ctrl.spectrometer.batch_receiver import BatchReceiver, SO_RXQ_OVFL
+from reach_ctrl.spectrometer.capture import CaptureProcess
+from reach_ctrl.spectrometer.reassembler import HeapReassembler
+from reach_ctrl.spectrometer import telemetry
+from reach_ctrl.spectrometer import spead
+
+
+def reverse_bits(channels, nof_bits):
+    """ Reverse the bits of an array of channel indices
+    @param channels: Channel indices
+    @param nof_bits: Number of bits in a channel index """
+    result = np.zeros_like(channels)
+    for n in range(nof_bits):
+        result |= ((channels >> n) & 1) << (nof_bits - n - 1)
+    return result
+
+
+def compute_reorder_index(nof_signals, nof_channels, floating_point=True):
+    """ Compute the gather index which converts the reassembled buffer (FPGA, multiplexed channels)
+    to the final (signal, channel) order. Demultiplexing, descrambling and bit reversal are all
+    permutations, so they are applied once to an index array rather than to every spectrum
+    @param nof_signals: Number of signals, split equally between two FPGAs
+    @param nof_channels: Number of frequency channels per signal
+    @param floating_point: Channels are bit reversed in floating point mode """
+
+    # Flat index of every sample in the reassembled buffer, one row per FPGA
+    nof_fpgas = 2
+    nof_signals_per_fpga = nof_signals // nof_fpgas
+    index = np.arange(nof_signals * nof_channels).reshape(nof_fpgas, -1)
+
+    # De-multiplex: signal s of FPGA b is every nof_signals_per_fpga-th sample starting at s
+    index = index.reshape(nof_fpgas, nof_channels, nof_signals_per_fpga)
+    index = index.transpose(0, 2, 1).reshape(nof_signals, nof_channels)
+
+    # Descramble: even channels map to the lower half of the band, odd channels to the upper half
+    if nof_signals_per_fpga != 1:
+        index = np.concatenate((index[:, 0::2], index[:, 1::2]), axis=1)
+
+    # Reverse bits if use floating point
+    if floating_point:
+        index = index[:, reverse_bits(np.arange(nof_channels), int(np.log2(nof_channels)))]
+
+    return np.ascontiguousarray(index)
 
 
 class Spectra(object):
     """ REACH spectrometer data receiver """
 
-    def __init__(self, ip, port=4660, nof_signals=2, nof_channels=16384, floating_point=True):
+    def __init__(self, ip, port=4660, nof_signals=2, nof_channels=16384, floating_point=True,
+                 batch_receive=False, batch_size=256, capture_process=False, nof_ring_slots=32,
+                 nof_inflight_heaps=4, heap_timeout=2, emit_partial_heaps=True):
         """ Class constructor:
         @param ip: IP address to bind receiver to 
-        @param port: Port to receive data on """
-
-        # Initialise parameters
+        @param port: Port to receive data on
+        @param batch_receive: Receive multiple packets per system call (recvmmsg), if available
+        @param batch_size: Maximum number of packets received and decoded together
+        @param capture_process: Receive and assemble heaps in a separate process
+        @param nof_ring_slots: Number of heaps in the shared memory ring used by the capture process
+        @param nof_inflight_heaps: Maximum number of heaps being reassembled at the same time
+        @param heap_timeout: Time in seconds after which an incomplete heap is returned (or dropped)
+        @param emit_partial_heaps: Return incomplete heaps, with missing channels marked in valid_mask. Missing
+                                   channels are left out of accumulations """
+
+        # Initialise parameters. Receiver parameters are kept to create the receiver in a capture process
+        self._parameters = {'ip': ip, 'port': port, 'nof_signals': nof_signals, 'nof_channels': nof_channels,
+                            'floating_point': floating_point, 'batch_receive': batch_receive,
+                            'batch_size': batch_size, 'nof_inflight_heaps': nof_inflight_heaps,
+                            'heap_timeout': heap_timeout, 'emit_partial_heaps': emit_partial_heaps}
         self._use_floating_point = floating_point
         self._nof_signals_per_fpga = nof_signals // 2
         self._nof_channels = nof_channels
@@ -29,232 +85,578 @@ class Spectra(object):
 
         # Create socket reference
         self._socket = None
+        self._socket_timeout = 2
 
-        # Spectra containers
-        data_type = np.double if self._use_floating_point else np.uint64
-        self._data_reassembled = np.zeros((2, self._nof_signals_per_fpga * self._nof_channels), dtype=data_type)
-        self._data_buffer = np.zeros((self._nof_signals, self._nof_channels), dtype=data_type)
-        self._data_temporary_buffer = np.zeros((self._nof_signals, self._nof_channels), dtype=data_type)
-
-        # Packet header content 
-        self._packet_counter = 0
-        self._logical_channel_id = 0
-        self._payload_length = 0
-        self._sync_time = 0
-        self._timestamp = 0
-        self._lmc_mode = 0
-        self._start_channel_id = 0
-        self._start_antenna_id = 0
-        self._buffer_id = 0
-        self._offset = 9 * 8
+        # Batched receiver
+        self._use_batch_receive = batch_receive
+        self._batch_size = batch_size
+        self._batch_receiver = None
+
+        # Capture process
+        self._use_capture_process = capture_process
+        self._nof_ring_slots = nof_ring_slots
+        self._capture_process = None
+
+        # Packets received in the last receive call, their decoded headers and the next packet to process
+        self._batch_packets = None
+        self._batch_headers = None
+        self._batch_valid = None
+        self._batch_nof_packets = 0
+        self._batch_index = 0
 
         # Payload data parameters
         self._data_width = 64
         self._data_byte = self._data_width // 8
         self._bytes_per_packet = 1024
         self._words_per_packet = self._bytes_per_packet // self._data_width
-        self._expected_nof_packets = (self._nof_signals * self._nof_channels * self._data_byte) // self._bytes_per_packet
 
-        # Book keeping
-        self._received_packets = 0
-        self._previous_timestamp = 0
+        # Channels of one signal per packet, as packets hold the multiplexed signals of an FPGA
+        self._channels_per_packet = self._bytes_per_packet // self._data_byte // self._nof_signals_per_fpga
+
+        # Heap reassembler, with one row per FPGA
+        data_type = self.data_type
+        self._emit_partial_heaps = emit_partial_heaps
+        self._reassembler = HeapReassembler(2, self._nof_signals_per_fpga * self._nof_channels,
+                                            self._bytes_per_packet // self._data_byte, data_type,
+                                            nof_heaps=nof_inflight_heaps, timeout=heap_timeout)
+        self._expected_nof_packets = self._reassembler.expected_nof_packets
+
+        # Receiver telemetry. Counters are cumulative, and the values at the last heap are kept to compute
+        # per-heap statistics
+        self._telemetry = telemetry.ReceiverTelemetry()
+        self._heap_statistics = np.zeros(1, dtype=telemetry.heap_statistics_dtype)
+        self._monitor_kernel_drops = False
+        self._kernel_drops = 0
+        self._last_counters = (0, 0, 0, 0, 0)
+        self._nof_invalid_packets = 0
+        self._nof_dropped_incomplete_heaps = 0
+
+        # Spectra containers
+        self._data_buffer = np.zeros((self._nof_signals, self._nof_channels), dtype=data_type)
+        self._data_valid = np.zeros((self._nof_signals, self._nof_channels), dtype=bool)
+
+        # Preallocated packet buffers and little-endian view type for payloads
+        self._packet_buffer = np.zeros((batch_size, 9000), dtype=np.uint8)
+        self._packet_lengths = np.zeros(batch_size, dtype=np.int64)
+        self._payload_type = np.dtype(data_type).newbyteorder('<')
+
+        # Gather index which maps the reassembled buffer to demuxed, descrambled and bit-reversed output,
+        # and the index of the packet which contains each output value
+        self._reorder_index = self._compute_reorder_index()
+        self._reorder_packet_index = self._reorder_index // (self._bytes_per_packet // self._data_byte)
+
+        # Payload offset within packet
+        self._offset = spead.HEADER_LENGTH
 
         # Received spectra placeholder
         self._receiver_thread = None
         self._received_spectra = None
         self._received_timestamps = None
+        self._received_sum_of_squares = None
+        self._received_channel_count = None
+        self._received_heap_statistics = None
+        self._received_count = 0
+        self._accumulate = False
+        self._squared_buffer = np.zeros((self._nof_signals, self._nof_channels))
+
+        # Persistent receiver
+        self._persistent_thread = None
+        self._persistent_stop = threading.Event()
+        self._spectra_queue = None
+        self._pending_request = None
+        self._nof_queue_overflows = 0
+
+    @property
+    def data_type(self):
+        """ Data type of received spectra """
+        return np.double if self._use_floating_point else np.uint64
+
+    @property
+    def telemetry(self):
+        """ Receiver telemetry """
+        return self._telemetry
+
+    @property
+    def heap_statistics(self):
+        """ Statistics of the last returned heap (telemetry.heap_statistics_dtype) """
+        return self._heap_statistics[0]
+
+    @property
+    def valid_mask(self):
+        """ Mask of the values received in the last returned spectrum (False where packets were lost) """
+        return self._data_valid
+
+    @property
+    def nof_queue_overflows(self):
+        """ Number of spectra dropped by the persistent receiver because its queue was full """
+        return self._nof_queue_overflows
 
     def initialise(self):
         """ Initilise socket and set local buffers """
+
+        # If using a capture process, start it. The socket is created in the capture process
+        if self._use_capture_process:
+            self._capture_process = CaptureProcess(self._parameters, self._nof_ring_slots)
+            self._capture_process.start()
+            return
+
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._socket.bind((self._ip, self._port))
-        self._socket.settimeout(2)
+        self._socket.settimeout(self._socket_timeout)
         self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 2 * 1024 * 1024)
 
-    def receive_spectrum(self):
-        """ Wait for a spead packet to arrive """
-
-        # Clear receiver 
-        self._clear_receiver()
+        # Request the number of packets dropped by the kernel with received packets, if supported
+        try:
+            self._socket.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+            self._monitor_kernel_drops = hasattr(self._socket, 'recvmsg_into')
+        except (socket.error, AttributeError):
+            logging.warning("Kernel packet drop monitoring not available")
+
+        # Use batched receiver if requested and supported, otherwise fall back to per-packet receive
+        if self._use_batch_receive:
+            if BatchReceiver.available():
+                self._batch_receiver = BatchReceiver(self._socket, nof_slots=self._batch_size)
+            else:
+                logging.warning("Batched packet receive not available, falling back to per-packet receive")
+
+    def close(self):
+        """ Stop persistent receiver and capture process, if any, and close socket """
+        self.stop_persistent_receiver()
+
+        if self._capture_process is not None:
+            self._capture_process.stop()
+            self._capture_process = None
+
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def receive_spectrum(self, stop_event=None):
+        """ Wait for a spead packet to arrive
+        @param stop_event: Optional event which stops the receiver, checked before receiving packets
+        @return: Timestamp and spectrum, or None if stopped """
+
+        # If using a capture process, get next heap from shared memory ring
+        if self._capture_process is not None:
+            heap = self._capture_process.read_heap(stop_event=stop_event, spectrum=self._data_buffer,
+                                                   valid_mask=self._data_valid)
+            if heap is None:
+                return None
+            timestamp, _, _, self._heap_statistics[0] = heap
+            self._telemetry.add_heap(self._heap_statistics[0], self._data_valid)
+            return timestamp, self._data_buffer
 
         # Check if receiver has been initialised
         if self._socket is None:
             logging.error("Spectrum receiver not initialised")
             return
 
+        # Return any heap which was completed while receiving the previous one
+        spectrum = self._pop_spectrum()
+        if spectrum is not None:
+            return spectrum
+
         # Loop until required to stop
         while True:
-            # Try to acquire packet
-            try:
-                packet, _ = self._socket.recvfrom(9000)
-            except socket.timeout:
-                logging.info("Socket timeout")
-                continue
-
-            # We have a packet, check if it is a valid packet
-            if not self._decode_spead_header(packet):
-                continue
-
-            # Valid packet, extract payload and add to buffer
-            unpack_type = 'd' if self._use_floating_point else 'q'
-            payload = struct.unpack('<' + unpack_type * (self._payload_length // 8), packet[self._offset:])
-            self._add_packet_to_buffer(payload)
+            # If all received packets have been processed, receive new ones
+            if self._batch_index == self._batch_nof_packets:
+                if stop_event is not None and stop_event.is_set():
+                    return None
+
+                try:
+                    self._receive_packets()
+                except socket.timeout:
+                    logging.info("Socket timeout")
+
+                    # Heaps in flight might have timed out
+                    spectrum = self._pop_spectrum()
+                    if spectrum is not None:
+                        return spectrum
+                    continue
+
+            # Process received packets
+            while self._batch_index < self._batch_nof_packets:
+                i = self._batch_index
+                self._batch_index += 1
+
+                if not self._batch_valid[i]:
+                    continue
+
+                # Valid packet, view payload in place and add to buffer
+                header = self._batch_headers[i]
+                payload = self._batch_packets[i, self._offset:self._offset + header['payload_length']]
+                self._add_packet_to_buffer(header, payload.view(self._payload_type))
+
+                # If a heap is ready, finalize it
+                spectrum = self._pop_spectrum()
+                if spectrum is not None:
+                    return spectrum
+
+    def _pop_spectrum(self):
+        """ Finalise the next heap which is ready in the reassembler, if any
+        @return: Timestamp and spectrum, or None if no heap is ready """
 
-            # If the buffer is full, finalize packet buffer
-            if self._detect_full_buffer():
-                self._finalise_buffer()
-                return self._sync_time + self._timestamp * 32768 * 2.5e-9, self._data_buffer
+        while True:
+            heap = self._reassembler.pop_heap()
+            if heap is None:
+                return None
+
+            if heap.complete or self._emit_partial_heaps:
+                timestamp = spead.heap_time(heap.header)
+                self._update_heap_statistics(timestamp, heap)
+                self._finalise_buffer(heap)
+                self._telemetry.add_heap(self._heap_statistics[0], self._data_valid)
+                return timestamp, self._data_buffer
+
+            self._nof_dropped_incomplete_heaps += 1
+            logging.warning("Dropped incomplete heap ({} of {} packets)".format(
+                np.count_nonzero(heap.packet_mask), self._expected_nof_packets))
+
+    def _update_heap_statistics(self, timestamp, heap):
+        """ Compute the statistics of a heap returned by the reassembler
+        @param timestamp: Heap timestamp
+        @param heap: Reassembled heap """
+
+        # Counters are cumulative, take the difference since the previous heap
+        counters = (self._reassembler.nof_late_packets, self._reassembler.nof_duplicate_packets,
+                    self._reassembler.nof_invalid_packets + self._nof_invalid_packets,
+                    self._reassembler.nof_dropped_heaps, self._kernel_drops)
+        late, duplicate, invalid, dropped, kernel_drops = [current - previous for current, previous
+                                                           in zip(counters, self._last_counters)]
+        self._last_counters = counters
+
+        # Incomplete heaps dropped since the previous heap are included in the dropped heap count
+        dropped += self._nof_dropped_incomplete_heaps
+        self._nof_dropped_incomplete_heaps = 0
+
+        self._heap_statistics[0] = (timestamp, self._expected_nof_packets, np.count_nonzero(heap.packet_mask),
+                                    late, duplicate, invalid, kernel_drops, dropped)
+
+    def _receive_packets(self):
+        """ Receive the next packet, or batch of packets if the batched receiver is used, and decode
+        their headers. Packets which follow a completed heap are kept for the next call to receive_spectrum """
+
+        if self._batch_receiver is not None:
+            nof_packets = self._batch_receiver.receive()
+            packets = self._batch_receiver.slots[:nof_packets]
+            lengths = self._batch_receiver.lengths[:nof_packets]
+            self._kernel_drops = self._batch_receiver.kernel_drops
+        else:
+            nof_packets = self._receive_queued_packets()
+            packets = self._packet_buffer[:nof_packets]
+            lengths = self._packet_lengths[:nof_packets]
+
+        # Decode headers and check whether packets are valid
+        headers, valid = spead.decode_spead_headers(packets, lengths, self._bytes_per_packet, self._nof_channels,
+                                                    self._channels_per_packet, self._nof_signals)
+        spead.log_header_errors(headers, valid)
+
+        # Check whether packets are floating point and how the spectra receiver is programmed
+        floating_point = (headers['flags'] & spead.FLAG_FLOATING_POINT) != 0
+        mismatch = valid & (floating_point != self._use_floating_point)
+        if np.any(mismatch):
+            logging.error("Firmware and spectra floating point settings do not match (sw: {})".format(
+                "on" if self._use_floating_point else "off"))
+            valid &= ~mismatch
+
+        # Packets rejected here are counted with the packets rejected by the reassembler
+        self._nof_invalid_packets += int(nof_packets - np.count_nonzero(valid))
+
+        self._batch_packets = packets
+        self._batch_headers = headers
+        self._batch_valid = valid
+        self._batch_nof_packets = nof_packets
+        self._batch_index = 0
+
+    def _receive_queued_packets(self):
+        """ Wait for a packet, then receive any other packets already queued on the socket without
+        blocking, so that their headers can be decoded together
+        @return: Number of received packets """
+
+        # The first packet is received with its ancillary data, which contains the kernel drop counter
+        if self._monitor_kernel_drops:
+            nof_bytes, ancillary_data, _, _ = self._socket.recvmsg_into([self._packet_buffer[0]],
+                                                                        socket.CMSG_SPACE(4))
+            for level, option, data in ancillary_data:
+                if level == socket.SOL_SOCKET and option == SO_RXQ_OVFL and len(data) >= 4:
+                    self._kernel_drops = int(np.frombuffer(data[:4], dtype=np.uint32)[0])
+            self._packet_lengths[0] = nof_bytes
+        else:
+            self._packet_lengths[0] = self._socket.recv_into(self._packet_buffer[0])
 
-    def _receive_spectra_threaded(self, nof_spectra=1):
-        """ Receive specified number of thread, should run in a separate thread """
+        nof_packets = 1
+        self._socket.settimeout(0)
+        try:
+            while nof_packets < self._packet_buffer.shape[0]:
+                self._packet_lengths[nof_packets] = self._socket.recv_into(self._packet_buffer[nof_packets])
+                nof_packets += 1
+        except socket.error:
+            pass
+        finally:
+            self._socket.settimeout(self._socket_timeout)
+
+        return nof_packets
+
+    def _start_accumulation(self, nof_spectra, accumulate, sum_of_squares):
+        """ Prepare containers for received spectra
+        @param nof_spectra: Number of spectra to receive
+        @param accumulate: Add spectra to a running sum rather than storing each one
+        @param sum_of_squares: Also accumulate the sum of squared spectra (accumulate mode only) """
 
-        self._received_spectra = np.zeros((nof_spectra, self._nof_signals, self._nof_channels))
         self._received_timestamps = np.zeros((nof_spectra))
-        for i in range(nof_spectra):
-            self._received_timestamps[i], self._received_spectra[i] = self.receive_spectrum()
+        self._received_channel_count = np.zeros((self._nof_signals, self._nof_channels), dtype=np.int64)
+        self._received_heap_statistics = np.zeros(nof_spectra, dtype=telemetry.heap_statistics_dtype)
+        self._received_count = 0
+        self._accumulate = accumulate
+        self._telemetry.start_acquisition()
+
+        # In accumulate mode memory does not depend on the number of spectra
+        if accumulate:
+            self._received_spectra = np.zeros((self._nof_signals, self._nof_channels))
+            self._received_sum_of_squares = np.zeros_like(self._received_spectra) if sum_of_squares else None
+        else:
+            self._received_spectra = np.zeros((nof_spectra, self._nof_signals, self._nof_channels))
+            self._received_sum_of_squares = None
+
+    def _add_to_accumulation(self, timestamp, spectrum, valid_mask, statistics):
+        """ Add a received spectrum to the current accumulation
+        @param timestamp: Spectrum timestamp
+        @param spectrum: Spectrum
+        @param valid_mask: Mask of received values in spectrum
+        @param statistics: Heap statistics """
+
+        i = self._received_count
+        self._received_timestamps[i] = timestamp
+        if not self._accumulate:
+            self._received_spectra[i] = spectrum
+        else:
+            # Values lost with their packets are zero, so only received values are accumulated
+            np.add(self._received_spectra, spectrum, out=self._received_spectra, where=valid_mask)
+            if self._received_sum_of_squares is not None:
+                np.multiply(spectrum, spectrum, out=self._squared_buffer)
+                np.add(self._received_sum_of_squares, self._squared_buffer, out=self._received_sum_of_squares,
+                       where=valid_mask)
+
+        self._received_channel_count += valid_mask
+        self._received_heap_statistics[i] = statistics
+        self._telemetry.add_to_acquisition(statistics)
+        self._received_count += 1
+
+    def _finish_accumulation(self):
+        """ Get the received spectra, trimmed to the number of spectra actually received. In accumulate mode,
+        channels which were not received in every spectrum are scaled by the number of spectra over the
+        number of values received, so that partial heaps do not bias the sum. Channels which were never
+        received are zero (see get_accumulation_statistics)
+        @return: Timestamps and spectra """
+        if self._accumulate:
+            partial = self._received_channel_count != self._received_count
+            if np.any(partial):
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    scale = np.where(self._received_channel_count > 0,
+                                     self._received_count / self._received_channel_count, 0)
+                self._received_spectra[partial] *= scale[partial]
+                if self._received_sum_of_squares is not None:
+                    self._received_sum_of_squares[partial] *= scale[partial]
+            return self._received_timestamps[:self._received_count], self._received_spectra
+        return self._received_timestamps[:self._received_count], self._received_spectra[:self._received_count]
+
+    def _receive_spectra_threaded(self, nof_spectra=1, start_time=None):
+        """ Receive specified number of thread, should run in a separate thread
+        @param nof_spectra: Number of spectra to receive
+        @param start_time: Skip heaps with a timestamp earlier than this time """
+
+        while self._received_count < nof_spectra:
+            heap = self.receive_spectrum()
+            if heap is None:
+                logging.error("Spectra receiver stopped after {} of {} spectra".format(self._received_count,
+                                                                                        nof_spectra))
+                break
+            if start_time is not None and heap[0] < start_time:
+                continue
+            self._add_to_accumulation(heap[0], heap[1], self._data_valid, self.heap_statistics)
+
+    def start_receiver(self, nof_spectra, accumulate=False, sum_of_squares=False, start_time=None):
+        """ Receive specified number of spectra. With the persistent receiver, spectra queued since the previous
+        acquisition are used, so back-to-back acquisitions have no dead time
+        @param nof_spectra: Number of spectra to receive
+        @param accumulate: Return the sum of the received spectra rather than every spectrum
+        @param sum_of_squares: Also accumulate the sum of squared spectra (accumulate mode only)
+        @param start_time: Only use heaps with a timestamp at or after this UNIX time, for instance the time at
+                           which the input was switched. None to use any heap """
+
+        # If the persistent receiver is running, spectra are read from its queue in wait_for_receiver
+        if self._persistent_thread is not None:
+            self._pending_request = (nof_spectra, accumulate, sum_of_squares, start_time)
+            return
 
-    def start_receiver(self, nof_spectra):
-        """ Receive specified number of spectra """
+        self._start_accumulation(nof_spectra, accumulate, sum_of_squares)
+
+        # Only return heaps captured from now on
+        if self._capture_process is not None:
+            self._capture_process.skip_to_latest()
+        else:
+            self._clear_receiver()
 
         # Create and start thread and wait for it to stop
-        self._receiver_thread = threading.Thread(target=self._receive_spectra_threaded, args=(nof_spectra,))
+        self._receiver_thread = threading.Thread(target=self._receive_spectra_threaded,
+                                                 args=(nof_spectra, start_time))
         self._receiver_thread.start()
 
     def wait_for_receiver(self):
         """ Wait for receiver to finish """
+
+        # Persistent receiver, get requested spectra from queue
+        if self._pending_request is not None:
+            nof_spectra, accumulate, sum_of_squares, start_time = self._pending_request
+            self._pending_request = None
+            return self.get(nof_spectra, accumulate=accumulate, sum_of_squares=sum_of_squares,
+                            start_time=start_time)
+
         if self._receiver_thread is None:
             logging.error("Receiver not started")
 
         self._receiver_thread.join()
 
         # Return result
-        return self._received_timestamps, self._received_spectra
+        return self._finish_accumulation()
 
-    def _decode_spead_header(self, packet):
-        """ Decode SPEAD packet header 
-        @param: Received packet header """
+    def start_persistent_receiver(self, queue_size=64):
+        """ Start a receiver which runs until stopped, placing spectra in a bounded queue. Spectra which arrive
+        between calls to get or iter_spectra are kept, so back-to-back acquisitions have no dead time
+        @param queue_size: Maximum number of queued spectra. When full, the oldest spectrum is dropped """
 
-        # Flag specifying whether packet is a valid SPEAD packet
-        valid_packet = False
+        if self._persistent_thread is not None:
+            logging.warning("Persistent receiver already running")
+            return
 
-        # Unpack SPEAD header items
-        try:
-            items = struct.unpack('>' + 'Q' * 9, packet[0:8 * 9])
-        except:
-            logging.error("Error processing packet")
-            return False
-
-        # Process all spead items
-        for idx in range(len(items)):
-            spead_item = items[idx]
-            spead_id = spead_item >> 48
-            val = spead_item & 0x0000FFFFFFFFFFFF
-            if spead_id == 0x5304 and idx == 0:
-                valid_packet = True
-            elif spead_id == 0x8001:
-                heap_counter = val
-                self._packet_counter = heap_counter & 0xFFFFFF
-                self._logical_channel_id = heap_counter >> 24
-            elif spead_id == 0x8004:
-                self._payload_length = val
-            elif spead_id == 0x9027:
-                self._sync_time = val
-            elif spead_id == 0x9600:
-                self._timestamp = val
-            elif spead_id == 0xA004:
-                self._lmc_mode = val & 0xEF
-                # Check whether packet is floating point and how the spectra receiver is programmed
-                if not ((val >> 7) & 0x1 and self._use_floating_point):
-                    logging.error("Firmware and spectra floating point settings do not match (firmware: {}, sw: {})".format(
-                        "on" if (val >> 7) & 0x1 else "off",
-                        "on" if self._use_floating_point else "off"))
-                    return
-            elif spead_id == 0xA002:
-                self._start_channel_id = (val & 0x000000FFFF000000) >> 24
-                self._start_antenna_id = (val & 0x000000000000FF00) >> 8
-            elif spead_id == 0xA003 or spead_id == 0xA001:
-                self._buffer_id = (val & 0xFFFFFFFF) >> 16
-            elif spead_id == 0x3300:
-                pass
-            else:
-                logging.error("Error in SPEAD header decoding!")
-                logging.error("Unexpected item {} at position {}".format(hex(spead_item), " at position " + str(idx)))
+        self._spectra_queue = queue.Queue(maxsize=queue_size)
+        self._persistent_stop.clear()
+        self._nof_queue_overflows = 0
+
+        if self._capture_process is not None:
+            self._capture_process.skip_to_latest()
+        else:
+            self._clear_receiver()
 
-        return valid_packet
+        self._persistent_thread = threading.Thread(target=self._persistent_receive, name="spectra_receiver")
+        self._persistent_thread.daemon = True
+        self._persistent_thread.start()
 
-    def _add_packet_to_buffer(self, data):
-        """ Add packet content to buffer """
-        index = self._start_channel_id * self._nof_signals_per_fpga
-        self._data_reassembled[self._start_antenna_id // self._nof_signals_per_fpga,
-                               index:index + self._payload_length // self._data_byte] = data
-        self._received_packets += 1
+    def stop_persistent_receiver(self):
+        """ Stop the persistent receiver """
+        if self._persistent_thread is None:
+            return
 
-    def _finalise_buffer(self):
-        """ Demux and descramble buffer for persisting """
+        self._persistent_stop.set()
+        self._persistent_thread.join()
+        self._persistent_thread = None
+        self._pending_request = None
 
-        # De-multiplex buffer
-        if self._nof_signals_per_fpga == 1:
-            self._data_temporary_buffer[:] = self._data_reassembled
-        else:
-            for b in range(self._nof_signals_per_fpga):
-                for n in range(self._nof_signals_per_fpga * self._nof_channels):
-                    self._data_temporary_buffer[(n % self._nof_signals_per_fpga) + self._nof_signals_per_fpga * b,
-                                                n // self._nof_signals_per_fpga] = self._data_reassembled[b, n]
-
-        # Descramble buffer
-        if self._nof_signals_per_fpga != 1:
-            for b in range(self._nof_signals):
-                for n in range(self._nof_channels):
-                    if n % 2 == 0:
-                        channel = old_div(n, 2)
-                    else:
-                        channel = old_div(n, 2) + self._nof_channels // 2
-                    self._data_buffer[b, channel] = self._data_temporary_buffer[b, n]
-        else:
-            self._data_buffer[:] = self._data_temporary_buffer
-
-        # Reverse bits if use floating point
-        if self._use_floating_point:
-            self._data_temporary_buffer[:] = 0
-            for b in range(self._nof_signals):
-                for n in range(self._nof_channels):
-                    # Perform reversal
-                    channel = self._reverse_bit(n)
-                    self._data_temporary_buffer[:][b, channel] = self._data_buffer[b, n]
-
-            # Copy final buffer
-            self._data_buffer[:] = self._data_temporary_buffer
-
-    def _reverse_bit(self, num):
-        step = int(np.log2(self._nof_channels))
-        result = 0
-        for n in range(step):
-            result += (num & 1) << (step - n - 1)
-            num >>= 1
-        return result
-
-    def _detect_full_buffer(self):
-        """ Check whether we have a full buffer """
-        # Timestamp check
-        if self._previous_timestamp != self._timestamp:
-            self._received_packets = 1
-            self._previous_timestamp = self._timestamp
-
-        # If number of received packets is the expected number, return True, otherwise False
-        if self._received_packets == self._expected_nof_packets:
-            self._received_packets = 0
-            return True
-        else:
-            return False
+    def _persistent_receive(self):
+        """ Persistent receiver thread, queues copies of received spectra until stopped """
+        while not self._persistent_stop.is_set():
+            heap = self.receive_spectrum(self._persistent_stop)
+            if heap is None:
+                continue
+
+            item = (heap[0], heap[1].copy(), self._data_valid.copy(), self.heap_statistics.copy())
+            try:
+                self._spectra_queue.put_nowait(item)
+            except queue.Full:
+                # Consumer is not keeping up, drop the oldest spectrum
+                try:
+                    self._spectra_queue.get_nowait()
+                except queue.Empty:
+                    pass
+                self._spectra_queue.put_nowait(item)
+                self._nof_queue_overflows += 1
+                logging.warning("Spectra queue full, dropped oldest spectrum")
+
+    def get(self, nof_spectra=1, timeout=None, accumulate=False, sum_of_squares=False, start_time=None):
+        """ Get the next spectra from the persistent receiver
+        @param nof_spectra: Number of spectra to get
+        @param timeout: Maximum time to wait in seconds, None to wait indefinitely
+        @param accumulate: Return the sum of the spectra rather than every spectrum
+        @param sum_of_squares: Also accumulate the sum of squared spectra (accumulate mode only)
+        @param start_time: Skip queued spectra with a timestamp earlier than this UNIX time
+        @return: Timestamps and spectra (fewer than requested on timeout), as returned by wait_for_receiver """
+
+        if self._persistent_thread is None:
+            logging.error("Persistent receiver not started")
+            return None
+
+        self._start_accumulation(nof_spectra, accumulate, sum_of_squares)
+
+        deadline = None if timeout is None else time.time() + timeout
+        while self._received_count < nof_spectra:
+            try:
+                item = self._spectra_queue.get(timeout=None if deadline is None else max(0, deadline - time.time()))
+            except queue.Empty:
+                logging.warning("Timed out after receiving {} of {} spectra".format(self._received_count,
+                                                                                    nof_spectra))
+                break
+            if start_time is not None and item[0] < start_time:
+                continue
+            self._add_to_accumulation(*item)
+
+        return self._finish_accumulation()
+
+    def iter_spectra(self, timeout=None):
+        """ Iterate over spectra from the persistent receiver
+        @param timeout: Stop iterating if no spectrum is received for this number of seconds
+        @return: Generator of timestamp, spectrum and valid mask tuples """
+
+        if self._persistent_thread is None:
+            logging.error("Persistent receiver not started")
+            return
+
+        while self._persistent_thread is not None:
+            try:
+                timestamp, spectrum, valid_mask, _ = self._spectra_queue.get(timeout=timeout)
+            except queue.Empty:
+                return
+            yield timestamp, spectrum, valid_mask
+
+    def get_acquisition_telemetry(self):
+        """ Get receiver statistics summed over the last acquisition (telemetry.acquisition_statistics_dtype) """
+        return self._telemetry.get_acquisition_statistics()
+
+    def get_heap_statistics(self):
+        """ Get the statistics of every heap in the last acquisition (telemetry.heap_statistics_dtype) """
+        return self._received_heap_statistics[:self._received_count].copy()
+
+    def get_accumulation_statistics(self):
+        """ Get statistics of the last accumulation
+        @return: Number of accumulated spectra, sum of squared spectra (None if not computed) and number
+                 of received values per signal and channel (lower than the number of spectra if packets were lost,
+                 in which case the accumulated values of the channel were scaled up to the number of spectra) """
+        return self._received_count, self._received_sum_of_squares, self._received_channel_count
+
+    def _add_packet_to_buffer(self, header, data):
+        """ Add packet content to buffer
+        @param header: Decoded packet header
+        @param data: Packet payload """
+        self._reassembler.add_packet(header,
+                                     header['start_antenna_id'] // self._nof_signals_per_fpga,
+                                     header['start_channel_id'] * self._nof_signals_per_fpga,
+                                     data)
+
+    def _compute_reorder_index(self):
+        """ Compute the gather index which converts the reassembled buffer to (signal, channel) order """
+        return compute_reorder_index(self._nof_signals, self._nof_channels, self._use_floating_point)
+
+    def _finalise_buffer(self, heap):
+        """ Demux and descramble heap for persisting
+        @param heap: Reassembled heap """
+        np.take(heap.data, self._reorder_index, out=self._data_buffer)
+        np.take(heap.packet_mask, self._reorder_packet_index, out=self._data_valid)
 
     def _clear_receiver(self):
-        """ Reset receiver  """
-        self._received_packets = 0
-        self._previous_timestamp = 0
+        """ Reset receiver. Heaps in flight, and the rest of the heap currently being received, are discarded """
+        self._reassembler.reset(skip_in_progress=True)
 
         self._data_buffer[:] = 0
-        self._data_reassembled[:] = 0
-        self._data_temporary_buffer[:] = 0
+        self._data_valid[:] = False
 
 
 if __name__ == "__main__":
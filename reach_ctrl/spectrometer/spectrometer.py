@@ -1,13 +1,13 @@
 #! /usr/bin/env python
 
 from builtins import object
-import numpy as np
 import logging
 import time
 import os
 
 from reach_ctrl.spectrometer.tile_reach import Tile
 from reach_ctrl.spectrometer.spectra import Spectra
+from reach_ctrl.spectrometer import telemetry
 from reach_ctrl.reach_config import REACHConfig
 
 __author__ = 'Alessio Magro'
@@ -15,8 +15,11 @@ __author__ = 'Alessio Magro'
 
 class Spectrometer(object):
 
-    def __init__(self, ip, port, lmc_ip, lmc_port, enable_spectra=True, sampling_rate=800e6):
-        """ Class which interfaces with TPM and spectrometer firmware """
+    def __init__(self, ip, port, lmc_ip, lmc_port, enable_spectra=True, sampling_rate=800e6,
+                 persistent_receiver=False):
+        """ Class which interfaces with TPM and spectrometer firmware
+        @param persistent_receiver: Keep receiving spectra between acquisitions, so that consecutive
+                                    acquisitions have no dead time """
 
         # Create Tile
         self._tile = Tile(ip=ip, port=port, lmc_ip=lmc_ip, lmc_port=lmc_port, sampling_rate=sampling_rate)
@@ -26,6 +29,8 @@ class Spectrometer(object):
         if enable_spectra:
             self._spectra = Spectra(ip=lmc_ip, port=lmc_port)
             self._spectra.initialise()
+            if persistent_receiver:
+                self._spectra.start_persistent_receiver()
 
     def connect(self):
         """ Connect to TPM """
@@ -85,30 +90,68 @@ class Spectrometer(object):
         self._tile['fpga2.dsp_regfile.channelizer_fft_bit_round'] = channel_scaling
         self._tile['board.regfile.ethernet_pause'] = 8000
 
-    def acquire_spectrum(self, channel=0, nof_seconds=1):
-        """ Acquire spectra for defined number of seconds """
+    def acquire_spectrum(self, channel=0, nof_seconds=1, sum_of_squares=False, start_time=None):
+        """ Acquire spectra for defined number of seconds. Spectra are accumulated as they arrive. Frequency
+        channels lost with their packets are accumulated over the spectra in which they were received and scaled
+        to the number of spectra, see get_accumulation_statistics for the number of values received per channel
+        :param channel: Signal to return
+        :param nof_seconds: Number of spectra to accumulate
+        :param sum_of_squares: Also accumulate squared spectra, see get_accumulation_statistics
+        :param start_time: Only accumulate spectra with a timestamp at or after this UNIX time, None to use any
+                           spectrum (including spectra queued by a persistent receiver) """
 
         if self._spectra is None:
             logging.warning("Cannot acquire spectra. Acqusition not initialised")
             return None
 
         # Start receiver
-        self._spectra.start_receiver(nof_seconds)
+        self._spectra.start_receiver(nof_seconds, accumulate=True, sum_of_squares=sum_of_squares,
+                                     start_time=start_time)
 
         # TODO: Start data transmission
         # ...
 
         # Wait for receiver to finish
-        # Spectra will be received in spectra/signals/channel order
+        # Accumulated spectra will be received in signals/channel order
         timestamps, spectra = self._spectra.wait_for_receiver()
 
         # TODO: Stop data transmission 
         # ...
 
         # Return spectra
-        spectra = np.sum(spectra, axis=0)
         return timestamps, spectra[channel, :]
 
+    def get_accumulation_statistics(self, channel=0):
+        """ Get the number of spectra, the sum of squared spectra (if requested) and the number of values received
+        per frequency channel of the last acquisition
+        :param channel: Signal to return """
+        count, sum_of_squares, channel_count = self._spectra.get_accumulation_statistics()
+        if sum_of_squares is not None:
+            sum_of_squares = sum_of_squares[channel, :]
+        return count, sum_of_squares, channel_count[channel, :]
+
+    def get_missing_channels(self, channel=0):
+        """ Get the frequency channels which were lost in at least one spectrum of the last acquisition
+        :param channel: Signal to check
+        :return: List of (start channel, stop channel) ranges, stop channel is exclusive """
+        count, _, channel_count = self._spectra.get_accumulation_statistics()
+        return [(start, stop) for _, start, stop in
+                telemetry.missing_channel_ranges(channel_count[channel:channel + 1] == count)]
+
+    def get_heap_statistics(self):
+        """ Get the receiver statistics of every heap in the last acquisition, including per-heap packet loss
+        :return: Array of heap statistics records (telemetry.heap_statistics_dtype) """
+        if self._spectra is None:
+            return None
+        return self._spectra.get_heap_statistics()
+
+    def get_receiver_telemetry(self):
+        """ Get receiver statistics of the last acquisition and a summary of recent heaps
+        :return: Acquisition statistics record and rolling summary dictionary """
+        if self._spectra is None:
+            return None, None
+        return self._spectra.get_acquisition_telemetry(), self._spectra.telemetry.summary()
+
 
 if __name__ == "__main__":
 
@@ -0,0 +1,123 @@
+from builtins import range
+from builtins import object
+from collections import deque
+import numpy as np
+
+# Statistics of a single received heap
+heap_statistics_dtype = np.dtype([('timestamp', np.float64),
+                                  ('expected_packets', np.int64),
+                                  ('received_packets', np.int64),
+                                  ('late_packets', np.int64),
+                                  ('duplicate_packets', np.int64),
+                                  ('invalid_packets', np.int64),
+                                  ('kernel_drops', np.int64),
+                                  ('dropped_heaps', np.int64)])
+
+# Statistics summed over an acquisition, stored alongside each spectrum in observation files
+acquisition_statistics_dtype = np.dtype([('nof_heaps', np.int64),
+                                         ('incomplete_heaps', np.int64),
+                                         ('expected_packets', np.int64),
+                                         ('received_packets', np.int64),
+                                         ('late_packets', np.int64),
+                                         ('duplicate_packets', np.int64),
+                                         ('invalid_packets', np.int64),
+                                         ('kernel_drops', np.int64),
+                                         ('dropped_heaps', np.int64)])
+
+# Counters which are summed as they are
+_summed_fields = ['expected_packets', 'received_packets', 'late_packets', 'duplicate_packets',
+                  'invalid_packets', 'kernel_drops', 'dropped_heaps']
+
+
+def missing_channel_ranges(valid_mask):
+    """ Get the ranges of channels which were not received
+    :param valid_mask: Boolean mask of received values, in signal/channel order
+    :return: List of (signal, start channel, stop channel) tuples, stop channel is exclusive """
+
+    ranges = []
+    for signal in range(valid_mask.shape[0]):
+        # Find edges of runs of missing channels
+        missing = np.concatenate(([False], ~valid_mask[signal], [False]))
+        edges = np.flatnonzero(missing[1:] != missing[:-1])
+        ranges.extend((signal, int(start), int(stop)) for start, stop in zip(edges[0::2], edges[1::2]))
+
+    return ranges
+
+
+class ReceiverTelemetry(object):
+    """ Keeps per-heap receiver statistics, totals for the current acquisition and a rolling summary """
+
+    def __init__(self, window=64):
+        """ Class constructor
+        :param window: Number of heaps in the rolling summary """
+        self._history = deque(maxlen=window)
+        self._acquisition = np.zeros(1, dtype=acquisition_statistics_dtype)
+        self._missing_channels = []
+
+    def start_acquisition(self):
+        """ Reset acquisition totals """
+        self._acquisition[:] = 0
+
+    def add_heap(self, statistics, valid_mask=None):
+        """ Add the statistics of a received heap to the rolling summary
+        :param statistics: Heap statistics record (heap_statistics_dtype)
+        :param valid_mask: Mask of received values in heap """
+
+        self._history.append(statistics.copy())
+
+        # Missing channel ranges of the last heap
+        if valid_mask is not None and statistics['received_packets'] != statistics['expected_packets']:
+            self._missing_channels = missing_channel_ranges(valid_mask)
+        else:
+            self._missing_channels = []
+
+    def add_to_acquisition(self, statistics):
+        """ Add the statistics of a heap used in the current acquisition to the acquisition totals
+        :param statistics: Heap statistics record (heap_statistics_dtype) """
+
+        acquisition = self._acquisition[0]
+        acquisition['nof_heaps'] += 1
+        if statistics['received_packets'] != statistics['expected_packets']:
+            acquisition['incomplete_heaps'] += 1
+        for field in _summed_fields:
+            acquisition[field] += statistics[field]
+
+    @property
+    def last_heap(self):
+        """ Statistics of the last heap, or None if no heap was received """
+        return self._history[-1] if len(self._history) else None
+
+    @property
+    def missing_channels(self):
+        """ Missing channel ranges (signal, start, stop) of the last heap """
+        return self._missing_channels
+
+    def get_acquisition_statistics(self):
+        """ Get statistics totals since the start of the acquisition (acquisition_statistics_dtype) """
+        return self._acquisition[0].copy()
+
+    def summary(self):
+        """ Get a summary of the heaps in the rolling window
+        :return: Dictionary with heap and packet counts, loss fraction and rates per second """
+
+        summary = {'nof_heaps': len(self._history)}
+        if len(self._history) == 0:
+            return summary
+
+        history = np.array(list(self._history), dtype=heap_statistics_dtype)
+        expected = int(np.sum(history['expected_packets']))
+        received = int(np.sum(history['received_packets']))
+        summary['incomplete_heaps'] = int(np.count_nonzero(history['received_packets'] !=
+                                                           history['expected_packets']))
+        summary['expected_packets'] = expected
+        summary['received_packets'] = received
+        summary['packet_loss'] = (expected - received) / float(expected) if expected else 0.0
+
+        # Rates are computed over the time spanned by the window
+        duration = history['timestamp'][-1] - history['timestamp'][0]
+        for field in ['late_packets', 'duplicate_packets', 'invalid_packets', 'kernel_drops', 'dropped_heaps']:
+            total = int(np.sum(history[field]))
+            summary[field] = total
+            summary[field + '_per_second'] = float(total / duration) if duration > 0 else 0.0
+
+        return summary
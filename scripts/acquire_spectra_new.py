@@ -1,5 +1,7 @@
 from reach_ctrl.spectrometer.spectrometer import Spectrometer
 from reach_ctrl.spectrometer.spectra import Spectra
+from reach_ctrl.spectrometer.telemetry import acquisition_statistics_dtype, heap_statistics_dtype
+from reach_ctrl.observation_writer import ObservationWriter
 from reach_ctrl.reach_config import REACHConfig
 
 import matplotlib.pyplot as plt
@@ -9,11 +11,10 @@ import datetime
 import logging
 import signal
 import time
-import h5py
 import os
 
-# Global pointer to data_file
-data_file_name = None
+# Global pointer to data file writer
+writer = None
 
 # Global pointer to spectrometer
 spectrometer = None
@@ -30,59 +31,58 @@ def _signal_handler(signum, frame):
 
 def create_output_file(data_file_name, name="test"):
     """ Create HDF5 output file """
-    # Create HDF5 file which will store observation data
-    with h5py.File(data_file_name, 'w') as f:
-        # Create group which will contain observation info
-        info = f.create_group('observation_info')
-
-        # Add attributes to group
-        info.attrs['observation_name'] = name
-        info.attrs['start_time'] = time.time()
-
-        # Create group which will contain all observation data
-        f.create_group("observation_data")
+    global writer
+
+    # Create HDF5 file which will store observation data. The file stays open until the acquisition is done.
+    # Dataset compression, filters, the flush interval, file rollover and previews are taken from the observation
+    # configuration, if defined
+    observation = REACHConfig()['observation'] or {}
+    writer = ObservationWriter(data_file_name, dataset_filters=observation.get('dataset_filters'),
+                               compression_processes=observation.get('compression_processes', 0),
+                               flush_interval=observation.get('flush_interval'),
+                               max_file_size=observation.get('max_file_size', 0) * 1024 * 1024,
+                               rollover_interval=observation.get('rollover_interval', 0),
+                               longitude=observation.get('longitude'),
+                               preview_levels=observation.get('preview_levels'))
+    writer.open(observation_info={'observation_name': name, 'start_time': time.time()})
 
     logging.info("Created output file")
 
 
-def add_spectrum_to_file(spectrum, timestamp, name="test"):
+def add_spectrum_to_file(spectrum, timestamp, name="test", receiver_statistics=None, channel_count=None,
+                         heap_statistics=None):
     """ Add spectrum to data file 
     :param spectrum: The spectrum
     :param name: The data name
     :param timestamp: Spectrum timestsamp
-    :param name: Input source name """
-
-    nof_frequency_channels = REACHConfig()['spectrometer']['nof_frequency_channels']
+    :param name: Input source name
+    :param receiver_statistics: Receiver statistics of the accumulation
+    :param channel_count: Number of spectra in which each signal and frequency channel was received
+    :param heap_statistics: Receiver statistics of every heap in the accumulation """
 
-    with h5py.File(data_file_name, 'a') as f:
-        # Create dataset names
-        dataset_name = "{}_spectra".format(name)
-        timestamp_name = "{}_timestamps".format(name)
+    # Rows are appended in one writer operation, so that they always end up in the same file segment
+    writer.submit(_write_spectrum, spectrum.copy(), timestamp, name, receiver_statistics,
+                  None if channel_count is None else channel_count.copy(), heap_statistics)
 
-        # Load observation data group
-        dset = f['observation_data']
 
-        # If data sets do not exist, add them
-        if dataset_name not in dset.keys():
-            dset.create_dataset(dataset_name,
-                                (2, 0, nof_frequency_channels),
-                                maxshape=(2, None, nof_frequency_channels),
-                                chunks=True,
-                                dtype='f8')
+def _write_spectrum(spectrum, timestamp, name, receiver_statistics, channel_count, heap_statistics):
+    """ Write spectrum rows to data file. Runs in the writer thread """
 
-            dset.create_dataset(timestamp_name, (0,),
-                                maxshape=(None,), chunks=True, dtype='f8')
+    # Spectra and channel counts are stored as (signal, time, channel)
+    writer.append("observation_data/{}_spectra".format(name), spectrum, axis=1, dtype='f8')
+    writer.append("observation_data/{}_timestamps".format(name), timestamp, dtype='f8')
 
-            logging.info("Added {} dataset to output file".format(dataset_name))
+    if channel_count is not None:
+        writer.append("observation_data/{}_channel_count".format(name), channel_count, axis=1, dtype='u4')
 
-        # Add spectrum and timestamp to buffer
-        dset = f['observation_data/{}'.format(dataset_name)]
-        dset.resize((dset.shape[0], dset.shape[1] + 1, dset.shape[2]))
-        dset[:, -1, :] = spectrum
+    # One row per heap, the number of heaps of each accumulation is nof_heaps in the receiver statistics
+    if heap_statistics is not None:
+        for statistics in heap_statistics:
+            writer.append("observation_data/{}_heap_statistics".format(name), statistics, dtype=heap_statistics_dtype)
 
-        dset = f['observation_data/{}'.format(timestamp_name)]
-        dset.resize((dset.shape[0] + 1,))
-        dset[-1] = timestamp
+    if receiver_statistics is not None:
+        writer.append("observation_data/{}_receiver_statistics".format(name), receiver_statistics,
+                      dtype=acquisition_statistics_dtype)
 
 
 def add_rms_to_file(rms, timestamp, name="test"):
@@ -96,28 +96,8 @@ def add_rms_to_file(rms, timestamp, name="test"):
     if len(rms) == 0:
         return
 
-    with h5py.File(data_file_name, 'a') as f:
-        # Create dataset names
-        dataset_name = "{}_rms".format(name)
-
-        # Load observation data group
-        dset = f['observation_info']
-
-        # If data sets do not exist, add them
-        if dataset_name not in dset.keys():
-            dset.create_dataset(dataset_name,
-                                (0, 5),
-                                maxshape=(None, 5),
-                                chunks=True,
-                                dtype='f8')
-
-            logging.info("Added {} dataset to output file".format(dataset_name))
-
-        # Add spectrum and timestamp to buffer
-        dset = f['observation_info/{}'.format(dataset_name)]
-        dset.resize((dset.shape[0] + 1, dset.shape[1]))
-        dset[-1, 0] = timestamp
-        dset[-1, 1:] = rms
+    # Timestamp followed by RMS values
+    writer.append("observation_info/{}_rms".format(name), np.concatenate(([timestamp], rms)), dtype='f8')
 
 
 def add_temperatures_to_file(temps, timestamp, name="test"):
@@ -131,32 +111,9 @@ def add_temperatures_to_file(temps, timestamp, name="test"):
     if len(temps) == 0:
         return
 
-    with h5py.File(data_file_name, 'a') as f:
-        # Create dataset names
-        dataset_name = "{}_temperatures".format(name)
-
-        # Load observation data group
-        dset = f['observation_info']
-
-        if 'channel_names' not in dset.attrs.keys():
-            dset.attrs['channel_names'] = "COLD_JUNCTION, COLD, HOT, LNA, LOAD, GORE28, GORE89, TPM, AMBIENT"
-
-        # If data sets do not exist, add them
-        if dataset_name not in dset.keys():
-            dset.create_dataset(dataset_name,
-                                (0, temps.shape[0] + 1),
-                                maxshape=(None, temps.shape[0] + 1),
-                                chunks=True,
-                                dtype='f4')
-
-            logging.info("Added {} dataset to output file".format(dataset_name))
-            f.flush()
-
-        # Add spectrum and timestamp to buffer
-        dset = f['observation_info/{}'.format(dataset_name)]
-        dset.resize((dset.shape[0] + 1, dset.shape[1]))
-        dset[-1, 0] = timestamp
-        dset[-1, 1:] = temps
+    # Timestamp followed by temperatures
+    writer.append("observation_info/{}_temperatures".format(name), np.concatenate(([timestamp], temps)),
+                  dtype='f4')
 
 
 def monitor_rms(cadence):
@@ -262,6 +219,8 @@ if __name__ == "__main__":
                       help="Number of seconds between RMS measurements (default: -1 seconds, do not record)")
     parser.add_option("--temp-cadence", dest="temp_cadence", type=int, default=-1, 
                       help="Number of seconds between temperature measurements (default: -1 seconds, do not record)")
+    parser.add_option("--capture-process", dest="capture_process", default=False, action="store_true",
+                      help="Receive spectra in a separate process (default: False)")
     (options, args) = parser.parse_args()
 
     # Initialise REACH config
@@ -295,7 +254,7 @@ if __name__ == "__main__":
 
     else:
         # Create and initialise receiver
-        spectra = Spectra(ip=conf['lmc_ip'], port=int(conf['lmc_port']))
+        spectra = Spectra(ip=conf['lmc_ip'], port=int(conf['lmc_port']), capture_process=options.capture_process)
         spectra.initialise()
 
     # If number of spectra is not defined, use a large number
@@ -306,7 +265,9 @@ if __name__ == "__main__":
     if options.output != "":
         options.output = "{}.hdf5".format(options.output)
         create_output_file(options.output)
-        data_file_name = options.output
+
+    # Monitoring threads writing to file
+    monitor_threads = []
 
     # Sanity check on RMS measurements
     if options.temp_cadence != -1:
@@ -315,8 +276,11 @@ if __name__ == "__main__":
             options.temp_cadence = False
         else:
             # Create RMS thread
+            writer.set_attributes('observation_info', {
+                'channel_names': "COLD_JUNCTION, COLD, HOT, LNA, LOAD, GORE28, GORE89, TPM, AMBIENT"})
             temp_thread = threading.Thread(target=monitor_temperatures, args=(options.temp_cadence, ))
             temp_thread.start()
+            monitor_threads.append(temp_thread)
 
     # Sanity check on RMS measurements
     if options.rms_cadence != -1:
@@ -335,6 +299,7 @@ if __name__ == "__main__":
             # Create RMS thread
             rms_thread = threading.Thread(target=monitor_rms, args=(options.rms_cadence,))
             rms_thread.start()
+            monitor_threads.append(rms_thread)
 
     # Wait for exit or termination
     signal.signal(signal.SIGINT, _signal_handler)
@@ -342,19 +307,21 @@ if __name__ == "__main__":
     # Kickstart plotting
     plt.figure()
 
+    # Keep receiving while plotting and writing, so consecutive accumulations are contiguous
+    spectra.start_persistent_receiver()
+
     # Look over number of required accumulations
     for accumulation in range(options.nof_spectra):
 
         # Grab spectra
-        spectra.start_receiver(options.accumulate)
-        timestamps, data = spectra.wait_for_receiver()
-
-        # # Generate accumulated spectra
-        data = np.sum(data, axis=0)
+        timestamps, data = spectra.get(options.accumulate, accumulate=True)
 
         # If writing to file, add
         if options.output != "":
-            add_spectrum_to_file(data, timestamps[0], name="test")
+            add_spectrum_to_file(data, timestamps[0], name="test",
+                                 receiver_statistics=spectra.get_acquisition_telemetry(),
+                                 channel_count=spectra.get_accumulation_statistics()[2],
+                                 heap_statistics=spectra.get_heap_statistics())
 
         data = 10 * np.log10(data)
 
@@ -379,6 +346,12 @@ if __name__ == "__main__":
         if stop_acquisition:
             break
 
-    # Finished acquiring data
+    # Finished acquiring data, stop monitoring threads and write pending data
+    spectra.close()
+    if writer is not None:
+        stop_acquisition = True
+        for thread in monitor_threads:
+            thread.join()
+        writer.close()
     logging.info("Finished acquiring data. Press Enter to quit")
     input()
@@ -1,9 +1,164 @@
 from __future__ import print_function
 from matplotlib import pyplot as plt
+from datetime import datetime
 import numpy as np
-import h5py
+import hashlib
+import json
 import os
 
+from reach_ctrl.observation_reader import LiveObservationReader
+
+# Reductions of waterfall cells, with the value of empty cells
+_STATISTICS = {"mean": (np.add, 0.0), "max": (np.maximum, -np.inf), "min": (np.minimum, np.inf)}
+
+
+def reduce_waterfall(reader, path, axis=0, signal=0, width=1024, height=768, statistic="mean",
+                     max_block_size=32 * 1024 * 1024):
+    """ Reduce a spectra dataset to a time-frequency grid of at most height x width cells. The dataset is read in
+    blocks of rows, each of which is reduced into the grid, so memory use does not depend on the length of the
+    observation. For the mean, the coarsest preview level with enough resolution is read instead if available
+    :param reader: LiveObservationReader of the file
+    :param path: Spectra dataset path
+    :param axis: Time axis of dataset
+    :param signal: Signal to reduce, for (signal, time, channel) datasets
+    :param width: Number of frequency cells
+    :param height: Number of time cells
+    :param statistic: Reduction of each cell, one of mean, max or min
+    :param max_block_size: Maximum size of a block of rows read from file in bytes
+    :return: Grid of linear values (NaN for empty cells), or None if the dataset is empty """
+
+    # Previews hold averages, so they can only be used for the mean
+    if statistic == "mean":
+        path = reader.select_preview(path, nof_channels=width, nof_rows=height, axis=axis)[0]
+
+    # Only the selected signal of (signal, time, channel) datasets is read from file
+    shape = reader.shape(path)
+    nof_rows, nof_channels = reader.nof_rows(path, axis), shape[-1]
+    signal = signal if len(shape) == 3 else None
+    if nof_rows == 0:
+        return None
+
+    width, height = min(width, nof_channels), min(height, nof_rows)
+    reduce, empty = _STATISTICS[statistic]
+
+    grid = np.full((height, width), empty)
+    counts = np.zeros((height, width), dtype=np.int64)
+
+    # Channels and rows are assigned to cells in the same way, channel c to cell c * width // nof_channels
+    channel_cells = np.arange(nof_channels) * width // nof_channels
+    channel_starts = np.flatnonzero(np.r_[True, channel_cells[1:] != channel_cells[:-1]])
+
+    row_size = 8 * nof_channels
+    block_rows = max(1, max_block_size // row_size)
+    for start in range(0, nof_rows, block_rows):
+        stop = min(nof_rows, start + block_rows)
+        data = reader.read(path, start, stop, axis, signal)
+
+        # Reduce along frequency first, then along time over runs of rows which fall in the same cell
+        data = data.astype(np.float64)
+        finite = np.isfinite(data)
+        data[~finite] = empty
+        data = reduce.reduceat(data, channel_starts, axis=1)
+        finite = np.add.reduceat(finite, channel_starts, axis=1, dtype=np.int64)
+
+        cells = np.arange(start, stop) * height // nof_rows
+        starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+        cells = cells[starts]
+        grid[cells] = reduce(grid[cells], reduce.reduceat(data, starts, axis=0))
+        counts[cells] += np.add.reduceat(finite, starts, axis=0)
+
+    if statistic == "mean":
+        with np.errstate(divide='ignore', invalid='ignore'):
+            grid /= counts
+    grid[counts == 0] = np.nan
+    return grid
+
+
+def get_waterfall(reader, path, axis=0, signal=0, width=1024, height=768, statistic="mean", cache_directory=None):
+    """ Reduce a spectra dataset with reduce_waterfall, caching the grid. The cache is keyed by file modification
+    time and size and by the reduction parameters, so a file is only read again once it changes
+    :param cache_directory: Directory of cached grids, None to disable the cache
+    :return: Grid of linear values, or None if the dataset is empty """
+
+    cache_file = None
+    if cache_directory is not None:
+        stat = os.stat(reader.file_name)
+        key = json.dumps([os.path.abspath(reader.file_name), stat.st_mtime, stat.st_size, path, axis, signal,
+                          width, height, statistic])
+        cache_file = os.path.join(cache_directory, "{}.npy".format(hashlib.sha1(key.encode()).hexdigest()))
+        if os.path.exists(cache_file):
+            return np.load(cache_file)
+
+    grid = reduce_waterfall(reader, path, axis, signal, width, height, statistic)
+
+    if cache_file is not None and grid is not None:
+        if not os.path.exists(cache_directory):
+            os.makedirs(cache_directory)
+        temporary_file = "{}.tmp.npy".format(cache_file[:-len(".npy")])
+        np.save(temporary_file, grid)
+        os.replace(temporary_file, cache_file)
+
+    return grid
+
+
+def render_waterfall(grid, output, title="", nof_channels=None, time_range=None, quicklook=False):
+    """ Render a waterfall grid in dB to a PNG file, without requiring a display
+    :param grid: Grid of linear values from reduce_waterfall
+    :param output: Path of PNG file
+    :param title: Plot title
+    :param nof_channels: Number of frequency channels of the full resolution dataset, for the frequency axis
+    :param time_range: (start, end) UNIX times of the first and last spectrum, None to label spectra by cell
+    :param quicklook: Add the mean spectrum and the total power over time below the waterfall """
+
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        grid_db = 10 * np.log10(grid)
+    grid_db[~np.isfinite(grid_db)] = np.nan
+
+    # Time runs downwards, in hours since the first spectrum
+    nof_channels = nof_channels or grid.shape[1]
+    if time_range is not None:
+        extent = [0, nof_channels, (time_range[1] - time_range[0]) / 3600.0, 0]
+        time_label = "Hours since {} UTC".format(datetime.utcfromtimestamp(time_range[0]).strftime("%d/%m/%Y %H:%M"))
+    else:
+        extent = [0, nof_channels, grid.shape[0], 0]
+        time_label = "Time cell"
+
+    figure = Figure(figsize=(12, 12 if quicklook else 8))
+    FigureCanvasAgg(figure)
+    if quicklook:
+        axes = figure.subplots(3, 1, gridspec_kw={'height_ratios': [3, 1, 1]})
+    else:
+        axes = [figure.subplots()]
+
+    # Colour limits ignore outliers
+    limits = np.nanpercentile(grid_db, [1, 99]) if np.any(np.isfinite(grid_db)) else [0, 1]
+    image = axes[0].imshow(grid_db, aspect='auto', interpolation='nearest', extent=extent,
+                           vmin=limits[0], vmax=limits[1])
+    figure.colorbar(image, ax=axes[0], label="Power (dB)")
+    axes[0].set_title(title)
+    axes[0].set_xlabel("Frequency Channel")
+    axes[0].set_ylabel(time_label)
+
+    if quicklook:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            spectrum = 10 * np.log10(np.nanmean(grid, axis=0))
+            power = 10 * np.log10(np.nansum(grid, axis=1))
+        axes[1].plot(np.linspace(0, nof_channels, grid.shape[1], endpoint=False), spectrum)
+        axes[1].set_xlabel("Frequency Channel")
+        axes[1].set_ylabel("Mean power (dB)")
+        axes[1].set_xlim(0, nof_channels)
+        axes[2].plot(np.linspace(extent[3], extent[2], grid.shape[0], endpoint=False), power)
+        axes[2].set_xlabel(time_label)
+        axes[2].set_ylabel("Total power (dB)")
+        axes[2].set_xlim(extent[3], extent[2])
+
+    figure.tight_layout()
+    figure.savefig(output)
+
+
 if __name__ == "__main__":
     from optparse import OptionParser
 
@@ -11,6 +166,27 @@ if __name__ == "__main__":
     parser.add_option("-f", "--file", dest="file", help="File to plot")
     parser.add_option("-d", "--dataset", dest="dataset", help="Dataset to plot")
     parser.add_option("-c", "--channel", dest="channel", default=0, type=int, help="Channel to plot (default: 0)")
+    parser.add_option("--follow", dest="follow", default=False, action="store_true",
+                      help="Keep plotting the latest spectrum while the file is being written (default: False)")
+    parser.add_option("--interval", dest="interval", default=5, type=float,
+                      help="Seconds between checks for new spectra in follow mode (default: 5)")
+    parser.add_option("--waterfall", dest="waterfall", default=False, action="store_true",
+                      help="Plot a time-frequency waterfall of the whole dataset (default: False)")
+    parser.add_option("--quicklook", dest="quicklook", default=False, action="store_true",
+                      help="Plot a waterfall with the mean spectrum and total power over time (default: False)")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="PNG file of the waterfall (default: <file>_<dataset>_waterfall.png)")
+    parser.add_option("--width", dest="width", default=1024, type=int,
+                      help="Number of frequency cells of the waterfall (default: 1024)")
+    parser.add_option("--height", dest="height", default=768, type=int,
+                      help="Number of time cells of the waterfall (default: 768)")
+    parser.add_option("--statistic", dest="statistic", default="mean", choices=sorted(_STATISTICS),
+                      help="Reduction of each waterfall cell: mean, max or min (default: mean)")
+    parser.add_option("--cache", dest="cache",
+                      default=os.path.join(os.path.expanduser("~"), ".cache", "reach_control"),
+                      help="Directory of cached waterfalls (default: ~/.cache/reach_control)")
+    parser.add_option("--no-cache", dest="cache", action="store_const", const=None,
+                      help="Do not cache waterfalls")
     (options, args) = parser.parse_args()
 
     if options.file is None:
@@ -21,16 +197,63 @@ if __name__ == "__main__":
         print("Provided filepath is not a file or does not exist")
         exit()
 
+    # Files are opened for SWMR reading, so they can be plotted while an observation is writing them
+    reader = LiveObservationReader(options.file)
 
-    with h5py.File(options.file, 'r') as f:
-        dset = f['observation_data']
+    path = "observation_data/{}_spectra".format(options.dataset)
+    if path not in reader.list_datasets():
+        print("Data set {} does not exist".format(options.dataset))
+        exit()
 
-        if "{}_spectra".format(options.dataset) not in list(dset.keys()):
-            print("Data set {} does not exist".format(options.dataset))
+    # Spectra are stored as (signal, time, channel) by acquisition scripts and as (time, channel) by observations
+    ndim = len(reader.shape(path))
+    axis = 1 if ndim == 3 else 0
+
+    if options.waterfall or options.quicklook:
+        grid = get_waterfall(reader, path, axis, options.channel, options.width, options.height, options.statistic,
+                             options.cache)
+        if grid is None:
+            print("Data set {} is empty".format(options.dataset))
+            exit()
+
+        # Waterfalls span the first to the last timestamp, if the dataset has timestamps
+        time_range = None
+        timestamps_path = "observation_data/{}_timestamps".format(options.dataset)
+        if timestamps_path in reader.list_datasets():
+            nof_rows = reader.nof_rows(timestamps_path)
+            if nof_rows > 0:
+                time_range = (float(reader.read(timestamps_path, 0, 1)[0]),
+                              float(reader.read(timestamps_path, nof_rows - 1, nof_rows)[0]))
+
+        output = options.output or "{}_{}_waterfall.png".format(os.path.splitext(options.file)[0], options.dataset)
+        render_waterfall(grid, output, "{} {} ({})".format(os.path.basename(options.file), options.dataset,
+                                                           options.statistic),
+                         reader.shape(path)[-1], time_range, options.quicklook)
+        reader.close()
+        print("Waterfall written to {}".format(output))
+        exit()
+
+    if not options.follow:
+        spectrum = reader.read(path, 0, 1, axis=axis, signal=options.channel)
+        if spectrum.size == 0:
+            print("Data set {} is empty".format(options.dataset))
             exit()
 
-        dset = f['observation_data/{}_spectra'.format(options.dataset)]
-        
         # plt.plot(10*np.log10(np.sum(dset[options.channel, :, :], axis=0)))
-        plt.plot(dset[options.channel, 0, :])
+        plt.plot(spectrum[0, :])
         plt.show()
+        exit()
+
+    # Only spectra added since the last check are read from file
+    plt.figure()
+    while plt.fignum_exists(1):
+        spectra = reader.read_new(path, axis=axis, max_rows=1, signal=options.channel)
+        if spectra.size != 0:
+            plt.clf()
+            plt.title("{} spectrum {}".format(options.dataset, reader.nof_rows(path, axis)))
+            plt.plot(spectra[-1, :])
+            plt.xlabel("Frequency Channel")
+            plt.draw()
+        plt.pause(options.interval)
+
+    reader.close()
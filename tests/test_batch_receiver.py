@@ -0,0 +1,38 @@
+import socket
+import numpy as np
+import pytest
+
+from reach_ctrl.spectrometer.batch_receiver import BatchReceiver
+
+pytestmark = pytest.mark.skipif(not BatchReceiver.available(), reason="recvmmsg not available")
+
+
+def test_receive_batches():
+    receiver_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver_socket.bind(("127.0.0.1", 0))
+    receiver_socket.settimeout(1)
+    sender_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    try:
+        receiver = BatchReceiver(receiver_socket, nof_slots=8, slot_size=2048)
+
+        # Batches of different sizes, including one larger than the number of slots
+        for nof_packets in [5, 3, 12]:
+            sizes = 100 + np.arange(nof_packets)
+            for i, size in enumerate(sizes):
+                sender_socket.sendto(bytes(bytearray([i]) * size), receiver_socket.getsockname())
+
+            received = 0
+            while received < nof_packets:
+                count = receiver.receive()
+                np.testing.assert_array_equal(receiver.lengths[:count], sizes[received:received + count])
+                for i in range(count):
+                    assert np.all(receiver.slots[i, :sizes[received + i]] == received + i)
+                received += count
+            assert received == nof_packets
+
+        with pytest.raises(socket.timeout):
+            receiver.receive()
+    finally:
+        receiver_socket.close()
+        sender_socket.close()
@@ -0,0 +1,103 @@
+import threading
+import numpy as np
+
+from reach_ctrl.spectrometer import capture
+from reach_ctrl.spectrometer.capture import HeapRing, CaptureProcess
+from reach_ctrl.spectrometer.telemetry import heap_statistics_dtype
+
+NOF_SIGNALS, NOF_CHANNELS = 2, 64
+
+
+def _write(ring, sequence):
+    """ Write a heap whose values are all equal to its sequence number """
+    statistics = np.zeros(1, dtype=heap_statistics_dtype)[0]
+    statistics['timestamp'] = sequence
+    ring.write(float(sequence), np.full((NOF_SIGNALS, NOF_CHANNELS), sequence, dtype=np.double),
+               np.ones((NOF_SIGNALS, NOF_CHANNELS), dtype=bool), statistics)
+
+
+def test_read_returns_copy():
+    ring = HeapRing(4, NOF_SIGNALS, NOF_CHANNELS)
+    try:
+        _write(ring, 0)
+        timestamp, spectrum, valid_mask, statistics = ring.read(0)
+
+        # Overwrite every slot, the heap which was read must not change
+        for sequence in range(1, 5):
+            _write(ring, sequence)
+        assert timestamp == 0
+        assert np.all(spectrum == 0) and np.all(valid_mask)
+        assert statistics['timestamp'] == 0
+        assert ring.read(0) is None
+        assert ring.read(4)[0] == 4
+    finally:
+        ring.close()
+
+
+def test_read_into_buffers():
+    ring = HeapRing(4, NOF_SIGNALS, NOF_CHANNELS)
+    try:
+        _write(ring, 0)
+        spectrum = np.zeros((NOF_SIGNALS, NOF_CHANNELS))
+        valid_mask = np.zeros((NOF_SIGNALS, NOF_CHANNELS), dtype=bool)
+        heap = ring.read(0, spectrum, valid_mask)
+        assert heap[1] is spectrum and heap[2] is valid_mask
+        assert np.all(valid_mask)
+    finally:
+        ring.close()
+
+
+def test_read_discards_heap_overwritten_while_copying(monkeypatch):
+    ring = HeapRing(1, NOF_SIGNALS, NOF_CHANNELS)
+    try:
+        _write(ring, 0)
+
+        # The producer wraps around the ring while the consumer is copying the spectrum
+        copyto = np.copyto
+
+        def racing_copyto(destination, source):
+            copyto(destination, source)
+            if ring.head == 1:
+                _write(ring, 1)
+
+        monkeypatch.setattr(capture.np, "copyto", racing_copyto)
+        assert ring.read(0) is None
+    finally:
+        ring.close()
+
+
+def test_read_heap_waits_for_producer():
+    process = CaptureProcess({'nof_signals': NOF_SIGNALS, 'nof_channels': NOF_CHANNELS}, nof_slots=4)
+    process._ring = HeapRing(4, NOF_SIGNALS, NOF_CHANNELS)
+
+    # Stand-in for the capture process, publishing heaps after a delay
+    stop = threading.Event()
+
+    def produce():
+        for sequence in range(3):
+            stop.wait(0.05)
+            _write(process._ring, sequence)
+            process._heap_event.set()
+
+    process._process = threading.Thread(target=produce)
+    process._process.start()
+    try:
+        timestamps = [process.read_heap(timeout=5)[0] for _ in range(3)]
+        assert timestamps == [0, 1, 2]
+        assert process.read_heap(timeout=0.2) is None
+    finally:
+        stop.set()
+        process._process.join()
+        process._ring.close()
+
+
+def test_read_heap_skips_overwritten_heaps():
+    process = CaptureProcess({'nof_signals': NOF_SIGNALS, 'nof_channels': NOF_CHANNELS}, nof_slots=4)
+    process._ring = HeapRing(4, NOF_SIGNALS, NOF_CHANNELS)
+    process._process = threading.Thread(target=lambda: None)
+    try:
+        for sequence in range(10):
+            _write(process._ring, sequence)
+        assert process.read_heap(timeout=1)[0] == 6
+    finally:
+        process._ring.close()
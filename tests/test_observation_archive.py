@@ -0,0 +1,124 @@
+import shutil
+import json
+import numpy as np
+import h5py
+import os
+
+from reach_ctrl.observation_archive import ObservationArchive
+from reach_ctrl.observation_reader import ObservationReader
+from reach_ctrl import utils
+
+
+def _write_file(file_name, start_time, nof_rows, nof_channels=16):
+    """ Write an observation file with (time, channel) antenna spectra and (signal, time, channel) load spectra """
+    timestamps = start_time + 10.0 * np.arange(nof_rows)
+    spectra = timestamps[:, np.newaxis] + np.arange(nof_channels)
+    with h5py.File(file_name, 'w') as f:
+        group = f.create_group('observation_data')
+        group.create_dataset('obs_ant_timestamps', data=timestamps)
+        group.create_dataset('obs_ant_lst_time', data=utils.get_sidereal_times(timestamps, 21.4))
+        group.create_dataset('obs_ant_spectra', data=spectra, maxshape=(None, nof_channels))
+        group.create_dataset('obs_load_timestamps', data=timestamps)
+        group.create_dataset('obs_load_spectra', data=np.stack([spectra, -spectra]))
+        group.create_dataset('obs_ant_receiver_statistics', data=np.zeros(nof_rows))
+
+
+def _concatenate(files, path):
+    """ Read a dataset from each file and concatenate the parts along the time axis """
+    parts = []
+    for file_name in files:
+        with h5py.File(file_name, 'r') as f:
+            parts.append(f[path][:])
+    return np.concatenate(parts, axis=1 if parts[0].ndim == 3 else 0)
+
+
+def _check_archive(archive_file, files):
+    """ Check that every archived dataset matches the concatenation of the files in time order """
+    with h5py.File(archive_file, 'r') as f:
+        assert sorted(f['observation_data']) == ['obs_ant_lst_time', 'obs_ant_spectra', 'obs_ant_timestamps',
+                                                 'obs_load_spectra', 'obs_load_timestamps']
+        for name, dataset in f['observation_data'].items():
+            assert dataset.is_virtual
+            np.testing.assert_array_equal(dataset[:], _concatenate(files, "observation_data/{}".format(name)))
+
+            # Rows map back to the file they came from
+            offsets = np.cumsum([0] + [len(_concatenate([file_name], 'observation_data/obs_ant_timestamps'))
+                                       for file_name in files])
+            np.testing.assert_array_equal(dataset.attrs['file_offsets'], offsets)
+
+
+def test_archive_matches_concatenation(tmp_path):
+    directory = tmp_path / "observations"
+    directory.mkdir()
+
+    # File names are not in time order, files are archived by their first timestamp
+    files = [str(directory / "{}.hdf5".format(name)) for name in ["c", "a", "b"]]
+    for i, file_name in enumerate(files):
+        _write_file(file_name, 1.7e9 + 1000 * i, 20 + 7 * i)
+
+    archive_file = str(directory / "archive.hdf5")
+    archive = ObservationArchive(archive_file)
+    assert archive.update(str(directory)) == 3
+    _check_archive(archive_file, files)
+
+    with h5py.File(archive_file, 'r') as f:
+        assert json.loads(f['observation_info'].attrs['files']) == ["c.hdf5", "a.hdf5", "b.hdf5"]
+
+    # Nothing is rewritten until a file is added, changed or removed
+    modification_time = os.path.getmtime(archive_file)
+    assert archive.update(str(directory)) == 0
+    assert os.path.getmtime(archive_file) == modification_time
+
+    files.append(str(directory / "d.hdf5"))
+    _write_file(files[-1], 1.7e9 + 500, 5)
+    assert archive.update(str(directory)) == 1
+    _check_archive(archive_file, [files[0], files[3], files[1], files[2]])
+
+    os.remove(files[1])
+    _write_file(files[2], 1.7e9 + 5000, 9)
+    assert archive.update(str(directory)) == 1
+    _check_archive(archive_file, [files[0], files[3], files[2]])
+
+    # Files are referenced relative to the archive, so the directory can be moved
+    shutil.move(str(directory), str(tmp_path / "moved"))
+    files = [str(tmp_path / "moved" / "{}.hdf5".format(name)) for name in ["c", "d", "b"]]
+    _check_archive(str(tmp_path / "moved" / "archive.hdf5"), files)
+
+
+def test_archive_skips_mismatched_files(tmp_path):
+    files = [str(tmp_path / "{}.hdf5".format(i)) for i in range(3)]
+    _write_file(files[0], 1.7e9, 10)
+    _write_file(files[1], 1.7e9 + 1000, 10, nof_channels=8)
+    _write_file(files[2], 1.7e9 + 2000, 10)
+
+    archive_file = str(tmp_path / "archive.hdf5")
+    ObservationArchive(archive_file).update(str(tmp_path))
+
+    # Spectra with a different number of channels are left out, other datasets of the file are kept
+    with h5py.File(archive_file, 'r') as f:
+        np.testing.assert_array_equal(f['observation_data/obs_ant_spectra'][:],
+                                      _concatenate([files[0], files[2]], 'observation_data/obs_ant_spectra'))
+        np.testing.assert_array_equal(f['observation_data/obs_ant_timestamps'][:],
+                                      _concatenate(files, 'observation_data/obs_ant_timestamps'))
+
+
+def test_reader_selects_from_archive(tmp_path):
+    files = [str(tmp_path / "{}.hdf5".format(i)) for i in range(4)]
+    for i, file_name in enumerate(files):
+        _write_file(file_name, 1.7e9 + 300 * i, 30)
+
+    archive_file = str(tmp_path / "archive.hdf5")
+    ObservationArchive(archive_file).update(str(tmp_path))
+
+    timestamps = _concatenate(files, 'observation_data/obs_ant_timestamps')
+    spectra = _concatenate(files, 'observation_data/obs_ant_spectra')
+    time_range = (1.7e9 + 250, 1.7e9 + 800)
+    mask = (timestamps >= time_range[0]) & (timestamps <= time_range[1])
+
+    reader = ObservationReader(archive_file)
+    try:
+        selected_timestamps, data = reader['obs_ant'].select(time_range).read()
+        np.testing.assert_array_equal(selected_timestamps, timestamps[mask])
+        np.testing.assert_array_equal(data, spectra[mask])
+    finally:
+        reader.close()
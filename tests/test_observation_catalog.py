@@ -0,0 +1,143 @@
+import numpy as np
+import pytest
+import h5py
+
+from reach_ctrl import observation_writer
+from reach_ctrl.observation_catalog import ObservationCatalog, _in_lst_range
+from reach_ctrl.observation_writer import ObservationWriter
+from reach_ctrl import utils
+
+LONGITUDE = 21.4
+
+
+def _write_file(file_name, name, sources, start_time):
+    """ Write an observation file with spectra, timestamps and LST for each source. Sources are measured in turn """
+    with h5py.File(file_name, 'w') as f:
+        f.create_group('observation_info').attrs['observation_name'] = name
+        group = f.create_group('observation_data')
+        for i, (source, nof_rows, step) in enumerate(sources):
+            timestamps = start_time + i * step / len(sources) + step * np.arange(nof_rows)
+            group.create_dataset("{}_timestamps".format(source), data=timestamps)
+            group.create_dataset("{}_spectra".format(source), data=np.zeros((nof_rows, 16)))
+            if source != 'obs_load':
+                group.create_dataset("{}_lst_time".format(source),
+                                     data=utils.get_sidereal_times(timestamps, LONGITUDE))
+
+
+def _brute_force(files, time_range, lst_range, sources):
+    """ Scan every file for the rows of each source in a time and LST range """
+    rows = set()
+    for file_name in files:
+        with h5py.File(file_name, 'r') as f:
+            group = f['observation_data']
+            for key in group:
+                if not key.endswith('_timestamps'):
+                    continue
+                source = key[:-len('_timestamps')]
+                if sources is not None and source not in sources:
+                    continue
+                timestamps = group[key][:]
+                mask = np.ones(timestamps.shape[0], dtype=bool)
+                if time_range is not None:
+                    mask &= (timestamps >= time_range[0]) & (timestamps <= time_range[1])
+                if lst_range is not None:
+                    mask &= _in_lst_range(utils.get_sidereal_times(timestamps, LONGITUDE), lst_range)
+                path = "observation_data/{}_spectra".format(source)
+                rows.update((str(file_name), path, row) for row in np.flatnonzero(mask))
+    return rows
+
+
+def _rows(matches):
+    """ Expand the slices returned by a query to a set of rows """
+    return set((path, dataset_path, row) for path, dataset_path, rows in matches
+               for row in range(rows.start, rows.stop))
+
+
+@pytest.fixture
+def catalog_files(tmp_path):
+    # Files start three hours apart, and the LST ranges of some queries wrap around 360
+    start_time = 1.7e9
+    files = []
+    for i in range(3):
+        file_name = tmp_path / "observation_{}.hdf5".format(i)
+        _write_file(str(file_name), "observation_{}".format(i),
+                    [('obs_ant', 700, 20.0), ('obs_load', 300, 60.0)], start_time + i * 3 * 3600)
+        files.append(str(file_name))
+
+    catalog = ObservationCatalog(str(tmp_path / "catalog.sqlite"), block_size=64, longitude=LONGITUDE)
+    assert catalog.update(str(tmp_path)) == 3
+    yield catalog, files
+    catalog.close()
+
+
+@pytest.mark.parametrize("time_range, lst_range, sources", [
+    (None, None, None),
+    ((1.7e9 + 1000, 1.7e9 + 12000), None, None),
+    ((1.7e9 + 1000, 1.7e9 + 12000), None, ['obs_load']),
+    (None, (30.0, 60.0), None),
+    (None, (350.0, 10.0), ['obs_ant']),
+    ((1.7e9 + 5000, 1.7e9 + 30000), (100.0, 20.0), None),
+    ((1.7e9 - 1000, 1.7e9 - 10), None, None),
+])
+def test_query_matches_brute_force(catalog_files, time_range, lst_range, sources):
+    catalog, files = catalog_files
+    expected = _brute_force(files, time_range, lst_range, sources)
+
+    # Exact queries return the rows in range, block aligned ones at least those rows
+    assert _rows(catalog.query(time_range, lst_range, sources, exact=True)) == expected
+    assert _rows(catalog.query(time_range, lst_range, sources)) >= expected
+
+
+def test_catalog_is_updated_when_files_change(catalog_files, tmp_path):
+    catalog, files = catalog_files
+    assert catalog.list_sources() == ['obs_ant', 'obs_load']
+    assert catalog.update(str(tmp_path)) == 0
+    assert [row[1] for row in catalog.list_files()] == ['observation_0', 'observation_1', 'observation_2']
+
+    # Changed files are indexed again, removed files are removed from the catalog
+    _write_file(files[0], "observation_0", [('obs_cold', 100, 10.0)], 1.7e9)
+    tmp_path.joinpath("observation_2.hdf5").unlink()
+    assert catalog.update(str(tmp_path)) == 1
+    assert catalog.list_sources() == ['obs_ant', 'obs_cold', 'obs_load']
+    assert _rows(catalog.query(exact=True)) == _brute_force(files[:2], None, None, None)
+
+
+def test_writer_indexes_segments_in_one_catalog(tmp_path, monkeypatch):
+    catalogs = []
+
+    class CountingCatalog(ObservationCatalog):
+        def __init__(self, *args, **kwargs):
+            super(CountingCatalog, self).__init__(*args, **kwargs)
+            catalogs.append(self)
+
+    monkeypatch.setattr(observation_writer, 'ObservationCatalog', CountingCatalog)
+
+    catalog_file = str(tmp_path / "catalog.sqlite")
+    writer = ObservationWriter(str(tmp_path / "observation.hdf5"), rows_per_flush=4, max_file_size=100 * 1024,
+                               flush_interval=0, longitude=LONGITUDE, catalog_file=catalog_file)
+    writer.open(observation_info={'observation_name': 'test'})
+
+    def add_spectrum(spectrum, timestamp):
+        writer.append('observation_data/test_spectra', spectrum)
+        writer.append('observation_data/test_timestamps', timestamp)
+
+    timestamps = 1.7e9 + 10.0 * np.arange(60)
+    for timestamp in timestamps:
+        writer.submit(add_spectrum, np.full(1024, timestamp), timestamp)
+    writer.close()
+
+    # Segments closed by the writer thread and the last one closed by close() share a catalog, closed with the writer
+    assert len(catalogs) == 1
+    assert catalogs[0]._connection is None
+
+    catalog = ObservationCatalog(catalog_file)
+    try:
+        files = catalog.list_files()
+        assert len(files) > 2
+        indexed = []
+        for path, dataset_path, rows in catalog.query(dataset='timestamps'):
+            with h5py.File(path, 'r') as f:
+                indexed.extend(f[dataset_path][rows])
+        np.testing.assert_array_equal(indexed, timestamps)
+    finally:
+        catalog.close()
@@ -0,0 +1,230 @@
+import numpy as np
+import pytest
+import h5py
+import os
+
+from reach_ctrl.observation_writer import ObservationWriter
+from reach_ctrl.observation_reader import LiveObservationReader, ObservationReader, read_manifest
+from reach_ctrl import utils
+
+
+def test_live_reader_reads_new_rows_once(tmp_path):
+    file_name = str(tmp_path / "observation.hdf5")
+    writer = ObservationWriter(file_name, rows_per_flush=4, swmr=True)
+    writer.open(observation_info={'observation_name': 'test'})
+    writer.create_dataset('observation_data/test_spectra', (8,), 'f8')
+    writer.create_dataset('observation_data/test_timestamps', (), 'f8')
+    writer.start_swmr()
+    writer.flush()
+
+    reader = LiveObservationReader(file_name)
+    try:
+        assert reader.get_attributes()['observation_name'] == 'test'
+        assert reader.read_latest('observation_data/test_spectra') is None
+        assert reader.read_new('observation_data/test_spectra').shape == (0, 8)
+
+        # Every row written by the writer is returned by exactly one read_new call
+        rows = []
+        for batch in [3, 5, 1, 7]:
+            start = sum(r.shape[0] for r in rows)
+            for i in range(start, start + batch):
+                writer.append('observation_data/test_spectra', np.full(8, i, dtype=np.double))
+                writer.append('observation_data/test_timestamps', float(i))
+            writer.flush()
+
+            new_rows = reader.read_new('observation_data/test_spectra')
+            assert new_rows.shape == (batch, 8)
+            np.testing.assert_array_equal(new_rows[:, 0], np.arange(start, start + batch))
+            rows.append(new_rows)
+
+        assert reader.read_new('observation_data/test_spectra').shape[0] == 0
+        assert reader.read_latest('observation_data/test_timestamps') == 15
+
+        # Only the latest rows are returned when limited
+        writer.append('observation_data/test_spectra', np.full(8, 16, dtype=np.double))
+        writer.append('observation_data/test_spectra', np.full(8, 17, dtype=np.double))
+        writer.flush()
+        np.testing.assert_array_equal(reader.read_new('observation_data/test_spectra', max_rows=1)[:, 0], [17])
+
+        # Datasets cannot be created once SWMR writing started, and the error reaches the producer
+        writer.append('observation_data/other_spectra', np.zeros(8))
+        with pytest.raises(ValueError):
+            writer.flush()
+    finally:
+        reader.close()
+        writer.close()
+
+
+def test_rollover_manifest_ranges(tmp_path):
+    file_name = str(tmp_path / "observation.hdf5")
+    writer = ObservationWriter(file_name, rows_per_flush=4, max_file_size=100 * 1024, flush_interval=0,
+                               longitude=21.4)
+    writer.open(observation_info={'observation_name': 'test'})
+
+    def add_spectrum(spectrum, timestamp):
+        writer.append('observation_data/test_spectra', spectrum)
+        writer.append('observation_data/test_timestamps', timestamp)
+
+    timestamps = 1.7e9 + 10.0 * np.arange(60)
+    for timestamp in timestamps:
+        writer.submit(add_spectrum, np.full(1024, timestamp), timestamp)
+    writer.close()
+
+    manifest_file = str(tmp_path / "observation_manifest.yaml")
+    segments = read_manifest(manifest_file)
+    assert len(segments) > 2
+
+    # Segments hold consecutive rows, and their manifest entries match their contents
+    written = []
+    for segment in segments:
+        with h5py.File(segment['file'], 'r') as f:
+            assert f['observation_info'].attrs['observation_name'] == 'test'
+            segment_timestamps = f['observation_data/test_timestamps'][:]
+            np.testing.assert_array_equal(f['observation_data/test_spectra'][:, 0], segment_timestamps)
+        assert segment['nof_rows'] == len(segment_timestamps)
+        assert segment['size'] == os.path.getsize(segment['file'])
+        assert segment['start_time'] == segment_timestamps[0]
+        assert segment['end_time'] == segment_timestamps[-1]
+        np.testing.assert_allclose([segment['start_lst'], segment['end_lst']],
+                                   utils.get_sidereal_times(segment_timestamps[[0, -1]], 21.4))
+        written.extend(segment_timestamps)
+    np.testing.assert_array_equal(written, timestamps)
+
+    # Segments are selected by overlap with a time range
+    start_time, end_time = segments[1]['start_time'] + 5, segments[1]['end_time'] - 5
+    assert [segment['file'] for segment in read_manifest(manifest_file, start_time, end_time)] == \
+        [segments[1]['file']]
+    assert len(read_manifest(manifest_file, start_time=segments[-1]['start_time'])) == 1
+    assert len(read_manifest(manifest_file, end_time=segments[0]['end_time'])) == 1
+
+
+def _write_observation_files(directory, nof_files=3, nof_rows=500, step=97.0, nof_channels=32):
+    """ Write consecutive observation files with (time, channel) antenna spectra, which have an LST dataset, and
+    (signal, time, channel) load spectra, which do not. The files span more than one sidereal day """
+    files, timestamps = [], 1.7e9 + step * np.arange(nof_files * nof_rows)
+    for i in range(nof_files):
+        file_name = os.path.join(str(directory), "observation_{}.hdf5".format(i))
+        part = timestamps[i * nof_rows:(i + 1) * nof_rows]
+        with h5py.File(file_name, 'w') as f:
+            group = f.create_group('observation_data')
+            group.create_dataset('obs_ant_timestamps', data=part)
+            group.create_dataset('obs_ant_lst_time', data=utils.get_sidereal_times(part, 21.4))
+            group.create_dataset('obs_ant_spectra', data=part[:, np.newaxis] + np.arange(nof_channels),
+                                 chunks=(16, nof_channels))
+            group.create_dataset('obs_load_timestamps', data=part)
+            group.create_dataset('obs_load_spectra', chunks=(2, 16, nof_channels),
+                                 data=np.stack([part[:, np.newaxis] + np.arange(nof_channels)] * 2) * [[[1]], [[-1]]])
+        files.append(file_name)
+    return files, timestamps
+
+
+@pytest.mark.parametrize("time_range, lst_range, channels", [
+    (None, None, None),
+    ((1.7e9 + 20000, 1.7e9 + 90000), None, (4, 20)),
+    (None, (100.0, 130.0), None),
+    (None, (350.0, 15.0), slice(0, 8)),
+    ((1.7e9 + 30000, 1.7e9 + 120000), (300.0, 60.0), None),
+    ((1.7e9 - 100, 1.7e9 - 1), None, None),
+])
+def test_selection_matches_brute_force(tmp_path, time_range, lst_range, channels):
+    files, timestamps = _write_observation_files(tmp_path)
+    lst = utils.get_sidereal_times(timestamps, 21.4)
+
+    mask = np.ones(len(timestamps), dtype=bool)
+    if time_range is not None:
+        mask &= (timestamps >= time_range[0]) & (timestamps <= time_range[1])
+    if lst_range is not None:
+        wrapped = np.mod(lst, 360.0)
+        if lst_range[0] <= lst_range[1]:
+            mask &= (wrapped >= lst_range[0]) & (wrapped <= lst_range[1])
+        else:
+            mask &= (wrapped >= lst_range[0]) | (wrapped <= lst_range[1])
+    channel_slice = slice(None) if channels is None else \
+        channels if isinstance(channels, slice) else slice(*channels)
+    expected = (timestamps[mask][:, np.newaxis] + np.arange(32))[:, channel_slice]
+
+    reader = ObservationReader(files, longitude=21.4)
+    try:
+        assert sorted(reader.sources) == ['obs_ant', 'obs_load']
+        for name in ['obs_ant', 'obs_load']:
+            selection = reader[name].select(time_range, lst_range, channels)
+            assert selection.nof_rows == np.count_nonzero(mask)
+            np.testing.assert_array_equal(selection.timestamps, timestamps[mask])
+            np.testing.assert_allclose(np.mod(selection.lst, 360.0), np.mod(lst[mask], 360.0), atol=1e-6)
+
+            selected_timestamps, data = selection.read()
+            np.testing.assert_array_equal(selected_timestamps, timestamps[mask])
+            if not mask.any():
+                assert data is None
+            elif name == 'obs_ant':
+                np.testing.assert_array_equal(data, expected)
+            else:
+                np.testing.assert_array_equal(data, np.stack([expected, -expected]))
+    finally:
+        reader.close()
+
+
+def test_blocks_match_full_read(tmp_path):
+    files, timestamps = _write_observation_files(tmp_path)
+    reader = ObservationReader(files, longitude=21.4)
+    try:
+        selection = reader['obs_ant'].select((timestamps[100] + 1, timestamps[1300]))
+        full_timestamps, full = selection.read()
+
+        # Small blocks are made of whole chunks, and never span files
+        blocks = list(selection.iter_blocks(max_block_size=3 * 16 * 32 * 8))
+        for block_timestamps, data in blocks:
+            assert data.shape[0] == len(block_timestamps) <= 3 * 16
+            first, last = np.searchsorted(timestamps, block_timestamps[[0, -1]])
+            assert first // 500 == last // 500
+            assert (first % 500) // 48 == (last % 500) // 48
+        np.testing.assert_array_equal(np.concatenate([block[0] for block in blocks]), full_timestamps)
+        np.testing.assert_array_equal(np.concatenate([block[1] for block in blocks]), full)
+
+        # Other datasets of the source are read along their time axis
+        _, load = reader['obs_load'].select((timestamps[100] + 1, timestamps[1300])).read()
+        np.testing.assert_array_equal(load[0], full)
+
+        # A selected signal is read as (time, channel), signals are ignored for (time, channel) datasets
+        _, signal = reader['obs_load'].select((timestamps[100] + 1, timestamps[1300]), signal=1).read()
+        np.testing.assert_array_equal(signal, load[1])
+        _, antenna = reader['obs_ant'].select((timestamps[100] + 1, timestamps[1300]), signal=1).read()
+        np.testing.assert_array_equal(antenna, full)
+    finally:
+        reader.close()
+
+
+def test_live_reader_reads_selected_signal(tmp_path):
+    files, _ = _write_observation_files(tmp_path, nof_files=1, nof_rows=40)
+    reader = LiveObservationReader(files[0])
+    try:
+        load = reader.read('observation_data/obs_load_spectra', 0, 40, axis=1)
+        np.testing.assert_array_equal(reader.read('observation_data/obs_load_spectra', 5, 9, axis=1, signal=1),
+                                      load[1, 5:9])
+        assert reader.read('observation_data/obs_load_spectra', 9, 9, axis=1, signal=1).shape == (0, 32)
+        np.testing.assert_array_equal(reader.read_new('observation_data/obs_load_spectra', axis=1, signal=0),
+                                      load[0])
+        np.testing.assert_array_equal(reader.read('observation_data/obs_ant_spectra', 0, 3, signal=1),
+                                      reader.read('observation_data/obs_ant_spectra', 0, 3))
+    finally:
+        reader.close()
+
+
+def test_selection_of_unordered_timestamps(tmp_path):
+    file_name = str(tmp_path / "observation.hdf5")
+    timestamps = 1.7e9 + np.array([0, 10, 20, 5, 15, 30, 25, 40], dtype=float)
+    with h5py.File(file_name, 'w') as f:
+        f.create_dataset('observation_data/obs_ant_timestamps', data=timestamps)
+        f.create_dataset('observation_data/obs_ant_spectra', data=np.arange(8.0)[:, np.newaxis] * np.ones(4))
+
+    reader = ObservationReader(file_name)
+    try:
+        selection = reader['obs_ant'].select((1.7e9 + 8, 1.7e9 + 26))
+        assert selection.runs == [(1, 3), (4, 5), (6, 7)]
+        np.testing.assert_array_equal(selection.read()[1][:, 0], [1, 2, 4, 6])
+
+        # LST is only computed when a longitude is given
+        with pytest.raises(ValueError):
+            reader['obs_ant'].select(lst_range=(0, 10))
+    finally:
+        reader.close()
@@ -0,0 +1,151 @@
+import numpy as np
+import h5py
+import os
+
+from reach_ctrl.observation_reduction import LSTAccumulator, LSTReduction, reduce_file, reduce_files
+from reach_ctrl import utils
+
+LONGITUDE = 21.0
+NOF_BINS = 24
+
+# Nights starting at different times, which overlap in LST
+START_TIMES = [1.7e9, 1.7e9 + 86400 + 3600, 1.7e9 + 2 * 86400 - 7200]
+
+
+def _write_night(file_name, start_time, nof_rows=300, nof_channels=16, seed=0):
+    """ Write a night of (time, channel) antenna spectra with an LST dataset, and (signal, time, channel) load
+    spectra without one. Some values are not finite
+    :return: Timestamps, antenna spectra and load spectra, with time along axis 0 """
+    random = np.random.RandomState(seed)
+    timestamps = start_time + 60.0 * np.arange(nof_rows)
+    antenna = random.uniform(1, 2, (nof_rows, nof_channels))
+    antenna[random.uniform(size=antenna.shape) < 0.01] = np.nan
+    load = random.uniform(1, 2, (2, nof_rows, nof_channels))
+    load[0, 5, 3] = np.inf
+    with h5py.File(file_name, 'w') as f:
+        group = f.create_group('observation_data')
+        group.create_dataset('obs_ant_timestamps', data=timestamps)
+        group.create_dataset('obs_ant_lst_time', data=utils.get_sidereal_times(timestamps, LONGITUDE))
+        group.create_dataset('obs_ant_spectra', data=antenna, chunks=(32, nof_channels))
+        group.create_dataset('obs_load_timestamps', data=timestamps)
+        group.create_dataset('obs_load_spectra', data=load, chunks=(2, 32, nof_channels))
+    return timestamps, antenna, np.moveaxis(load, 1, 0)
+
+
+def _write_nights(directory, start_times=START_TIMES):
+    """ Write a file per night
+    :return: File names and night data """
+    files, nights = [], []
+    for i, start_time in enumerate(start_times):
+        files.append(os.path.join(str(directory), "night_{}.hdf5".format(i)))
+        nights.append(_write_night(files[-1], start_time, seed=i))
+    return files, nights
+
+
+def _brute_force(nights, name, channels=slice(None)):
+    """ Bin every spectrum by LST one at a time, then compute the mean and standard deviation of the finite values
+    of each bin and channel """
+    index = 1 if name == 'obs_ant' else 2
+    bins = {}
+    for night in nights:
+        for timestamp, spectrum in zip(night[0], night[index]):
+            lst = float(utils.get_sidereal_times(np.array([timestamp]), LONGITUDE)[0]) % 360.0
+            bins.setdefault(int(lst * NOF_BINS // 360.0), []).append(spectrum[..., channels])
+
+    shape = (NOF_BINS,) + nights[0][index][0][..., channels].shape
+    mean, std = np.full(shape, np.nan), np.full(shape, np.nan)
+    for lst_bin, spectra in bins.items():
+        spectra = np.array(spectra)
+        finite = np.isfinite(spectra)
+        count = finite.sum(axis=0)
+        values = np.where(finite, spectra, 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean[lst_bin] = values.sum(axis=0) / count
+            std[lst_bin] = np.sqrt(np.where(finite, (values - mean[lst_bin]) ** 2, 0).sum(axis=0) / count)
+    return mean, std
+
+
+def _check(accumulator, nights, channels=slice(None)):
+    """ Check the mean and standard deviation of every source against brute-force binning """
+    assert sorted(accumulator.sources) == ['obs_ant', 'obs_load']
+    for name in accumulator.sources:
+        mean, std = _brute_force(nights, name, channels)
+        assert np.isnan(mean).any() and np.isfinite(mean).any()
+        np.testing.assert_allclose(accumulator.mean(name), mean, rtol=1e-10)
+        np.testing.assert_allclose(accumulator.std(name), std, rtol=1e-6, atol=1e-10)
+
+
+def test_reduce_file_matches_brute_force(tmp_path):
+    files, nights = _write_nights(tmp_path)
+
+    # Small blocks split the file across several calls to add
+    accumulator = reduce_file(files[0], NOF_BINS, LONGITUDE, max_block_size=20 * 16 * 8)
+    _check(accumulator, nights[:1])
+    assert list(accumulator.files) == [os.path.abspath(files[0])]
+
+    accumulator = reduce_file(files[0], NOF_BINS, LONGITUDE, sources=['obs_ant'], channels=(4, 10))
+    assert list(accumulator.sources) == ['obs_ant']
+    np.testing.assert_allclose(accumulator.mean('obs_ant'), _brute_force(nights[:1], 'obs_ant', slice(4, 10))[0])
+
+    # Sources without an LST dataset need a longitude
+    assert reduce_file(files[0], NOF_BINS) is None
+
+
+def test_reduce_file_reads_selected_signal(tmp_path, monkeypatch):
+    files, nights = _write_nights(tmp_path)
+
+    # Record the selections read from (signal, time, channel) datasets
+    selections = []
+    getitem = h5py.Dataset.__getitem__
+
+    def record(dataset, index, *args, **kwargs):
+        if dataset.ndim == 3:
+            selections.append(index)
+        return getitem(dataset, index, *args, **kwargs)
+
+    monkeypatch.setattr(h5py.Dataset, '__getitem__', record)
+    accumulator = reduce_file(files[0], NOF_BINS, LONGITUDE, signal=1, max_block_size=20 * 16 * 8)
+    monkeypatch.undo()
+
+    # Only the selected signal is read, and reduced as a (time, channel) source
+    assert len(selections) > 1 and all(selection[0] == 1 for selection in selections)
+    signal_nights = [(timestamps, antenna, load[:, 1]) for timestamps, antenna, load in nights[:1]]
+    _check(accumulator, signal_nights)
+    assert accumulator.mean('obs_load').shape == (NOF_BINS, 16)
+
+
+def test_reduce_files_matches_brute_force(tmp_path):
+    files, nights = _write_nights(tmp_path)
+
+    # The result does not depend on the number of processes, nor on the order in which partial sums are merged
+    for nof_processes in [1, 2]:
+        _check(reduce_files(files, NOF_BINS, LONGITUDE, nof_processes=nof_processes), nights)
+
+    merged = LSTAccumulator(NOF_BINS)
+    for file_name in reversed(files):
+        merged.merge(reduce_file(file_name, NOF_BINS, LONGITUDE))
+    _check(merged, nights)
+
+    # Accumulators are saved and loaded with their files
+    merged.save(str(tmp_path / "accumulator.h5"))
+    loaded = LSTAccumulator.load(str(tmp_path / "accumulator.h5"))
+    _check(loaded, nights)
+    assert loaded.files == merged.files
+
+
+def test_reduction_adds_new_files(tmp_path):
+    files, nights = _write_nights(tmp_path, START_TIMES[:2])
+    accumulator_file = str(tmp_path / "lst_average.h5")
+    reduction = LSTReduction(accumulator_file, NOF_BINS, LONGITUDE, nof_processes=1)
+    _check(reduction.update(str(tmp_path)), nights)
+
+    # Only the new night is reduced, and added to the saved partial sums
+    files.append(str(tmp_path / "night_2.hdf5"))
+    nights.append(_write_night(files[-1], START_TIMES[2], seed=2))
+    accumulator = reduction.update(str(tmp_path))
+    _check(accumulator, nights)
+    assert sorted(accumulator.files) == sorted(os.path.abspath(file_name) for file_name in files)
+    _check(LSTAccumulator.load(accumulator_file), nights)
+
+    # Files which are already reduced are not added again
+    _check(reduction.update(str(tmp_path)), nights)
@@ -0,0 +1,367 @@
+import threading
+import logging
+import shutil
+import time
+import numpy as np
+import h5py
+import pytest
+
+from reach_ctrl.observation_writer import ObservationWriter, truncate_mantissa, get_dataset_filter, get_preview_path
+from reach_ctrl.observation_reader import LiveObservationReader, ObservationReader, select_preview_level
+from reach_ctrl.spectrometer.telemetry import acquisition_statistics_dtype
+
+
+def test_round_trip(tmp_path):
+    file_name = str(tmp_path / "observation.hdf5")
+    writer = ObservationWriter(file_name, rows_per_flush=8)
+    writer.open(observation_info={'observation_name': 'test', 'start_time': 1.0})
+
+    statistics = np.zeros(1, dtype=acquisition_statistics_dtype)
+
+    def add_spectra():
+        for i in range(50):
+            statistics['nof_heaps'] = i
+            writer.append('observation_data/test_spectra', np.full((2, 64), i, dtype=np.double), axis=1, dtype='f8')
+            writer.append('observation_data/test_timestamps', i, dtype='f8')
+            writer.append('observation_data/test_receiver_statistics', statistics[0],
+                          dtype=acquisition_statistics_dtype)
+
+    def add_rms():
+        for i in range(70):
+            writer.append('observation_info/test_rms', np.concatenate(([i], np.ones(4))), dtype='f8')
+
+    # Several producers append concurrently
+    threads = [threading.Thread(target=add_spectra), threading.Thread(target=add_rms)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    writer.set_attributes('observation_info', {'channel_names': 'a, b'})
+    writer.close()
+
+    with h5py.File(file_name, 'r') as f:
+        spectra = f['observation_data/test_spectra']
+        assert spectra.shape == (2, 50, 64)
+        np.testing.assert_array_equal(spectra[0, :, 0], np.arange(50))
+        np.testing.assert_array_equal(f['observation_data/test_timestamps'][:], np.arange(50))
+        np.testing.assert_array_equal(f['observation_data/test_receiver_statistics']['nof_heaps'], np.arange(50))
+        assert f['observation_info/test_rms'].shape == (70, 5)
+        np.testing.assert_array_equal(f['observation_info/test_rms'][:, 0], np.arange(70))
+        assert f['observation_info'].attrs['observation_name'] == 'test'
+        assert f['observation_info'].attrs['channel_names'] == 'a, b'
+
+    assert writer.get_statistics()['nof_errors'] == 0
+
+
+def test_submitted_functions_run_in_order(tmp_path):
+    file_name = str(tmp_path / "observation.hdf5")
+    writer = ObservationWriter(file_name, rows_per_flush=4)
+    writer.open()
+
+    def add_derived(timestamp):
+        writer.append('observation_data/test_derived', timestamp * 2)
+
+    for i in range(10):
+        writer.append('observation_data/test_timestamps', float(i))
+        writer.submit(add_derived, float(i))
+
+    writer.close()
+
+    with h5py.File(file_name, 'r') as f:
+        np.testing.assert_array_equal(f['observation_data/test_derived'][:], 2 * np.arange(10))
+
+
+def test_datasets_sized_from_plan(tmp_path):
+    file_name = str(tmp_path / "observation.hdf5")
+    writer = ObservationWriter(file_name, rows_per_flush=4, expected_rows={'a_spectra': 40, 'b_spectra': 6},
+                               preview_levels=[(4, 4)])
+    writer.open()
+
+    for i in range(3):
+        for name in ['a', 'b', 'c']:
+            writer.append('observation_data/{}_spectra'.format(name), np.full(16, i, dtype=np.double))
+    writer.flush()
+
+    # Each dataset starts with its own planned size, previews with the planned size over their time factor, and
+    # unplanned datasets with one chunk
+    capacities = {path: dataset.dataset.shape[0] for path, dataset in writer._datasets.items()}
+    assert capacities['observation_data/a_spectra'] == 40
+    assert capacities['observation_data/b_spectra'] == 6
+    assert capacities['observation_data/c_spectra'] == 4
+    assert capacities['observation_preview/a_spectra_f4_t4'] == 10
+    assert capacities['observation_preview/b_spectra_f4_t4'] == 2
+    assert capacities['observation_preview/c_spectra_f4_t4'] == 4
+
+    # Datasets grow beyond their plan, and are trimmed to the rows written on close
+    for i in range(3, 10):
+        writer.append('observation_data/b_spectra', np.full(16, i, dtype=np.double))
+    writer.close()
+
+    with h5py.File(file_name, 'r') as f:
+        assert f['observation_data/a_spectra'].shape == (3, 16)
+        np.testing.assert_array_equal(f['observation_data/b_spectra'][:, 0], np.arange(10))
+        assert f['observation_preview/a_spectra_f4_t4'].shape == (1, 4)
+        assert f['observation_preview/b_spectra_f4_t4'].shape == (3, 4)
+
+
+@pytest.mark.parametrize("compression_processes", [0, 2])
+def test_rows_written_survive_crash(tmp_path, compression_processes):
+    file_name = str(tmp_path / "observation.hdf5")
+    filters = {'*_spectra': {'compression': 'gzip'}}
+    writer = ObservationWriter(file_name, rows_per_flush=4, expected_rows={'obs_ant_spectra': 40,
+                                                                           'obs_ant_timestamps': 40},
+                               dataset_filters=filters, compression_processes=compression_processes)
+    writer.open()
+    for i in range(11):
+        writer.append('observation_data/obs_ant_spectra', np.full(16, i + 1, dtype=np.double))
+        writer.append('observation_data/obs_ant_timestamps', 1.7e9 + i)
+    writer.flush()
+
+    # A copy of the file after the flush is what remains if the writer stops without closing the file. Datasets
+    # keep their planned size, the rows written are in the nof_rows attribute
+    crashed_file = str(tmp_path / "crashed.hdf5")
+    shutil.copy(file_name, crashed_file)
+    writer.close()
+
+    with h5py.File(crashed_file, 'r') as f:
+        assert f['observation_data/obs_ant_spectra'].shape == (40, 16)
+        assert f['observation_data/obs_ant_spectra'].attrs['nof_rows'] == 11
+        assert f['observation_data/obs_ant_timestamps'].attrs['nof_rows'] == 11
+
+    reader = LiveObservationReader(crashed_file)
+    try:
+        assert reader.nof_rows('observation_data/obs_ant_spectra') == 11
+        assert reader.read_latest('observation_data/obs_ant_spectra')[0] == 11
+    finally:
+        reader.close()
+
+    reader = ObservationReader(crashed_file)
+    try:
+        timestamps, spectra = reader['obs_ant'].select().read()
+        np.testing.assert_array_equal(timestamps, 1.7e9 + np.arange(11))
+        np.testing.assert_array_equal(spectra[:, 0], np.arange(1, 12))
+    finally:
+        reader.close()
+
+    # Writing continues after the rows written, and the file is trimmed when closed
+    writer = ObservationWriter(crashed_file, rows_per_flush=4)
+    writer.open(mode='a')
+    writer.append('observation_data/obs_ant_spectra', np.full(16, 12, dtype=np.double))
+    writer.close()
+    with h5py.File(crashed_file, 'r') as f:
+        np.testing.assert_array_equal(f['observation_data/obs_ant_spectra'][:, 0], np.arange(1, 13))
+        assert f['observation_data/obs_ant_spectra'].attrs['nof_rows'] == 12
+
+
+def test_chunk_cache_size(tmp_path, caplog):
+    # Chunks of four rows of two 16384 channel spectra are 1 MB, larger than the default HDF5 chunk cache
+    file_name = str(tmp_path / "observation.hdf5")
+    writer = ObservationWriter(file_name, rows_per_flush=4, chunk_cache_size=4 * 1024 * 1024)
+    writer.open()
+    writer.append('observation_data/obs_ant_spectra', np.ones((2, 16384)))
+    writer.flush()
+    assert writer._file.id.get_access_plist().get_cache()[2] == 4 * 1024 * 1024
+    writer.close()
+
+    writer = ObservationWriter(file_name, rows_per_flush=4, chunk_cache_size=512 * 1024)
+    writer.open()
+    with caplog.at_level(logging.WARNING):
+        writer.append('observation_data/obs_ant_spectra', np.ones((2, 16384)))
+        writer.close()
+    assert "do not fit in the chunk cache" in caplog.text
+
+
+def test_slow_writer_blocks_producers(tmp_path):
+    file_name = str(tmp_path / "observation.hdf5")
+    writer = ObservationWriter(file_name, rows_per_flush=4, max_queue_size=4)
+    writer.open()
+
+    def add_slowly(value):
+        time.sleep(0.01)
+        writer.append('observation_data/test_derived', value)
+
+    for i in range(30):
+        writer.append('observation_data/test_timestamps', float(i))
+        writer.submit(add_slowly, float(i))
+
+    # The queue is bounded, so producers are blocked rather than queueing without limit
+    statistics = writer.get_statistics()
+    assert statistics['nof_blocked'] > 0
+    assert statistics['blocked_time'] > 0
+    assert statistics['max_queue_depth'] <= 4
+    writer.close()
+
+    with h5py.File(file_name, 'r') as f:
+        np.testing.assert_array_equal(f['observation_data/test_derived'][:], np.arange(30))
+        np.testing.assert_array_equal(f['observation_data/test_timestamps'][:], np.arange(30))
+
+
+def _fail():
+    raise IOError("disk full")
+
+
+def test_writer_errors_are_raised_to_producers(tmp_path):
+    writer = ObservationWriter(str(tmp_path / "observation.hdf5"))
+    writer.open()
+
+    writer.submit(_fail)
+    with pytest.raises(IOError, match="disk full"):
+        writer.flush()
+
+    # The error keeps being raised, except by close once it has been reported
+    with pytest.raises(IOError, match="disk full"):
+        writer.append('observation_data/test_timestamps', 1.0)
+    writer.close()
+    assert writer.get_statistics()['nof_errors'] == 1
+
+
+def test_writer_error_raised_on_close(tmp_path):
+    writer = ObservationWriter(str(tmp_path / "observation.hdf5"))
+    writer.open()
+
+    # The error happens after the last append was queued
+    appended = threading.Event()
+
+    def fail_later():
+        appended.wait()
+        _fail()
+
+    writer.submit(fail_later)
+    writer.append('observation_data/test_timestamps', 1.0)
+    appended.set()
+    with pytest.raises(IOError, match="disk full"):
+        writer.close()
+
+
+def _noisy_spectra(nof_rows, nof_channels=1024):
+    """ Spectra with a smooth bandpass and noise, like real spectra """
+    random = np.random.RandomState(0)
+    bandpass = 1e9 * np.exp(-np.linspace(0, 3, nof_channels))
+    return bandpass * (1 + 0.01 * random.standard_normal((nof_rows, nof_channels)))
+
+
+def test_truncate_mantissa():
+    data = _noisy_spectra(4)
+    truncated = truncate_mantissa(data.copy(), 10)
+
+    # Relative error is bounded by half of the last kept mantissa bit, and the dropped bits are zero
+    assert np.max(np.abs(truncated / data - 1)) <= 2.0 ** -11
+    assert np.all(truncated.view(np.uint64) & np.uint64((1 << 42) - 1) == 0)
+
+    special = np.array([np.inf, -np.inf, np.nan, 0.0])
+    truncated = truncate_mantissa(special.copy(), 10)
+    assert np.isposinf(truncated[0]) and np.isneginf(truncated[1]) and np.isnan(truncated[2]) and truncated[3] == 0
+
+
+def test_dataset_filters(tmp_path):
+    file_name = str(tmp_path / "observation.hdf5")
+    filters = {'*_spectra': {'compression': 'gzip', 'compression_level': 4, 'shuffle': True, 'mantissa_bits': 16},
+               '*_float': {'compression': 'lzf', 'dtype': 'float32'}}
+    assert get_dataset_filter(filters, 'observation_data/test_spectra')['compression'] == 'gzip'
+    assert get_dataset_filter(filters, 'observation_data/test_timestamps') == {}
+
+    spectra = _noisy_spectra(40)
+    writer = ObservationWriter(file_name, rows_per_flush=8, dataset_filters=filters)
+    writer.open()
+    for i, spectrum in enumerate(spectra):
+        writer.append('observation_data/test_spectra', spectrum)
+        writer.append('observation_data/test_float', spectrum)
+        writer.append('observation_data/test_timestamps', 1e9 + i)
+    writer.close()
+
+    with h5py.File(file_name, 'r') as f:
+        dataset = f['observation_data/test_spectra']
+        assert dataset.compression == 'gzip' and dataset.compression_opts == 4 and dataset.shuffle
+        assert dataset.attrs['mantissa_bits'] == 16
+        np.testing.assert_allclose(dataset[:], spectra, rtol=2.0 ** -17)
+        assert dataset.id.get_storage_size() < spectra.nbytes / 2
+
+        dataset = f['observation_data/test_float']
+        assert dataset.compression == 'lzf' and dataset.dtype == np.float32
+        np.testing.assert_allclose(dataset[:], spectra, rtol=1e-7)
+
+        # Datasets without filters are stored as they are
+        dataset = f['observation_data/test_timestamps']
+        assert dataset.compression is None
+        np.testing.assert_array_equal(dataset[:], 1e9 + np.arange(40))
+
+
+def test_direct_chunk_writes_match_filter_pipeline(tmp_path):
+    filters = {'*_spectra': {'compression': 'gzip', 'compression_level': 4, 'shuffle': True, 'mantissa_bits': 20}}
+    spectra = _noisy_spectra(45)
+
+    # Write the same spectra through the HDF5 filter pipeline and with chunks compressed in a process pool.
+    # Flushes in the middle leave chunks which are partly written by each path
+    files = {}
+    for nof_processes in [0, 2]:
+        file_name = str(tmp_path / "observation_{}.hdf5".format(nof_processes))
+        writer = ObservationWriter(file_name, rows_per_flush=8, dataset_filters=filters,
+                                   compression_processes=nof_processes)
+        writer.open()
+        for i, spectrum in enumerate(spectra):
+            writer.append('observation_data/test_spectra', spectrum)
+            if i == 20:
+                writer.flush()
+        writer.close()
+        files[nof_processes] = file_name
+
+    with h5py.File(files[0], 'r') as pipeline, h5py.File(files[2], 'r') as direct:
+        pipeline_dataset = pipeline['observation_data/test_spectra']
+        direct_dataset = direct['observation_data/test_spectra']
+        np.testing.assert_array_equal(pipeline_dataset[:], direct_dataset[:])
+
+        # Stored chunks are byte for byte identical
+        for row in range(0, spectra.shape[0], 8):
+            assert pipeline_dataset.id.read_direct_chunk((row, 0)) == direct_dataset.id.read_direct_chunk((row, 0))
+
+
+def _brute_force_preview(spectra, frequency_factor, time_factor):
+    """ Average spectra (time, ..., channel) over groups of rows and channels, one group at a time """
+    nof_rows, nof_channels = spectra.shape[0], spectra.shape[-1]
+    preview = []
+    for row in range(0, nof_rows, time_factor):
+        averages = []
+        for channel in range(0, nof_channels, frequency_factor):
+            averages.append(np.mean(spectra[row:row + time_factor, ..., channel:channel + frequency_factor],
+                                    axis=(0, -1)))
+        preview.append(np.stack(averages, axis=-1))
+    return np.array(preview)
+
+
+@pytest.mark.parametrize("axis", [0, 1])
+def test_previews_match_brute_force_averages(tmp_path, axis):
+    file_name = str(tmp_path / "observation.hdf5")
+    levels = [(16, 1), (64, 4), (256, 16)]
+    writer = ObservationWriter(file_name, rows_per_flush=8, preview_levels=levels)
+    writer.open()
+
+    # Spectra are (time, channel) or (signal, time, channel). Channels and rows are not multiples of the factors,
+    # so the last group of each level is partial
+    spectra = np.random.RandomState(0).uniform(1, 2, (45, 2, 1000) if axis == 1 else (45, 1000))
+    for spectrum in spectra:
+        writer.append('observation_data/test_spectra', spectrum, axis=axis)
+        writer.append('observation_data/test_timestamps', 0.0)
+    writer.close()
+
+    with h5py.File(file_name, 'r') as f:
+        # Previews are only written for spectra
+        assert sorted(f['observation_preview']) == ['test_spectra_f16_t1', 'test_spectra_f256_t16',
+                                                    'test_spectra_f64_t4']
+        for frequency_factor, time_factor in levels:
+            dataset = f[get_preview_path('observation_data/test_spectra', frequency_factor, time_factor)]
+            assert dataset.dtype == np.float32
+            assert dataset.attrs['source'] == 'observation_data/test_spectra'
+            preview = np.moveaxis(dataset[:], axis, 0)
+            assert preview.shape[0] == -(-45 // time_factor)
+            assert preview.shape[-1] == -(-1000 // frequency_factor)
+            np.testing.assert_allclose(preview, _brute_force_preview(spectra, frequency_factor, time_factor),
+                                       rtol=1e-6)
+
+        # The coarsest level with the requested resolution is selected, full resolution if none has it
+        path = 'observation_data/test_spectra'
+        assert select_preview_level(f, path, axis=axis) == ('observation_preview/test_spectra_f256_t16', 256, 16)
+        assert select_preview_level(f, path, nof_channels=10, nof_rows=5, axis=axis)[1:] == (64, 4)
+        assert select_preview_level(f, path, nof_channels=60, nof_rows=20, axis=axis)[1:] == (16, 1)
+        assert select_preview_level(f, path, nof_channels=100, axis=axis) == (path, 1, 1)
+        assert select_preview_level(f, path, nof_rows=46, axis=axis) == (path, 1, 1)
@@ -0,0 +1,162 @@
+import importlib.util
+import numpy as np
+import pytest
+import h5py
+import os
+
+pytest.importorskip("matplotlib")
+
+from reach_ctrl.observation_reader import LiveObservationReader
+from reach_ctrl.observation_writer import ObservationWriter
+
+# The plotting script is not part of the package, it is loaded from its path
+_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts",
+                       "plot_observation_file.py")
+_spec = importlib.util.spec_from_file_location("plot_observation_file", _SCRIPT)
+plot_observation_file = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(plot_observation_file)
+
+
+def _brute_force_grid(spectra, width, height, statistic):
+    """ Reduce (time, channel) spectra to a grid one cell at a time, ignoring non-finite values """
+    nof_rows, nof_channels = spectra.shape
+    rows = np.arange(nof_rows) * height // nof_rows
+    channels = np.arange(nof_channels) * width // nof_channels
+    grid = np.full((height, width), np.nan)
+    for i in range(height):
+        for j in range(width):
+            values = spectra[rows == i][:, channels == j]
+            values = values[np.isfinite(values)]
+            if values.size:
+                grid[i, j] = {'mean': np.mean, 'max': np.max, 'min': np.min}[statistic](values)
+    return grid
+
+
+def _write_spectra(file_name, spectra, axis=0, preview_levels=None):
+    """ Write spectra (time, channel) with ObservationWriter, as (signal, time, channel) if axis is 1 """
+    writer = ObservationWriter(file_name, rows_per_flush=8, preview_levels=preview_levels)
+    writer.open()
+    for spectrum in spectra:
+        writer.append('observation_data/obs_ant_spectra', np.stack([spectrum, -spectrum]) if axis else spectrum,
+                      axis=axis)
+    writer.close()
+
+
+@pytest.fixture
+def spectra():
+    spectra = np.random.RandomState(0).uniform(1, 100, (101, 333))
+    spectra[7, 10:20] = np.nan
+    spectra[50:60, 5] = np.inf
+    return spectra
+
+
+@pytest.mark.parametrize("statistic", ["mean", "max", "min"])
+@pytest.mark.parametrize("width, height", [(64, 32), (1000, 1000), (100, 7)])
+def test_waterfall_matches_brute_force(tmp_path, spectra, statistic, width, height):
+    file_name = str(tmp_path / "observation.hdf5")
+    _write_spectra(file_name, spectra)
+
+    reader = LiveObservationReader(file_name)
+    try:
+        # Small blocks reduce the dataset in several reads, with cells split across blocks
+        grid = plot_observation_file.reduce_waterfall(reader, 'observation_data/obs_ant_spectra', width=width,
+                                                      height=height, statistic=statistic, max_block_size=9 * 333 * 8)
+    finally:
+        reader.close()
+
+    expected = _brute_force_grid(spectra, min(width, 333), min(height, 101), statistic)
+    assert grid.shape == expected.shape
+    np.testing.assert_allclose(grid, expected, rtol=1e-12)
+
+
+def test_waterfall_of_signal(tmp_path, spectra, monkeypatch):
+    file_name = str(tmp_path / "observation.hdf5")
+    _write_spectra(file_name, spectra, axis=1)
+
+    # Record the selections read from (signal, time, channel) datasets
+    selections = []
+    getitem = h5py.Dataset.__getitem__
+
+    def record(dataset, index, *args, **kwargs):
+        if dataset.ndim == 3:
+            selections.append(index)
+        return getitem(dataset, index, *args, **kwargs)
+
+    reader = LiveObservationReader(file_name)
+    try:
+        monkeypatch.setattr(h5py.Dataset, '__getitem__', record)
+        grid = plot_observation_file.reduce_waterfall(reader, 'observation_data/obs_ant_spectra', axis=1, signal=1,
+                                                      width=50, height=20, statistic="min",
+                                                      max_block_size=9 * 333 * 8)
+        monkeypatch.undo()
+    finally:
+        reader.close()
+    np.testing.assert_allclose(grid, _brute_force_grid(-spectra, 50, 20, "min"))
+
+    # Only the selected signal is read, in blocks of the requested size
+    assert len(selections) == -(-101 // 9)
+    assert all(selection[0] == 1 and selection[1].stop - selection[1].start <= 9 for selection in selections)
+
+
+def test_waterfall_uses_previews(tmp_path):
+    file_name = str(tmp_path / "observation.hdf5")
+    spectra = np.random.RandomState(1).uniform(1, 100, (96, 320))
+    _write_spectra(file_name, spectra, preview_levels=[(16, 1), (64, 4)])
+
+    # Preview cells average whole groups of channels and spectra, so the mean matches the full resolution grid.
+    # The max is always reduced from full resolution spectra
+    reader = LiveObservationReader(file_name)
+    try:
+        path = 'observation_data/obs_ant_spectra'
+        assert reader.select_preview(path, nof_channels=5, nof_rows=24)[1:] == (64, 4)
+        grid = plot_observation_file.reduce_waterfall(reader, path, width=5, height=24)
+        np.testing.assert_allclose(grid, _brute_force_grid(spectra, 5, 24, "mean"), rtol=1e-5)
+        grid = plot_observation_file.reduce_waterfall(reader, path, width=5, height=24, statistic="max")
+        np.testing.assert_array_equal(grid, _brute_force_grid(spectra, 5, 24, "max"))
+    finally:
+        reader.close()
+
+
+def test_waterfall_cache_and_render(tmp_path, spectra, monkeypatch):
+    file_name = str(tmp_path / "observation.hdf5")
+    _write_spectra(file_name, spectra)
+    cache_directory = str(tmp_path / "cache")
+
+    reader = LiveObservationReader(file_name)
+    try:
+        path = 'observation_data/obs_ant_spectra'
+        grid = plot_observation_file.get_waterfall(reader, path, width=64, height=32,
+                                                   cache_directory=cache_directory)
+        assert len(os.listdir(cache_directory)) == 1
+
+        # Cached grids are returned without reading the file, other parameters are reduced again
+        def fail(*args, **kwargs):
+            raise AssertionError("Waterfall reduced again")
+
+        monkeypatch.setattr(plot_observation_file, 'reduce_waterfall', fail)
+        np.testing.assert_array_equal(plot_observation_file.get_waterfall(reader, path, width=64, height=32,
+                                                                          cache_directory=cache_directory), grid)
+        with pytest.raises(AssertionError):
+            plot_observation_file.get_waterfall(reader, path, width=64, height=32, statistic="max",
+                                                cache_directory=cache_directory)
+        monkeypatch.undo()
+
+        # Grids with empty cells are rendered, with or without the quicklook panels
+        for quicklook in [False, True]:
+            output = str(tmp_path / "waterfall_{}.png".format(quicklook))
+            plot_observation_file.render_waterfall(grid, output, "test", 333, (1.7e9, 1.7e9 + 3600), quicklook)
+            with open(output, 'rb') as f:
+                assert f.read(8) == b'\x89PNG\r\n\x1a\n'
+    finally:
+        reader.close()
+
+    # Empty datasets have no waterfall
+    writer = ObservationWriter(str(tmp_path / "empty.hdf5"))
+    writer.open()
+    writer.create_dataset('observation_data/obs_ant_spectra', (16,), 'f8')
+    writer.close()
+    reader = LiveObservationReader(str(tmp_path / "empty.hdf5"))
+    try:
+        assert plot_observation_file.reduce_waterfall(reader, 'observation_data/obs_ant_spectra') is None
+    finally:
+        reader.close()
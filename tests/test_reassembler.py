@@ -0,0 +1,201 @@
+import time
+import numpy as np
+
+from reach_ctrl.spectrometer.reassembler import HeapReassembler
+from reach_ctrl.spectrometer.spead_generator import SpeadGenerator, ramp_spectrum
+from reach_ctrl.spectrometer.spectra import Spectra
+from reach_ctrl.spectrometer import spead
+
+NOF_ROWS = 2
+ROW_LENGTH = 64
+PACKET_LENGTH = 16
+NOF_PACKETS = NOF_ROWS * ROW_LENGTH // PACKET_LENGTH
+
+
+def _header(timestamp, sync_time=1000):
+    """ Decoded header of a packet """
+    header = np.zeros(1, dtype=spead.header_dtype)[0]
+    header['timestamp'] = timestamp
+    header['sync_time'] = sync_time
+    return header
+
+
+def _packet(timestamp, packet):
+    """ Header, row, offset and payload of a packet. Payload values identify the heap and the position """
+    row, offset = divmod(packet * PACKET_LENGTH, ROW_LENGTH)
+    payload = 1000.0 * timestamp + row * ROW_LENGTH + offset + np.arange(PACKET_LENGTH)
+    return _header(timestamp), row, offset, payload
+
+
+def _heap_data(timestamp):
+    """ Expected data of a complete heap """
+    return (1000.0 * timestamp + np.arange(NOF_ROWS * ROW_LENGTH)).reshape(NOF_ROWS, ROW_LENGTH)
+
+
+def _reassembler(**kwargs):
+    """ Reassembler of heaps with NOF_PACKETS packets """
+    return HeapReassembler(NOF_ROWS, ROW_LENGTH, PACKET_LENGTH, **kwargs)
+
+
+def test_interleaved_heaps():
+    reassembler = _reassembler(nof_heaps=4)
+
+    # Packets of three heaps arrive interleaved and out of order
+    packets = [(timestamp, packet) for timestamp in [1, 2, 3] for packet in range(NOF_PACKETS)]
+    order = np.random.RandomState(0).permutation(len(packets))
+    heaps = []
+    for index in order:
+        reassembler.add_packet(*_packet(*packets[index]))
+        heap = reassembler.pop_heap()
+        while heap is not None:
+            heaps.append((int(heap.header['timestamp']), heap.complete, heap.data.copy()))
+            heap = reassembler.pop_heap()
+
+    # Heaps are returned complete, in timestamp order
+    assert [heap[:2] for heap in heaps] == [(1, True), (2, True), (3, True)]
+    for timestamp, _, data in heaps:
+        np.testing.assert_array_equal(data, _heap_data(timestamp))
+    assert reassembler.nof_late_packets == reassembler.nof_duplicate_packets == reassembler.nof_dropped_heaps == 0
+
+
+def test_late_and_duplicate_packets():
+    reassembler = _reassembler()
+
+    reassembler.add_packet(*_packet(2, 0))
+    header, row, offset, payload = _packet(2, 0)
+    reassembler.add_packet(header, row, offset, payload + 1)
+    assert reassembler.nof_duplicate_packets == 1
+
+    for packet in range(1, NOF_PACKETS):
+        reassembler.add_packet(*_packet(2, packet))
+    heap = reassembler.pop_heap()
+    assert heap.complete
+
+    # The first copy of a duplicate packet is kept
+    np.testing.assert_array_equal(heap.data, _heap_data(2))
+
+    # Packets of returned heaps and of older heaps are late
+    reassembler.add_packet(*_packet(2, 3))
+    reassembler.add_packet(*_packet(1, 0))
+    assert reassembler.nof_late_packets == 2
+    assert reassembler.pop_heap() is None
+
+    # A new sync time restarts timestamps
+    header, row, offset, payload = _packet(1, 0)
+    header['sync_time'] = 2000
+    reassembler.add_packet(header, row, offset, payload)
+    assert reassembler.nof_late_packets == 2
+    assert reassembler.pop_heap(flush=True).header['timestamp'] == 1
+
+
+def test_timeout_returns_partial_heap():
+    reassembler = _reassembler(timeout=0.05)
+    received = [0, 2, 3, 6]
+    for packet in received:
+        reassembler.add_packet(*_packet(5, packet))
+
+    assert reassembler.pop_heap() is None
+    time.sleep(0.1)
+    heap = reassembler.pop_heap()
+    assert not heap.complete
+    np.testing.assert_array_equal(np.flatnonzero(heap.packet_mask), received)
+
+    # Received packets are in place, missing packets are zero
+    expected = _heap_data(5).reshape(NOF_PACKETS, PACKET_LENGTH)
+    expected[~heap.packet_mask] = 0
+    np.testing.assert_array_equal(heap.data, expected.reshape(NOF_ROWS, ROW_LENGTH))
+    assert reassembler.pop_heap() is None
+
+
+def test_partial_heap_valid_mask():
+    nof_channels = 256
+    generator = SpeadGenerator(nof_channels=nof_channels)
+    spectra = Spectra("127.0.0.1", nof_channels=nof_channels, heap_timeout=0.05)
+    packets = generator.build_heap(ramp_spectrum(2, nof_channels), 10)
+    headers, valid = spead.decode_spead_headers(packets)
+    assert np.all(valid)
+
+    # Drop some packets of the heap
+    lost = [1, 2]
+    for i, (header, packet) in enumerate(zip(headers, packets)):
+        if i not in lost:
+            spectra._add_packet_to_buffer(header, packet[spead.HEADER_LENGTH:].view('<f8'))
+    assert spectra._pop_spectrum() is None
+    time.sleep(0.1)
+    _, spectrum = spectra._pop_spectrum()
+
+    # The values of lost packets are those which the firmware placed in them, in (signal, channel) order
+    expected_valid = np.ones(2 * nof_channels, dtype=bool)
+    for i in lost:
+        row = headers[i]['start_antenna_id']
+        packet = (row * nof_channels + headers[i]['start_channel_id']) // generator._values_per_packet
+        expected_valid[generator._gather_index[packet]] = False
+    expected_valid = expected_valid.reshape(2, nof_channels)
+
+    np.testing.assert_array_equal(spectra.valid_mask, expected_valid)
+    np.testing.assert_array_equal(spectrum[expected_valid], ramp_spectrum(2, nof_channels)[expected_valid])
+    assert np.all(spectrum[~expected_valid] == 0)
+    assert spectra.heap_statistics['received_packets'] == generator.nof_packets_per_heap - len(lost)
+
+
+def test_heaps_beyond_table_size():
+    reassembler = _reassembler(nof_heaps=2, timeout=60)
+    reassembler.add_packet(*_packet(1, 0))
+    reassembler.add_packet(*_packet(2, 0))
+
+    # A third heap pushes the oldest one out of the table, and it is returned before timing out
+    reassembler.add_packet(*_packet(3, 0))
+    heap = reassembler.pop_heap()
+    assert heap.header['timestamp'] == 1
+    assert not heap.complete
+    assert reassembler.pop_heap() is None
+
+    # Heaps which are pushed out but not returned are dropped when no slot is free. Heap 4 pushes out heap 2,
+    # heap 5 pushes out heap 3 and drops heap 2
+    reassembler.add_packet(*_packet(4, 0))
+    reassembler.add_packet(*_packet(5, 0))
+    assert reassembler.nof_dropped_heaps == 1
+    assert reassembler.pop_heap().header['timestamp'] == 3
+    assert reassembler.pop_heap() is None
+    assert [int(reassembler.pop_heap(flush=True).header['timestamp']) for _ in range(2)] == [4, 5]
+    assert reassembler.pop_heap(flush=True) is None
+
+
+def test_out_of_range_packets_are_dropped():
+    reassembler = _reassembler()
+    header, _, _, payload = _packet(1, 0)
+
+    # Rows outside the heap, offset past the row, packet ending past the row, misaligned offset and short payload
+    for row, offset, data in [(NOF_ROWS, 0, payload), (0, 10 * ROW_LENGTH, payload), (-1, 0, payload),
+                              (0, ROW_LENGTH - PACKET_LENGTH // 2, payload), (0, 1, payload),
+                              (0, 0, payload[:4])]:
+        reassembler.add_packet(header, row, offset, data)
+    assert reassembler.nof_invalid_packets == 6
+    assert reassembler.pop_heap(flush=True) is None
+
+    # The heap is still reassembled from valid packets
+    for packet in range(NOF_PACKETS):
+        reassembler.add_packet(*_packet(1, packet))
+    heap = reassembler.pop_heap()
+    assert heap.complete
+    np.testing.assert_array_equal(heap.data, _heap_data(1))
+
+
+def test_out_of_range_packets_are_counted_by_receiver():
+    nof_channels = 256
+    generator = SpeadGenerator(nof_channels=nof_channels)
+    spectra = Spectra("127.0.0.1", nof_channels=nof_channels)
+    packets = generator.build_heap(ramp_spectrum(2, nof_channels), 10)
+    headers, _ = spead.decode_spead_headers(packets)
+
+    # A packet placed outside the heap is dropped, rather than stopping the receiver
+    stray = headers[0].copy()
+    stray['start_channel_id'] = 10 * nof_channels
+    spectra._add_packet_to_buffer(stray, packets[0, spead.HEADER_LENGTH:].view('<f8'))
+
+    for header, packet in zip(headers, packets):
+        spectra._add_packet_to_buffer(header, packet[spead.HEADER_LENGTH:].view('<f8'))
+    _, spectrum = spectra._pop_spectrum()
+    np.testing.assert_array_equal(spectrum, ramp_spectrum(2, nof_channels))
+    assert spectra.heap_statistics['invalid_packets'] == 1
+    assert spectra.heap_statistics['received_packets'] == generator.nof_packets_per_heap
@@ -0,0 +1,131 @@
+import logging
+import socket
+import numpy as np
+import pytest
+
+from reach_ctrl.spectrometer.spead_generator import SpeadGenerator, ramp_spectrum
+from reach_ctrl.spectrometer.spectra import Spectra
+from reach_ctrl.spectrometer import spead
+
+NOF_CHANNELS = 1024
+
+
+def _heap(nof_signals=2, floating_point=True):
+    """ Packets of a generated heap, and their header items as 64-bit words """
+    generator = SpeadGenerator(nof_signals=nof_signals, nof_channels=NOF_CHANNELS, floating_point=floating_point)
+    spectrum = ramp_spectrum(nof_signals, NOF_CHANNELS)
+    packets = generator.build_heap(spectrum if floating_point else spectrum.astype(np.uint64), 1234, 7).copy()
+    return packets, packets[:, :spead.HEADER_LENGTH].view('>u8')
+
+
+def _item(spead_id, value):
+    """ Encode a header item """
+    return (spead_id << 48) | value
+
+
+def _decode(packets, lengths=None, nof_signals=2):
+    """ Decode packets with the range checks used by the receiver """
+    channels_per_packet = 128 // (nof_signals // 2)
+    return spead.decode_spead_headers(packets, lengths, 1024, NOF_CHANNELS, channels_per_packet, nof_signals)
+
+
+def test_items_in_any_position():
+    packets, items = _heap()
+    expected, valid = _decode(packets)
+    assert np.all(valid)
+    assert np.all(expected['timestamp'] == 1234) and np.all(expected['heap_counter'] == 7)
+    assert np.all(expected['flags'] == spead.FLAG_FLOATING_POINT)
+
+    # The same items in another order decode to the same headers, whether every packet or only some packets
+    # have the other order
+    permutation = np.r_[0, np.random.RandomState(0).permutation(np.arange(1, spead.NOF_HEADER_ITEMS))]
+    for reordered in [slice(None), slice(0, None, 3)]:
+        shuffled = packets.copy()
+        shuffled_items = shuffled[:, :spead.HEADER_LENGTH].view('>u8')
+        shuffled_items[reordered] = items[reordered][:, permutation]
+        headers, valid = _decode(shuffled)
+        assert np.all(valid)
+        np.testing.assert_array_equal(headers, expected)
+
+
+def test_unknown_items_are_flagged(caplog):
+    packets, items = _heap()
+    items[5:8, 7] = _item(0x1234, 99)
+
+    headers, valid = _decode(packets)
+    flagged = (headers['flags'] & spead.FLAG_UNKNOWN_ITEM) != 0
+    np.testing.assert_array_equal(np.flatnonzero(flagged), [5, 6, 7])
+
+    # Other items are still decoded
+    assert np.all(headers['start_channel_id'][5:8] > 0)
+    with caplog.at_level(logging.ERROR):
+        spead.log_header_errors(headers, valid)
+    assert "Unexpected SPEAD header items in 3 packets" in caplog.text
+
+
+def test_truncated_and_corrupt_packets_are_invalid():
+    packets, items = _heap()
+    lengths = np.full(packets.shape[0], packets.shape[1])
+
+    # Truncated payloads, and packets without the SPEAD magic item
+    lengths[1] = spead.HEADER_LENGTH + 1023
+    lengths[2] = spead.HEADER_LENGTH
+    items[3, 0] = _item(0x1234, 0)
+
+    _, valid = _decode(packets, lengths)
+    np.testing.assert_array_equal(np.flatnonzero(~valid), [1, 2, 3])
+
+    # Without lengths, packets are assumed to be complete
+    _, valid = _decode(packets)
+    np.testing.assert_array_equal(np.flatnonzero(~valid), [3])
+
+
+@pytest.mark.parametrize("nof_signals", [2, 4])
+def test_out_of_range_packets_are_invalid(nof_signals, caplog):
+    packets, items = _heap(nof_signals)
+    headers, valid = _decode(packets, nof_signals=nof_signals)
+    assert np.all(valid)
+
+    # Start channel past the heap, packet ending past the heap, misaligned start channel, antenna past the
+    # number of signals and a payload length other than the configured one
+    channels_per_packet = 128 // (nof_signals // 2)
+    for packet, start_channel in [(0, 10 * NOF_CHANNELS), (1, NOF_CHANNELS - channels_per_packet // 2), (2, 1)]:
+        items[packet, 6] = _item(spead.CHANNEL_INFO, start_channel << 24)
+    items[3, 6] = _item(spead.CHANNEL_INFO, nof_signals << 8)
+    items[4, 2] = _item(spead.PAYLOAD_LENGTH, 512)
+
+    headers, valid = _decode(packets, nof_signals=nof_signals)
+    np.testing.assert_array_equal(np.flatnonzero(~valid), [0, 1, 2, 3, 4])
+    np.testing.assert_array_equal(np.flatnonzero(headers['flags'] & spead.FLAG_OUT_OF_RANGE), [0, 1, 2, 3, 4])
+
+    with caplog.at_level(logging.ERROR):
+        spead.log_header_errors(headers, valid)
+    assert "Discarded 5 invalid SPEAD packets" in caplog.text
+    assert "out of range in 5 SPEAD packets" in caplog.text
+
+    # Range checks are only applied when the heap layout is given
+    _, valid = spead.decode_spead_headers(packets)
+    assert np.all(valid)
+
+
+@pytest.mark.parametrize("floating_point", [True, False])
+def test_floating_point_mismatch_is_dropped(floating_point):
+    packets, _ = _heap(floating_point=floating_point)
+    headers, _ = _decode(packets)
+    assert np.all(((headers['flags'] & spead.FLAG_FLOATING_POINT) != 0) == floating_point)
+
+    # The receiver drops packets whose floating point mode does not match its own
+    spectra = Spectra("127.0.0.1", port=0, nof_channels=NOF_CHANNELS, floating_point=True)
+    spectra.initialise()
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for packet in packets[:4]:
+            sender.sendto(packet.tobytes(), spectra._socket.getsockname())
+        nof_received = 0
+        while nof_received < 4:
+            spectra._receive_packets()
+            assert np.all(spectra._batch_valid == floating_point)
+            nof_received += spectra._batch_nof_packets
+    finally:
+        sender.close()
+        spectra.close()
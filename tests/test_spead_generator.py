@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from reach_ctrl.spectrometer.spead_generator import SpeadGenerator, ramp_spectrum
+from reach_ctrl.spectrometer.spectra import compute_reorder_index
+from reach_ctrl.spectrometer import spead
+
+
+@pytest.mark.parametrize("nof_signals", [2, 4])
+@pytest.mark.parametrize("floating_point", [True, False])
+def test_receiver_reorder_recovers_generated_spectrum(nof_signals, floating_point):
+    nof_channels = 512
+    generator = SpeadGenerator(nof_signals=nof_signals, nof_channels=nof_channels, floating_point=floating_point)
+    spectrum = ramp_spectrum(nof_signals, nof_channels)
+    if not floating_point:
+        spectrum = spectrum.astype(np.uint64)
+
+    packets = generator.build_heap(spectrum, 0)
+    headers, valid = spead.decode_spead_headers(packets)
+    assert np.all(valid)
+
+    # Place payloads in the reassembled buffer as the receiver does, then reorder with the receiver's index
+    nof_signals_per_fpga = nof_signals // 2
+    payloads = packets[:, spead.HEADER_LENGTH:].copy().view('<f8' if floating_point else '<u8')
+    reassembled = np.zeros((2, nof_signals_per_fpga * nof_channels), dtype=payloads.dtype)
+    for header, payload in zip(headers, payloads):
+        offset = header['start_channel_id'] * nof_signals_per_fpga
+        reassembled[header['start_antenna_id'] // nof_signals_per_fpga, offset:offset + payload.size] = payload
+
+    index = compute_reorder_index(nof_signals, nof_channels, floating_point)
+    np.testing.assert_array_equal(np.take(reassembled, index), spectrum)
+
+
+def test_heap_counter():
+    generator = SpeadGenerator(nof_channels=256)
+    spectrum = ramp_spectrum(2, 256)
+
+    for heap in [0, 1, 2, 0x1000001]:
+        headers, _ = spead.decode_spead_headers(generator.build_heap(spectrum, 100 + heap, heap))
+
+        # Every packet of a heap carries the same heap counter and timestamp
+        assert np.all(headers['heap_counter'] == heap & 0xFFFFFF)
+        assert np.all(headers['timestamp'] == 100 + heap)
+        assert len(headers) == generator.nof_packets_per_heap
@@ -0,0 +1,162 @@
+from __future__ import division
+import numpy as np
+import pytest
+
+from reach_ctrl.spectrometer.spectra import Spectra, compute_reorder_index
+from reach_ctrl.spectrometer import telemetry
+
+
+def _reverse_bit(num, nof_channels):
+    """ Reverse the bits of a channel index, as in the original receiver """
+    step = int(np.log2(nof_channels))
+    result = 0
+    for n in range(step):
+        result += (num & 1) << (step - n - 1)
+        num >>= 1
+    return result
+
+
+def _reference_reorder(reassembled, nof_signals, nof_channels, floating_point):
+    """ Demux, descramble and bit reverse a reassembled buffer with the nested loops of the original receiver """
+    nof_signals_per_fpga = nof_signals // 2
+    temp = np.zeros((nof_signals, nof_channels), dtype=reassembled.dtype)
+    buffer = np.zeros((nof_signals, nof_channels), dtype=reassembled.dtype)
+
+    # De-multiplex buffer
+    if nof_signals_per_fpga == 1:
+        temp[:] = reassembled
+    else:
+        for b in range(nof_signals_per_fpga):
+            for n in range(nof_signals_per_fpga * nof_channels):
+                temp[(n % nof_signals_per_fpga) + nof_signals_per_fpga * b, n // nof_signals_per_fpga] = \
+                    reassembled[b, n]
+
+    # Descramble buffer
+    if nof_signals_per_fpga != 1:
+        for b in range(nof_signals):
+            for n in range(nof_channels):
+                if n % 2 == 0:
+                    channel = n // 2
+                else:
+                    channel = n // 2 + nof_channels // 2
+                buffer[b, channel] = temp[b, n]
+    else:
+        buffer[:] = temp
+
+    # Reverse bits if use floating point
+    if floating_point:
+        temp[:] = 0
+        for b in range(nof_signals):
+            for n in range(nof_channels):
+                temp[b, _reverse_bit(n, nof_channels)] = buffer[b, n]
+        buffer[:] = temp
+
+    return buffer
+
+
+@pytest.mark.parametrize("nof_signals", [2, 4])
+@pytest.mark.parametrize("nof_channels", [8, 64, 256, 1024])
+@pytest.mark.parametrize("floating_point", [True, False])
+def test_reorder_index_matches_original_loops(nof_signals, nof_channels, floating_point):
+    # Every sample of the reassembled buffer has a distinct value, so any misplaced sample is detected
+    reassembled = np.arange(nof_signals * nof_channels, dtype=np.uint64).reshape(2, -1) + 1
+
+    expected = _reference_reorder(reassembled, nof_signals, nof_channels, floating_point)
+    index = compute_reorder_index(nof_signals, nof_channels, floating_point)
+
+    assert index.shape == (nof_signals, nof_channels)
+    np.testing.assert_array_equal(np.take(reassembled, index), expected)
+
+
+def test_accumulation_ignores_lost_channels():
+    spectra = Spectra("127.0.0.1", nof_signals=2, nof_channels=8)
+    spectrum = np.full((2, 8), 3.0)
+
+    # The second spectrum lost the upper half of the band of the first signal, which is zero in the heap
+    partial_spectrum = spectrum.copy()
+    partial_mask = np.ones((2, 8), dtype=bool)
+    partial_spectrum[0, 4:] = 0
+    partial_mask[0, 4:] = False
+
+    # The last channel of the second signal is never received
+    never_received = np.ones((2, 8), dtype=bool)
+    never_received[1, 7] = False
+
+    spectra._start_accumulation(3, accumulate=True, sum_of_squares=True)
+    statistics = np.zeros(1, dtype=telemetry.heap_statistics_dtype)[0]
+    statistics['expected_packets'] = 16
+    spectra._add_to_accumulation(0, spectrum * never_received, never_received, statistics)
+    spectra._add_to_accumulation(1, partial_spectrum * never_received, partial_mask & never_received, statistics)
+    spectra._add_to_accumulation(2, spectrum * never_received, never_received, statistics)
+    timestamps, accumulated = spectra._finish_accumulation()
+
+    # Partially received channels are scaled to the number of spectra, so they are not biased low
+    expected = np.full((2, 8), 9.0)
+    expected[1, 7] = 0
+    np.testing.assert_array_equal(timestamps, [0, 1, 2])
+    np.testing.assert_allclose(accumulated, expected)
+
+    count, sum_of_squares, channel_count = spectra.get_accumulation_statistics()
+    assert count == 3
+    np.testing.assert_allclose(sum_of_squares, expected * 3)
+    assert np.all(channel_count[0, :4] == 3) and np.all(channel_count[0, 4:] == 2)
+    assert np.all(channel_count[1, :7] == 3) and channel_count[1, 7] == 0
+    assert len(spectra.get_heap_statistics()) == 3
+    assert np.all(spectra.get_heap_statistics()['expected_packets'] == 16)
+
+
+def _accumulate(spectra, valid_masks, accumulate=True, sum_of_squares=True):
+    """ Pass spectra through the accumulation of a receiver, with lost values zeroed as in received heaps
+    :return: Receiver, timestamps and accumulated spectra """
+    receiver = Spectra("127.0.0.1", nof_signals=spectra.shape[1], nof_channels=spectra.shape[2])
+    receiver._start_accumulation(len(spectra), accumulate, sum_of_squares)
+    statistics = np.zeros(1, dtype=telemetry.heap_statistics_dtype)[0]
+    for i, (spectrum, valid_mask) in enumerate(zip(spectra, valid_masks)):
+        receiver._add_to_accumulation(i, np.where(valid_mask, spectrum, 0), valid_mask, statistics)
+    timestamps, accumulated = receiver._finish_accumulation()
+    return receiver, timestamps, accumulated
+
+
+@pytest.mark.parametrize("nof_spectra", [1, 10])
+def test_accumulation_matches_sum(nof_spectra):
+    spectra = np.random.RandomState(0).uniform(0, 1e6, (nof_spectra, 2, 64))
+    valid_masks = np.ones(spectra.shape, dtype=bool)
+
+    receiver, timestamps, accumulated = _accumulate(spectra, valid_masks)
+    np.testing.assert_array_equal(timestamps, np.arange(nof_spectra))
+    np.testing.assert_allclose(accumulated, np.sum(spectra, axis=0), rtol=1e-12)
+
+    count, sum_of_squares, channel_count = receiver.get_accumulation_statistics()
+    assert count == nof_spectra
+    np.testing.assert_allclose(sum_of_squares, np.sum(spectra ** 2, axis=0), rtol=1e-12)
+    assert np.all(channel_count == nof_spectra)
+
+    # Without sum of squares only the sum is computed, without accumulation every spectrum is returned
+    receiver, _, accumulated = _accumulate(spectra, valid_masks, sum_of_squares=False)
+    np.testing.assert_allclose(accumulated, np.sum(spectra, axis=0), rtol=1e-12)
+    assert receiver.get_accumulation_statistics()[1] is None
+
+    _, timestamps, received = _accumulate(spectra, valid_masks, accumulate=False)
+    np.testing.assert_array_equal(received, spectra)
+    assert len(timestamps) == nof_spectra
+
+
+def test_accumulation_scales_missing_channels_by_count():
+    random = np.random.RandomState(1)
+    spectra = random.uniform(0, 1e6, (10, 2, 64))
+    valid_masks = random.uniform(size=spectra.shape) > 0.3
+    valid_masks[:, 1, 5] = False
+
+    receiver, _, accumulated = _accumulate(spectra, valid_masks)
+    count, sum_of_squares, channel_count = receiver.get_accumulation_statistics()
+    np.testing.assert_array_equal(channel_count, valid_masks.sum(axis=0))
+
+    # Each channel is the mean of its received values times the number of spectra, channels which were never
+    # received are zero
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = np.where(channel_count > 0, count / channel_count, 0)
+    expected = np.sum(np.where(valid_masks, spectra, 0), axis=0) * scale
+    expected_squares = np.sum(np.where(valid_masks, spectra ** 2, 0), axis=0) * scale
+    assert np.any((channel_count > 0) & (channel_count < count)) and accumulated[1, 5] == 0
+    np.testing.assert_allclose(accumulated, expected, rtol=1e-12)
+    np.testing.assert_allclose(sum_of_squares, expected_squares, rtol=1e-12)
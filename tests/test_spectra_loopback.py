@@ -0,0 +1,198 @@
+import threading
+import socket
+import numpy as np
+import pytest
+
+from reach_ctrl.spectrometer.batch_receiver import BatchReceiver
+from reach_ctrl.spectrometer.spectra import Spectra
+from reach_ctrl.spectrometer.spead_generator import SpeadGenerator, ramp_spectrum, TIMESTAMP_PERIOD
+from reach_ctrl.spectrometer import spead
+
+NOF_CHANNELS = 1024
+INTEGRATION_TIME = 0.05
+
+
+def _free_port():
+    """ Get a UDP port which is not in use """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+@pytest.fixture
+def loopback():
+    """ Receiver and a generator sending heaps to it in real time, until the test finishes """
+    port = _free_port()
+    spectra = Spectra("127.0.0.1", port=port, nof_channels=NOF_CHANNELS)
+    spectra.initialise()
+
+    generator = SpeadGenerator(port=port, nof_channels=NOF_CHANNELS, integration_time=INTEGRATION_TIME)
+    stop = threading.Event()
+    thread = threading.Thread(target=generator.run, args=(-1,),
+                              kwargs={'heap_rate': 1 / INTEGRATION_TIME, 'stop_event': stop})
+    thread.start()
+
+    yield spectra, generator
+
+    stop.set()
+    thread.join()
+    generator.close()
+    spectra.close()
+
+
+def test_receiver_reassembles_generator_spectra(loopback):
+    spectra, _ = loopback
+    spectra.start_receiver(3)
+    timestamps, received = spectra.wait_for_receiver()
+
+    assert len(timestamps) == 3
+    for spectrum in received:
+        np.testing.assert_array_equal(spectrum, ramp_spectrum(2, NOF_CHANNELS))
+
+
+def test_persistent_receiver_has_no_dead_time(loopback):
+    spectra, generator = loopback
+    spectra.start_persistent_receiver()
+
+    # Heaps which arrive between acquisitions are used by the next acquisition
+    timestamps = []
+    for _ in range(3):
+        spectra.start_receiver(4, accumulate=True)
+        acquired, accumulated = spectra.wait_for_receiver()
+        timestamps.extend(acquired)
+        np.testing.assert_allclose(accumulated, 4 * ramp_spectrum(2, NOF_CHANNELS))
+        threading.Event().wait(3 * INTEGRATION_TIME)
+
+    step = generator._timestamp_step * TIMESTAMP_PERIOD
+    np.testing.assert_allclose(np.diff(timestamps), step, atol=1e-5)
+
+
+def test_persistent_receiver_start_time(loopback):
+    spectra, _ = loopback
+    spectra.start_persistent_receiver()
+
+    timestamps, _ = spectra.get(2)
+    threading.Event().wait(4 * INTEGRATION_TIME)
+
+    # Queued heaps older than the start time are skipped
+    start_time = timestamps[-1] + 2.5 * INTEGRATION_TIME
+    spectra.start_receiver(2, start_time=start_time)
+    later_timestamps, _ = spectra.wait_for_receiver()
+    assert len(later_timestamps) == 2
+    assert later_timestamps[0] >= start_time
+    assert later_timestamps[0] - timestamps[-1] < 4 * INTEGRATION_TIME
+
+
+def _send_burst(spectra, nof_heaps, lost, first_heap=0, generator=None):
+    """ Send heaps of spectra which differ per heap to the receiver in one burst, without some packets
+    :return: Sent spectra, and the mask of received values in (signal, channel) order of each heap """
+    generator = generator or SpeadGenerator(nof_channels=NOF_CHANNELS)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sent, masks = [], []
+    try:
+        for heap in range(first_heap, first_heap + nof_heaps):
+            sent.append(ramp_spectrum(2, NOF_CHANNELS) + 10000 * heap)
+            packets = generator.build_heap(sent[-1], 10 * (heap + 1), heap)
+            headers, _ = spead.decode_spead_headers(packets)
+            mask = np.ones(2 * NOF_CHANNELS, dtype=bool)
+            for i, (header, packet) in enumerate(zip(headers, packets)):
+                if i in lost.get(heap, []):
+                    index = (header['start_antenna_id'] * NOF_CHANNELS + header['start_channel_id'])
+                    mask[generator._gather_index[index // generator._values_per_packet]] = False
+                else:
+                    sender.sendto(packet.tobytes(), spectra._socket.getsockname())
+            masks.append(mask.reshape(2, NOF_CHANNELS))
+    finally:
+        sender.close()
+    return sent, masks
+
+
+@pytest.mark.parametrize("emit_partial_heaps", [True, False])
+def test_burst_larger_than_one_drain(emit_partial_heaps):
+    # Each receive call drains at most 8 packets, a heap has 16 packets
+    spectra = Spectra("127.0.0.1", port=0, nof_channels=NOF_CHANNELS, batch_size=8, nof_inflight_heaps=2,
+                      emit_partial_heaps=emit_partial_heaps)
+    spectra.initialise()
+    try:
+        lost = {1: [3, 15], 3: [0]}
+        sent, masks = _send_burst(spectra, 6, lost)
+
+        received = []
+        while len(received) < (6 if emit_partial_heaps else 4):
+            _, spectrum = spectra.receive_spectrum()
+            received.append((spectrum.copy(), spectra.valid_mask.copy(), spectra.heap_statistics.copy()))
+    finally:
+        spectra.close()
+
+    # Heaps are returned in order, incomplete heaps with the values of the lost packets marked as missing
+    heaps = range(6) if emit_partial_heaps else [0, 2, 4, 5]
+    for heap, (spectrum, valid_mask, statistics) in zip(heaps, received):
+        np.testing.assert_array_equal(valid_mask, masks[heap])
+        np.testing.assert_array_equal(spectrum[valid_mask], sent[heap][valid_mask])
+        assert statistics['received_packets'] == 16 - len(lost.get(heap, []))
+
+    statistics = np.array([heap[2] for heap in received])
+    assert statistics['dropped_heaps'].sum() == (0 if emit_partial_heaps else 2)
+    assert statistics['late_packets'].sum() == statistics['invalid_packets'].sum() == 0
+    assert statistics['kernel_drops'].sum() == 0
+
+
+def _heap_index(spectrum, valid_mask):
+    """ Index of a heap sent by _send_burst, from its received values """
+    return int(round((spectrum[valid_mask][0] - ramp_spectrum(2, NOF_CHANNELS)[valid_mask][0]) / 10000))
+
+
+def _receive_overflowing_burst(batch_receive):
+    """ Send a burst which overflows the socket buffer before the receiver runs, then one more heap
+    :return: Heap index, valid mask and heap statistics of every received heap """
+    spectra = Spectra("127.0.0.1", port=0, nof_channels=NOF_CHANNELS, batch_receive=batch_receive,
+                      batch_size=8, nof_inflight_heaps=1)
+    spectra.initialise()
+    if not spectra._monitor_kernel_drops:
+        spectra.close()
+        pytest.skip("Kernel packet drop monitoring not available")
+    spectra._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16384)
+
+    received = []
+    try:
+        generator = SpeadGenerator(nof_channels=NOF_CHANNELS)
+        sent, _ = _send_burst(spectra, 8, {}, generator=generator)
+
+        # The last heap is sent once the burst is received, with the socket buffer restored and the same sync
+        # time, and pushes the partial heap of the burst out of the reassembler
+        def send_last_heap():
+            spectra._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 2 * 1024 * 1024)
+            sent.extend(_send_burst(spectra, 1, {}, first_heap=8, generator=generator)[0])
+
+        sender = threading.Timer(0.3, send_last_heap)
+        sender.start()
+        while not received or received[-1][0] != 8:
+            _, spectrum = spectra.receive_spectrum()
+            heap = _heap_index(spectrum, spectra.valid_mask)
+            np.testing.assert_array_equal(spectrum[spectra.valid_mask], sent[heap][spectra.valid_mask])
+            received.append((heap, spectra.valid_mask.copy(), spectra.heap_statistics.copy()))
+        sender.join()
+    finally:
+        spectra.close()
+    return received
+
+
+@pytest.mark.skipif(not BatchReceiver.available(), reason="recvmmsg not available")
+def test_batch_receive_matches_per_packet_receive():
+    per_packet, batched = [_receive_overflowing_burst(batch_receive) for batch_receive in [False, True]]
+
+    # Every packet of the burst is either received or reported as dropped by the kernel
+    statistics = np.array([heap[2] for heap in per_packet])
+    assert np.all(per_packet[-1][1])
+    assert statistics['kernel_drops'].sum() > 0
+    assert statistics['received_packets'][:-1].sum() + statistics['kernel_drops'].sum() == 8 * 16
+
+    # Both receive paths return the same heaps, with the same valid values and statistics. Timestamps differ
+    # by the sync time of each run
+    assert [heap[0] for heap in batched] == [heap[0] for heap in per_packet]
+    fields = [name for name in statistics.dtype.names if name != 'timestamp']
+    for (_, batched_mask, batched_statistics), (_, mask, heap_statistics) in zip(batched, per_packet):
+        np.testing.assert_array_equal(batched_mask, mask)
+        assert batched_statistics[fields].tolist() == heap_statistics[fields].tolist()
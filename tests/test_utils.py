@@ -0,0 +1,120 @@
+from datetime import datetime, timezone
+import calendar
+import numpy as np
+import pytest
+
+from reach_ctrl import utils
+
+ephem = pytest.importorskip("ephem")
+
+LONGITUDE = 21.4
+
+
+def _ephem_sidereal_time(timestamp, longitude=LONGITUDE):
+    """ Local apparent sidereal time in degrees computed by ephem """
+    observer = ephem.Observer()
+    observer.lon = str(longitude)
+    observer.lat = '-30.8'
+    observer.date = ephem.Date(timestamp / 86400.0 + 2440587.5 - 2415020.0)
+    return np.degrees(float(observer.sidereal_time()))
+
+
+def _angle_difference(first, second):
+    """ Difference between angles in degrees, wrapped to [-180, 180) """
+    return np.mod(np.asarray(first) - np.asarray(second) + 180.0, 360.0) - 180.0
+
+
+def test_sidereal_times_match_ephem():
+    timestamps = np.random.RandomState(1).uniform(0.7e9, 2.2e9, 500)
+
+    lst = utils.get_sidereal_times(timestamps, LONGITUDE)
+    expected = [_ephem_sidereal_time(timestamp) for timestamp in timestamps]
+
+    assert lst.shape == timestamps.shape
+    assert np.max(np.abs(_angle_difference(lst, expected))) * 3600 < 0.3
+
+
+def test_sidereal_time_scalar():
+    timestamp = 1.7e9
+    lst = utils.get_sidereal_time(LONGITUDE, -30.8, timestamp)
+    assert isinstance(lst, float)
+    assert 0 <= lst < 360
+    assert abs(_angle_difference(lst, _ephem_sidereal_time(timestamp))) * 3600 < 0.3
+
+
+def _ephem_lst_error(timeline, lst):
+    """ Largest difference between the LST computed by ephem at each instant and the expected LST, in arcseconds """
+    actual = [_ephem_sidereal_time(timestamp) for timestamp in timeline]
+    return np.max(np.abs(_angle_difference(actual, lst))) * 3600
+
+
+@pytest.mark.parametrize("start_lst, start_time", [(0.0, 1.7e9), (123.4, 1.0e9), (359.99, 2.1e9)])
+def test_lst_timeline_matches_ephem(start_lst, start_time):
+    timeline = utils.get_lst_timeline(start_lst, LONGITUDE, start_time, period=86400, repetitions=400)
+
+    # The LST is reached on 400 consecutive sidereal days, starting within a sidereal day of the start time
+    assert timeline.shape == (400,)
+    assert start_time <= timeline[0] < start_time + 86164.1
+    np.testing.assert_allclose(np.diff(timeline), 86164.09, atol=0.1)
+    assert _ephem_lst_error(timeline, start_lst) < 0.3
+
+    # Shorter periods are in sidereal seconds
+    timeline = utils.get_lst_timeline(start_lst, LONGITUDE, start_time, period=3600, repetitions=30)
+    assert _ephem_lst_error(timeline, start_lst + np.arange(30) * 15.0) < 0.3
+
+
+def test_utc_schedule_timeline():
+    start = calendar.timegm((2024, 3, 1, 22, 30, 0))
+    expected = start + 600.0 * np.arange(3)
+
+    for mode in ["UTC", "uct"]:
+        np.testing.assert_array_equal(utils.get_schedule_timeline("01/03/2024_22:30", mode, period=600,
+                                                                  repetitions=3), expected)
+    np.testing.assert_array_equal(utils.get_schedule_timeline(float(start), "UTC", period=600, repetitions=3),
+                                  expected)
+    np.testing.assert_array_equal(
+        utils.get_schedule_timeline(datetime(2024, 3, 1, 22, 30, tzinfo=timezone.utc), "UTC", period=600,
+                                    repetitions=3), expected)
+    np.testing.assert_array_equal(utils.get_schedule_timeline("now", "UTC", period=600, repetitions=3,
+                                                              start_time=start), expected)
+
+
+def test_lst_schedule_timeline():
+    start_time = calendar.timegm((2024, 3, 1, 12, 0, 0))
+
+    # Next occurrence of an LST, and the first occurrence on or after a UTC date
+    timeline = utils.get_schedule_timeline("17:45", "LST", LONGITUDE, period=86400, repetitions=5,
+                                           start_time=start_time)
+    assert start_time <= timeline[0] < start_time + 86164.1
+    assert _ephem_lst_error(timeline, 17.75 * 15) < 0.3
+
+    not_before = calendar.timegm((2024, 6, 10, 0, 0, 0))
+    timeline = utils.get_schedule_timeline("10/06/2024_17:45:30", "LST", LONGITUDE, start_time=start_time)
+    assert not_before <= timeline[0] < not_before + 86164.1
+    assert _ephem_lst_error(timeline, (17 + 45.5 / 60) * 15) < 0.3
+
+    # Dates in the past search from the current time
+    timeline = utils.get_schedule_timeline("01/01/2020_17:45", "LST", LONGITUDE, start_time=start_time)
+    assert start_time <= timeline[0] < start_time + 86164.1
+
+    # Instants start at that instant, and repeat at the same LST
+    for date_time in ["now", start_time, datetime.fromtimestamp(start_time, timezone.utc)]:
+        timeline = utils.get_schedule_timeline(date_time, "LST", LONGITUDE, period=86400, repetitions=3,
+                                               start_time=start_time)
+        assert abs(timeline[0] - start_time) < 1e-3
+        assert _ephem_lst_error(timeline, _ephem_sidereal_time(start_time)) < 0.3
+
+
+def test_invalid_schedules():
+    with pytest.raises(ValueError):
+        utils.get_schedule_timeline("now", "GPS")
+    with pytest.raises(ValueError):
+        utils.get_schedule_timeline("17:45", "LST")
+    for date_time in ["17", "17:45:30:00", "10/06/2024_17"]:
+        with pytest.raises(ValueError):
+            utils._parse_lst(date_time)
+
+    # Invalid and past schedules are logged and do not wait
+    utils.schedule("17:45", "GPS")
+    utils.schedule("01/01/2020_00:00", "UTC")
+    utils.wait_until(0)